@@ -2,38 +2,50 @@
 # cython: language_level=3str, wraparound=False, boundscheck=False, nonecheck=False
 
 import binascii
-from cpython.version cimport PY_MAJOR_VERSION
+from collections import OrderedDict
+from cpython.buffer cimport (
+    PyBUF_SIMPLE, PyBUF_WRITABLE, PyBuffer_Release, PyObject_GetBuffer)
+from cpython.bytes cimport (
+    PyBytes_AS_STRING, PyBytes_CheckExact, PyBytes_GET_SIZE)
 from datetime import datetime, timedelta, tzinfo
-import difflib
 from functools import wraps
 import glob
 import hashlib
-from libc.stdint cimport uint8_t, uint32_t, uint64_t
-from libc.stdlib cimport free
+import json
+from libc.stdint cimport int8_t, int64_t, uint8_t, uint32_t, uint64_t
+from libc.stdlib cimport calloc, free
+from libc.string cimport memcmp, memcpy
+from libc.time cimport time as _c_time
+from posix.fcntl cimport (
+    POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED, posix_fadvise)
+from posix.unistd cimport close as _close_fd
+import json
 from math import log
+import mmap
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import os
+import queue
 import re
-from threading import Lock
+import socket
+import sqlite3
+import struct
+import threading
+from threading import Lock, RLock
 import time
+import traceback
 from typing import Dict, Tuple
 import warnings
 
-# if throws "module 'lzf' has no attribute 'decompress'",
-# `pip uninstall lzf && pip install python-lzf`
-import lzf
+try:  # numpy is optional, only used for bulk operations
+    import numpy as np
+except ImportError:
+    np = None
 
 __version__ = '2.2.2'
 __author__ = 'marat@cmu.edu'
 __license__ = 'GPL v3'
 
-if PY_MAJOR_VERSION < 3:
-    str_type = unicode
-    bytes_type = str
-else:
-    str_type = str
-    bytes_type = bytes
-
-
 try:
     with open('/etc/hostname') as fh:
         HOSTNAME = fh.read().strip()
@@ -54,14 +66,6 @@ if not IS_TEST_ENV:
         warnings.warn('Commit and tree direct content is only available on da4.'
                       ' Some functions might not work as expected.\n\n')
 
-# Cython is generally smart enough to convert data[i] to int, but
-# pyximport in Py2 fails to do so, requires to use ord explicitly
-# TODO: get rid of this shame once Py2 support is dropped
-cdef uint8_t nth_byte(bytes data, uint32_t i):
-    if PY_MAJOR_VERSION < 3:
-        return ord(data[i])
-    return data[i]
-
 def _latest_version(path_template):
     if '{ver}' not in path_template:
         return ''
@@ -99,111 +103,327 @@ def _key_length(str path_template):
     # this caused hard to catch bugs before
     str_keys = [fname[_prefix_len:len(fname)-len(postfix)] for fname in filenames]
     keys = [int(key) for key in str_keys if key]
-    # Py2/3 compatible version
     return int(log(max(keys or [0]) + 1, 2))
     # re_pattern = path_template.format(key='(\d+)', ver='([A-Za-z0-9]+)')
     # _matched = re.match(re_pattern, 'c2cFull{ver}.0.tch')
 
-VERSIONS = {}  # type: Dict[str, str]
+# if a data type is not found, its location is modified in this order
+# until there is a match, e.g. /da5_fast -> /da4_fast -> /da3_fast -> ...
+_FALLBACK_CHAIN = (
+    ('da5', 'da4'),
+    ('da4', 'da3'),
+    ('da3_fast', 'da7_data/basemaps'),
+    ('da7', 'da0'),
+    ('da0', 'da5'),
+    ('da5', 'da8'),
+    ('da8', 'never_gonna_happen'),
+)
+
 
-def _get_paths(dict raw_paths):
-    # type: (Dict[str, Tuple[str, Dict[str, str]]]) -> Dict[str, Tuple[bytes, int]]
-    """
-    Compose path from
-    Args:
-        raw_paths (Dict[str, Tuple[str, Dict[str, str]]]): see example below
+class _Versions(dict):
+    """ Data type versions, resolved together with paths """
+    def __init__(self, paths):
+        super(_Versions, self).__init__()
+        self._paths = paths
+
+    def __missing__(self, dtype):
+        self._paths[dtype]  # resolving the path sets the version
+        version = dict.get(self, dtype)
+        if version is None:
+            raise KeyError(dtype)
+        return version
+
+
+class PathRegistry(dict):
+    """ Map data types to a path template and a key length, e.g.:
+        'author_commits' -> ('/da0_data/basemaps/a2cFullR.{key}.tch', 5)
+
+    Paths are resolved lazily, on first access to a data type, because
+    globbing ~30 data types over NFS makes import take seconds.
+    Resolution is done at most once per data type.
+
+    If `manifest_path` is given, resolved paths are also stored in this JSON
+    file, so that other processes can reuse them without globbing.
+    Manifest entries are keyed by host and `OSCAR_*` environment variables,
+    and are invalidated when any of the data directories up to the resolved
+    one in the fallback chain is modified, or versions of the first shard
+    in the resolved directory are added or replaced.
+
+    The same shards are often available on several hosts. Besides the
+    resolved location, directories listed in `OSCAR_<CATEGORY>_REPLICAS` or
+    `OSCAR_<DATA_TYPE>_REPLICAS` (separated by `os.pathsep`) that have the
+    same files are used as replicas of the data type, see `ReplicaRouter`.
+    Other locations of the fallback chain are only checked for replicas
+    if `discover_replicas` is set (OSCAR_DISCOVER_REPLICAS environment
+    variable), since a dead mount there would stall first reads of every
+    data type.
 
-    Returns:
-        (Dict[str, Tuple[str, int]]: map data type to a path template and a key
-            length, e.g.:
-            'author_commits' -> ('/da0_data/basemaps/a2cFullR.{key}.tch', 5)
+    Args:
+        raw_paths (Dict[str, Tuple[str, Dict[str, str]]]): map of a category
+            (environment variable to override location) to a default location
+            and filename templates of data types in this category
+        manifest_path (Optional[str]): path to the JSON manifest
     """
-    paths = {}  # type: Dict[str, Tuple[bytes, int]]
-    local_data_prefix = '/' + HOST + '_data'
-    for category, (path_prefix, filenames) in raw_paths.items():
-        cat_path_prefix = os.environ.get(category, path_prefix)
-        cat_version = os.environ.get(category + '_VER') or _latest_version(
-            os.path.join(cat_path_prefix, list(filenames.values())[0]))
+    def __init__(self, raw_paths, manifest_path=None):
+        super(PathRegistry, self).__init__()
+        # data type -> (category, filename template)
+        self._sources = {}  # type: Dict[str, Tuple[str, str]]
+        # category -> (default location, filename template to get version)
+        self._categories = {}  # type: Dict[str, Tuple[str, str]]
+        for category, (path_prefix, filenames) in raw_paths.items():
+            self._categories[category] = (
+                path_prefix, list(filenames.values())[0])
+            for ptype, fname in filenames.items():
+                self._sources[ptype] = (category, fname)
+        self._resolved = set()
+        self._category_versions = {}  # type: Dict[str, str]
+        # data type -> path templates of all copies, the primary first
+        self._replicas = {}  # type: Dict[str, List[str]]
+        # data type -> (key length, replica locations, shard -> paths)
+        self._routes = {}  # type: Dict[str, tuple]
+        self._lock = RLock()
+        self.versions = _Versions(self)
+        self.manifest_path = manifest_path
+        self._manifest_key = None
+        self.discover_replicas = bool(
+            os.environ.get('OSCAR_DISCOVER_REPLICAS'))
+
+    def __missing__(self, dtype):
+        with self._lock:
+            if dtype not in self._resolved and dtype in self._sources:
+                self._resolved.add(dtype)
+                resolved = self._from_manifest(dtype)
+                if resolved is None:
+                    resolved = self._resolve(dtype)
+                    if resolved is not None and self.manifest_path:
+                        self._to_manifest(dtype, resolved)
+                if resolved is not None:
+                    path_template, key_length, version = resolved[:3]
+                    dict.__setitem__(self.versions, dtype, version)
+                    dict.__setitem__(self, dtype, (path_template, key_length))
+        path = dict.get(self, dtype)
+        if path is None:
+            raise KeyError(dtype)
+        return path
+
+    def __setitem__(self, dtype, value):
+        with self._lock:
+            dict.__setitem__(self, dtype, value)
+            # paths set explicitly have no replicas unless added later
+            self._replicas[dtype] = [value[0]]
+            self._routes.pop(dtype, None)
+
+    def __delitem__(self, dtype):
+        with self._lock:
+            dict.__delitem__(self, dtype)
+            self._replicas.pop(dtype, None)
+            self._routes.pop(dtype, None)
+
+    def __contains__(self, dtype):
+        return self.get(dtype) is not None
+
+    def get(self, dtype, default=None):
+        try:
+            return self[dtype]
+        except KeyError:
+            return default
+
+    def resolve_all(self):
+        """ Resolve all known data types; normally it is done on demand """
+        for dtype in self._sources:
+            self.get(dtype)
+        return self
+
+    def _category_prefix(self, category):
+        cat_path_prefix = os.environ.get(category, self._categories[category][0])
+        local_data_prefix = '/' + HOST + '_data'
         if cat_path_prefix.startswith(local_data_prefix):
             cat_path_prefix = '/data' + cat_path_prefix[len(local_data_prefix):]
+        return cat_path_prefix
+
+    def _category_version(self, category):
+        if category not in self._category_versions:
+            self._category_versions[category] = os.environ.get(
+                category + '_VER') or _latest_version(os.path.join(
+                    self._category_prefix(category),
+                    self._categories[category][1]))
+        return self._category_versions[category]
+
+    def _locations(self, dtype):
+        """ Data directories to look for the data type, in the order of
+        the fallback chain """
+        category, fname = self._sources[dtype]
+        ppath = os.environ.get(
+            '_'.join(['OSCAR', dtype.upper()]), self._category_prefix(category))
+        for replace_from, replace_to in _FALLBACK_CHAIN:
+            yield ppath
+            ppath = ppath.replace(replace_from, replace_to)
+
+    def _resolve(self, dtype):
+        """ Find location of the data type by globbing data directories
 
-        for ptype, fname in filenames.items():
-            ppath = os.environ.get(
-                '_'.join(['OSCAR', ptype.upper()]), cat_path_prefix)
-            for replace_from, replace_to in [
-                ('da5', 'da4'),
-                ('da4', 'da3'),
-                ('da3_fast', 'da7_data/basemaps'),
-                ('da7', 'da0'),
-                ('da0', 'da5'),
-                ('da5', 'da8'),
-                ('da8', 'never_gonna_happen'),
-            ]:
+        Returns:
+            Optional[Tuple[str, int, str, str]]: path template, key length,
+                version and the data directory
+        """
+        category, fname = self._sources[dtype]
+        for ppath in self._locations(dtype):
+            path_template = os.path.join(ppath, fname)
+            key_length = _key_length(path_template)
+            # match
+            if key_length:
                 # get the latest version for the current mapping
-                path_template = os.path.join(ppath, fname)
-                pver = os.environ.get(
-                    '_'.join(['OSCAR', ptype.upper(), 'VER']), 
-                    _latest_version(path_template) or cat_version)
-                path_template = os.path.join(ppath, fname)
-                key_length = _key_length(path_template)
-
-                # match
-                if key_length:
-                    if ptype in VERSIONS and VERSIONS[ptype] > pver:
-                        warnings.warn(
-                            "Skipping older version of %s: %s > %s" % (
-                                ptype, VERSIONS[ptype], pver))
-                        continue
-                    VERSIONS[ptype] = pver
-                    paths[ptype] = (
-                        path_template.format(ver=pver, key='{key}'), key_length)
-                    break
-                # mismatch
-                ppath = ppath.replace(replace_from, replace_to)
-            
-            else:
-                warnings.warn("No keys found for path_template %s:\n%s" % (
-                    ptype, path_template))
-
-            # # TODO: .format with pver and check keys only
-            # # this will allow to handle 2-char versions
-            # key_length = _key_length(path_template)
-            # if not key_length and not IS_TEST_ENV:
-            #     ppath = ppath .replace('da5','da4')
-            #     path_template = os.path.join(ppath, fname)
-            #     key_length = _key_length(path_template)
-            #     if not key_length:
-            #       ppath = ppath .replace('da4','da3')
-            #       path_template = os.path.join(ppath, fname)
-            #       key_length = _key_length(path_template)
-            #       if not key_length:
-            #         ppath = ppath .replace('da3_fast','da7_data/basemaps')
-            #         path_template = os.path.join(ppath, fname)
-            #         key_length = _key_length(path_template)
-            #         if not key_length:
-            #           ppath = ppath .replace('da7','da0')
-            #           path_template = os.path.join(ppath, fname)
-            #           key_length = _key_length(path_template)
-            #           if not key_length:
-            #             ppath = ppath .replace('da0','da5')
-            #             path_template = os.path.join(ppath, fname)
-            #             key_length = _key_length(path_template)
-            #             if not key_length:
-            #               ppath = ppath .replace('da5','da8')
-            #               path_template = os.path.join(ppath, fname)
-            #               key_length = _key_length(path_template)
-            #               if not key_length:
-            #                 warnings.warn("No keys found for path_template %s:\n%s" % (
-            #                    ptype, path_template))
-            # VERSIONS[ptype] = pver
-            # paths[ptype] = (
-            #     path_template.format(ver=pver, key='{key}'), key_length)
-    return paths
+                pver = os.environ.get('_'.join(['OSCAR', dtype.upper(), 'VER']))
+                if pver is None:
+                    pver = (_latest_version(path_template)
+                            or self._category_version(category))
+                return (path_template.format(ver=pver, key='{key}'),
+                        key_length, pver, ppath)
+
+        warnings.warn("No keys found for path_template %s:\n%s" % (
+            dtype, path_template))
+        return None
+
+    def replicas(self, dtype):
+        """ Path templates of all copies of the data type, the resolved
+        one first. Candidate locations are only checked to have the first
+        shard of the same version, so that it doesn't take globbing.
+
+        Raises:
+            KeyError: if the data type is not available
+        """
+        path_template = self[dtype][0]
+        if dtype in self._replicas:
+            return self._replicas[dtype]
+        with self._lock:
+            if dtype in self._replicas:
+                return self._replicas[dtype]
+            templates = [path_template]
+            category, fname = self._sources[dtype]
+            version = self.versions[dtype]
+            candidates = []
+            if self.discover_replicas:
+                candidates.extend(self._locations(dtype))
+            for name in (category, 'OSCAR_' + dtype.upper()):
+                candidates.extend(os.environ.get(
+                    name + '_REPLICAS', '').split(os.pathsep))
+            for ppath in candidates:
+                if not ppath:
+                    continue
+                template = os.path.join(ppath, fname).format(
+                    ver=version, key='{key}')
+                if template not in templates \
+                        and os.path.exists(template.format(key=0)):
+                    templates.append(template)
+            self._replicas[dtype] = templates
+        return templates
+
+    def add_replica(self, dtype, path_template):
+        """ Register one more copy of the data type, e.g. on another host.
+        The template has to have the same sharding as the resolved one.
+        """
+        templates = self.replicas(dtype)
+        with self._lock:
+            if path_template not in templates:
+                self._replicas[dtype] = templates + [path_template]
+                self._routes.pop(dtype, None)
+
+    def routes(self, dtype):
+        """ Get precomputed paths to read the data type from, so that
+        reads do no string formatting.
+
+        Returns:
+            Tuple[int, Tuple[str, ...], List[Tuple[bytes, ...]]]: key length,
+                replica locations (directories) and, for every shard,
+                paths to this shard in every replica
+        """
+        route = self._routes.get(dtype)
+        if route is not None:
+            return route
+        prefix_length = self[dtype][1]
+        templates = self.replicas(dtype)
+        route = (
+            prefix_length,
+            tuple(os.path.dirname(template) for template in templates),
+            [tuple(template.format(key=shard).encode('ascii')
+                   for template in templates)
+             for shard in range(1 << prefix_length)])
+        self._routes[dtype] = route
+        return route
+
+    def _get_manifest_key(self):
+        if self._manifest_key is None:
+            overrides = sorted((k, v) for k, v in os.environ.items()
+                               if k.startswith('OSCAR_'))
+            self._manifest_key = HOST + ':' + hashlib.sha1(
+                repr(overrides).encode('utf8')).hexdigest()
+        return self._manifest_key
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _signature(self, dtype, directory):
+        """ State of files the resolution of a data type depends on:
+        modification times of locations up to the resolved one in the
+        fallback chain, where new files would take precedence, and all
+        versions of the first shard in the resolved location """
+        signature = []
+        for ppath in self._locations(dtype):
+            if any(ppath == location for location, _ in signature):
+                continue
+            try:
+                mtime = os.stat(ppath).st_mtime
+            except OSError:
+                mtime = None
+            signature.append([ppath, mtime])
+            if ppath == directory:
+                break
+        fname = self._sources[dtype][1]
+        for path in sorted(glob.glob(
+                os.path.join(directory, fname).format(key=0, ver='*'))):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append([path, stat.st_mtime, stat.st_size])
+        return signature
+
+    def _from_manifest(self, dtype):
+        if not self.manifest_path:
+            return None
+        entry = self._read_manifest().get(
+            self._get_manifest_key(), {}).get(dtype)
+        if not entry:
+            return None
+        path_template, key_length, version, directory, signature = entry
+        if signature != self._signature(dtype, directory):
+            return None
+        return path_template, key_length, version, directory
+
+    def _to_manifest(self, dtype, resolved):
+        directory = resolved[3]
+        try:
+            signature = self._signature(dtype, directory)
+            manifest = self._read_manifest()
+            manifest.setdefault(self._get_manifest_key(), {})[dtype] = \
+                list(resolved) + [signature]
+            # write and rename to avoid partial reads by other processes
+            tmp_path = '%s.%d.tmp' % (self.manifest_path, os.getpid())
+            with open(tmp_path, 'w') as fh:
+                json.dump(manifest, fh)
+            os.rename(tmp_path, self.manifest_path)
+        except (IOError, OSError) as e:
+            warnings.warn('Failed to update paths manifest %s: %s' % (
+                self.manifest_path, e))
 
 
 # note to future self: Python2 uses str (bytes) for os.environ,
 # Python3 uses str (unicode). Don't add Py2/3 compatibility prefixes here
-PATHS = _get_paths({
+PATHS = PathRegistry({
     'OSCAR_ALL_BLOBS': ('/da5_data/All.blobs/', {
         'commit_sequential_idx': 'commit_{key}.idx',
         'commit_sequential_bin': 'commit_{key}.bin',
@@ -248,7 +468,8 @@ PATHS = _get_paths({
         'file_blobs': 'f2bFull{ver}.{key}.tch',
         'blob_files': 'b2fFull{ver}.{key}.tch',
     }),
-})
+}, os.environ.get('OSCAR_PATHS_MANIFEST'))
+VERSIONS = PATHS.versions  # type: Dict[str, str]
 
 # prefixes used by World of Code to identify source project platforms
 # See Project.to_url() for more details
@@ -271,6 +492,11 @@ URL_PREFIXES = {
     b'salsa.debian.org': b'salsa.debian.org',
     b'sourceforge.net': b'git.code.sf.net/p'
 }
+# read buffer for sequential scans of .bin files
+SEQUENTIAL_BUFFER_SIZE = 16 * 1024 ** 2
+# how far ahead to prefetch .tch files in full scans, see `Hash.items()`
+SCAN_READAHEAD = 64 * 1024 ** 2
+
 IGNORED_AUTHORS = (
     b'GitHub Merge Button <merge-button@github.com>'
 )
@@ -279,6 +505,144 @@ class ObjectNotFound(KeyError):
     pass
 
 
+class ShardError(RuntimeError):
+    """ Raised by `map_shards()` after all shards are processed if some of
+    them have failed. Failed shards are listed in the `shards` attribute,
+    so that they can be re-run using `shards=` parameter """
+    def __init__(self, message, shards):
+        super(ShardError, self).__init__(message)
+        self.shards = shards
+
+
+_clock = time.perf_counter
+# collectors currently recording; checking a C flag keeps the overhead
+# of disabled instrumentation down to a single comparison
+cdef list _ACTIVE_STATS = []
+cdef bint _STATS_ON = False
+_STATS_LOCK = Lock()
+
+
+class Stats(object):
+    """ Counters of storage reads, decompression and parsing, to find out
+    what a slow job is bound by. Events are recorded as operation, data type
+    and shard, each with count, bytes and cumulative time in seconds:
+
+    - `read_tch`: `_Base.read_tch()`, by data type and shard
+    - `read_many`: batch reads, e.g. `fetch_many()`, by data type and shard
+    - `hash_read`: low level .tch reads
+    - `decomp`: LZF decompression, bytes are uncompressed size
+    - `blob_data`: `Blob.data`, by shard
+    - `commit_parse`, `tree_parse`: parsing of commits and trees
+
+    Data type and shard are None if they are unknown, e.g. for direct
+    `decomp()` calls; batch decompression of many shards has no shard.
+
+    The global collector is returned by `stats()`. Collection can be
+    enabled globally, or only within a `with` block:
+
+        >>> with Stats() as s:  # doctest: +SKIP
+        ...     Project('user2589_minicms').head
+        >>> s.counters(by=('op', 'dtype'))  # doctest: +SKIP
+        {('read_tch', 'project_commits'): {'count': 1, 'bytes': ..., ...}
+
+    Callbacks are called on every event with
+    `(op, dtype, shard, nbytes, seconds)`, e.g. to export to a metrics
+    system.
+    """
+    _fields = ('op', 'dtype', 'shard')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._data = {}  # type: Dict[tuple, list]
+        self.callbacks = []
+
+    @property
+    def enabled(self):
+        return self in _ACTIVE_STATS
+
+    def enable(self):
+        global _STATS_ON
+        with _STATS_LOCK:
+            if self not in _ACTIVE_STATS:
+                _ACTIVE_STATS.append(self)
+            _STATS_ON = True
+
+    def disable(self):
+        global _STATS_ON
+        with _STATS_LOCK:
+            if self in _ACTIVE_STATS:
+                _ACTIVE_STATS.remove(self)
+            _STATS_ON = bool(_ACTIVE_STATS)
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disable()
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+    def add_callback(self, func):
+        self.callbacks.append(func)
+
+    def record(self, op, dtype, shard, nbytes, seconds):
+        key = (op, dtype, shard)
+        with self._lock:
+            counter = self._data.get(key)
+            if counter is None:
+                counter = self._data[key] = [0, 0, 0.0]
+            counter[0] += 1
+            counter[1] += nbytes
+            counter[2] += seconds
+        for callback in self.callbacks:
+            callback(op, dtype, shard, nbytes, seconds)
+
+    def counters(self, by=('op', 'dtype', 'shard')):
+        """ Get aggregated counters
+
+        Args:
+            by (Tuple[str]): fields to group by,
+                any of 'op', 'dtype' and 'shard'
+
+        Returns:
+            Dict[tuple, dict]: {(field values): {'count', 'bytes', 'time'}}
+        """
+        positions = [self._fields.index(field) for field in by]
+        res = {}
+        with self._lock:
+            for key, (count, nbytes, seconds) in self._data.items():
+                group = tuple(key[i] for i in positions)
+                total = res.get(group)
+                if total is None:
+                    total = res[group] = {'count': 0, 'bytes': 0, 'time': 0.0}
+                total['count'] += count
+                total['bytes'] += nbytes
+                total['time'] += seconds
+        return res
+
+    def __repr__(self):
+        return '<Stats: %d events>' % sum(
+            counter[0] for counter in self._data.values())
+
+
+STATS = Stats()
+
+
+def stats():
+    """ Get the global `Stats` collector; it records events only after
+    `.enable()` or within a `with` block """
+    return STATS
+
+
+cdef _track(str op, dtype, shard, Py_ssize_t nbytes, double start):
+    cdef double seconds = _clock() - start
+    for collector in list(_ACTIVE_STATS):
+        collector.record(op, dtype, shard, nbytes, seconds)
+
+
 cdef unber(bytes buf):
     r""" Perl BER unpacking.
     BER is a way to pack several variable-length ints into one
@@ -314,6 +678,31 @@ cdef unber(bytes buf):
     return res
 
 
+cdef extern from 'Python.h':
+    object PyBytes_FromStringAndSize(const char *s, Py_ssize_t len)
+
+
+cdef Py_ssize_t _lzf_header(const unsigned char *buf, Py_ssize_t csize,
+                            Py_ssize_t *usize) nogil:
+    """ Parse Compress::LZF header, see `lzf_length`.
+    Returns header length, or -1 if the header is corrupted """
+    cdef:
+        Py_ssize_t start = 1, i
+        uint8_t lower = buf[0], mask = 0x80
+
+    while mask and csize > start and (lower & mask):
+        mask >>= 1 + (mask == 0x80)
+        start += 1
+    if not mask or csize < start:
+        return -1
+    usize[0] = lower & (mask - 1)
+    for i in range(1, start):
+        usize[0] = (usize[0] << 6) + (buf[i] & 0x3f)
+    if not usize[0]:
+        return -1
+    return start
+
+
 cdef (int, int) lzf_length(bytes raw_data):
     # type: (bytes) -> (int, int)
     r""" Get length of uncompressed data from a header of Compress::LZF
@@ -341,45 +730,245 @@ cdef (int, int) lzf_length(bytes raw_data):
     (3, 2524)
     """
     # PY:725us, Cy:194usec
-    cdef:
-        # compressed size, header length, uncompressed size
-        uint32_t csize=len(raw_data), start=1, usize
-        # first byte, mask, buffer iterator placeholder
-        uint8_t lower=nth_byte(raw_data, 0), mask=0x80, b
-
-    while mask and csize > start and (lower & mask):
-        mask >>= 1 + (mask == 0x80)
-        start += 1
-    if not mask or csize < start:
-        raise ValueError('LZF compressed data header is corrupted')
-    usize = lower & (mask - 1)
-    for b in raw_data[1:start]:
-        usize = (usize << 6) + (b & 0x3f)
-    if not usize:
+    cdef Py_ssize_t usize = 0
+    cdef Py_ssize_t start = _lzf_header(
+        <const unsigned char *>PyBytes_AS_STRING(raw_data),
+        PyBytes_GET_SIZE(raw_data), &usize)
+    if start < 0:
         raise ValueError('LZF compressed data header is corrupted')
     return start, usize
 
 
-def decomp(bytes raw_data):
+cdef Py_ssize_t _lzf_decompress(const unsigned char *ip, Py_ssize_t in_len,
+                                unsigned char *op, Py_ssize_t out_len) nogil:
+    """ A port of lzf_decompress() from liblzf (lzf_d.c).
+    Returns the number of decompressed bytes, -1 if the output buffer is
+    too small (E2BIG) or -2 if the data is corrupted (EINVAL) """
+    cdef:
+        const unsigned char *in_end = ip + in_len
+        unsigned char *out_start = op
+        unsigned char *out_end = op + out_len
+        unsigned char *ref
+        Py_ssize_t ctrl, length
+
+    while ip < in_end:
+        ctrl = ip[0]
+        ip += 1
+        if ctrl < 32:  # literal run of ctrl + 1 bytes
+            ctrl += 1
+            if op + ctrl > out_end:
+                return -1
+            if ip + ctrl > in_end:
+                return -2
+            memcpy(op, ip, ctrl)
+            op += ctrl
+            ip += ctrl
+            continue
+        # back reference
+        length = ctrl >> 5
+        if length == 7:
+            if ip >= in_end:
+                return -2
+            length += ip[0]
+            ip += 1
+        if ip >= in_end:
+            return -2
+        length += 2
+        ctrl = ((ctrl & 0x1f) << 8) + ip[0] + 1
+        ip += 1
+        if op + length > out_end:
+            return -1
+        if ctrl > op - out_start:
+            return -2
+        ref = op - ctrl
+        if ctrl >= length:
+            memcpy(op, ref, length)
+            op += length
+        else:  # overlapping copy, i.e. a repeated pattern
+            while length:
+                op[0] = ref[0]
+                op += 1
+                ref += 1
+                length -= 1
+    return op - out_start
+
+
+# decompressing smaller values without the GIL isn't worth switching threads
+cdef Py_ssize_t _NOGIL_THRESHOLD = 4096
+
+
+cdef bytes _decomp(const unsigned char *buf, Py_ssize_t size,
+                   dtype=None, shard=None):
+    """ Decompress a Compress::LZF value from a raw buffer, see `decomp`.
+    `dtype` and `shard` label the recorded `Stats` event """
+    if not size:
+        return b''
+    cdef:
+        double started = _clock() if _STATS_ON else 0
+        Py_ssize_t start, usize = 0, length
+        unsigned char *out
+        bytes data
+    if buf[0] == 0:  # Compress::LZF stores incompressible data as is
+        data = PyBytes_FromStringAndSize(<const char *>buf + 1, size - 1)
+    else:
+        start = _lzf_header(buf, size, &usize)
+        if start < 0:
+            raise ValueError('LZF compressed data header is corrupted')
+        # it's fine to write into a bytes object nobody else has seen yet
+        data = PyBytes_FromStringAndSize(NULL, usize)
+        out = <unsigned char *>PyBytes_AS_STRING(data)
+        if usize < _NOGIL_THRESHOLD:
+            length = _lzf_decompress(buf + start, size - start, out, usize)
+        else:
+            with nogil:
+                length = _lzf_decompress(
+                    buf + start, size - start, out, usize)
+        if length == -2:
+            raise ValueError('LZF compressed data is corrupted')
+        if length == -1:  # python-lzf returns None if usize is too small
+            return None
+        if length != usize:  # Compress::LZF treats this as corruption
+            raise ValueError('LZF compressed data is corrupted')
+    if started:
+        _track('decomp', dtype, shard, len(data), started)
+    return data
+
+
+def decomp(raw_data):
     # type: (bytes) -> bytes
-    """ lzf wrapper to handle perl tweaks in Compress::LZF
+    """ LZF decompression, handling perl tweaks in Compress::LZF
     This function extracts uncompressed size header
     and then does usual lzf decompression.
 
+    Besides bytes, it accepts any object supporting the buffer protocol,
+    e.g. a memoryview of an mmap'ed .bin file, without copying it.
+    Large values are decompressed with the GIL released, so threads
+    decompressing blobs actually run in parallel.
+
     Args:
         raw_data (bytes): data compressed with Perl Compress::LZF
 
     Returns:
         str: unpacked data
     """
-    if not raw_data:
+    return _decomp_value(raw_data, None, None)
+
+
+cdef bytes _decomp_value(raw_data, dtype, shard):
+    """ `decomp` of a value read from `dtype` files """
+    if raw_data is None:
         return b''
-    if nth_byte(raw_data, 0) == 0:
-        return raw_data[1:]
-    start, usize = lzf_length(raw_data)
-    # while it is tempting to include liblzf and link statically, there is
-    # zero advantage comparing to just using python-lzf
-    return lzf.decompress(raw_data[start:], usize)
+    if PyBytes_CheckExact(raw_data):
+        return _decomp(<const unsigned char *>PyBytes_AS_STRING(raw_data),
+                       PyBytes_GET_SIZE(raw_data), dtype, shard)
+    cdef Py_buffer view
+    PyObject_GetBuffer(raw_data, &view, PyBUF_SIMPLE)
+    try:
+        return _decomp(<const unsigned char *>view.buf, view.len, dtype, shard)
+    finally:
+        PyBuffer_Release(&view)
+
+
+def decomp_many(values):
+    # type: (Iterable[Optional[bytes]]) -> List[Optional[bytes]]
+    """ Decompress many values at once, releasing the GIL only once.
+    Empty values are decompressed to `b''`, `None` stays `None`.
+
+    Args:
+        values (Iterable[Optional[bytes]]): values compressed with
+            Perl Compress::LZF, bytes or buffers (e.g. memoryviews)
+
+    Returns:
+        List[Optional[bytes]]: unpacked data in the same order
+
+    >>> decomp_many([b'\\x00abc', None, b''])
+    [b'abc', None, b'']
+    """
+    return _decomp_many(values, None, None)
+
+
+cdef list _decomp_many(values, dtype, shard):
+    """ `decomp_many` of values read from `dtype` files; shard is None if
+    they come from several shards """
+    cdef:
+        list res = []
+        list pending = []  # (index, view index, header length)
+        Py_ssize_t n, i, j, start, usize, total = 0
+        Py_ssize_t *lengths
+        const unsigned char **inputs
+        Py_ssize_t *in_lengths
+        unsigned char **outputs
+        Py_ssize_t *out_lengths
+        Py_buffer *views
+        Py_ssize_t nviews = 0, size
+        const unsigned char *buf
+        double started = _clock() if _STATS_ON else 0
+    values = list(values)
+    n = len(values)
+    views = <Py_buffer *>calloc(n or 1, sizeof(Py_buffer))
+    inputs = <const unsigned char **>calloc(n or 1, sizeof(char *))
+    in_lengths = <Py_ssize_t *>calloc(n or 1, sizeof(Py_ssize_t))
+    outputs = <unsigned char **>calloc(n or 1, sizeof(char *))
+    out_lengths = <Py_ssize_t *>calloc(n or 1, sizeof(Py_ssize_t))
+    lengths = <Py_ssize_t *>calloc(n or 1, sizeof(Py_ssize_t))
+    if (views == NULL or inputs == NULL or in_lengths == NULL
+            or outputs == NULL or out_lengths == NULL or lengths == NULL):
+        free(views); free(inputs); free(in_lengths)
+        free(outputs); free(out_lengths); free(lengths)
+        raise MemoryError
+    try:
+        # first pass: parse headers and allocate outputs, holding the GIL
+        for i, value in enumerate(values):
+            if value is None:
+                res.append(None)
+                continue
+            if not PyBytes_CheckExact(value):
+                PyObject_GetBuffer(value, &views[nviews], PyBUF_SIMPLE)
+                nviews += 1
+                buf = <const unsigned char *>views[nviews - 1].buf
+                size = views[nviews - 1].len
+            else:
+                buf = <const unsigned char *>PyBytes_AS_STRING(value)
+                size = PyBytes_GET_SIZE(value)
+            if not size:
+                res.append(b'')
+            elif buf[0] == 0:
+                res.append(PyBytes_FromStringAndSize(
+                    <const char *>buf + 1, size - 1))
+            else:
+                start = _lzf_header(buf, size, &usize)
+                if start < 0:
+                    raise ValueError('LZF compressed data header is corrupted')
+                data = PyBytes_FromStringAndSize(NULL, usize)
+                j = len(pending)
+                inputs[j] = buf + start
+                in_lengths[j] = size - start
+                outputs[j] = <unsigned char *>PyBytes_AS_STRING(data)
+                out_lengths[j] = usize
+                pending.append(i)
+                res.append(data)
+        # second pass: decompress everything without the GIL
+        n = len(pending)
+        with nogil:
+            for j in range(n):
+                lengths[j] = _lzf_decompress(
+                    inputs[j], in_lengths[j], outputs[j], out_lengths[j])
+        for j, i in enumerate(pending):
+            if lengths[j] == -1:
+                res[i] = None
+            elif lengths[j] != out_lengths[j]:  # incl. -2, i.e. corrupted
+                raise ValueError('LZF compressed data is corrupted')
+    finally:
+        for j in range(nviews):
+            PyBuffer_Release(&views[j])
+        free(views); free(inputs); free(in_lengths)
+        free(outputs); free(out_lengths); free(lengths)
+    if started:
+        for data in res:
+            if data:
+                total += len(data)
+        _track('decomp', dtype, shard, total, started)
+    return res
 
 
 cdef uint32_t fnvhash(bytes data):
@@ -418,6 +1007,464 @@ def slice20(bytes raw_data):
     return tuple(raw_data[i:i + 20] for i in range(0, len(raw_data), 20))
 
 
+class ShaArray(object):
+    """ Read-only array of binary SHAs, a compact alternative to `slice20()`.
+    It is a numpy 'S20' view over the raw relation value, so no per-SHA
+    objects are created until items are accessed. Requires numpy.
+
+        >>> shas = Project('user2589_minicms').commit_sha_array
+        >>> 'f2a7fcdc51450ab03cb364415f14e634fa69b62c' in shas
+        True
+        >>> len(shas & Author('...').commit_sha_array)  # doctest: +SKIP
+
+    Membership tests use binary search over a sorted copy, which is
+    made on the first check. Set operations return sorted arrays of
+    unique SHAs.
+
+    Attributes:
+        raw (bytes): concatenated binary SHAs
+        array (np.ndarray): 'S20' view of `raw`. Note that numpy strips
+            trailing null bytes when converting items back to bytes;
+            use indexing or iteration of this object instead.
+    """
+
+    def __init__(self, raw_data=None):
+        if np is None:
+            raise ImportError('ShaArray requires numpy')
+        self.raw = raw_data or b''
+        if len(self.raw) % 20:
+            raise ValueError('Raw data length is not a multiple of 20')
+        self.array = np.frombuffer(self.raw, 'S20')
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.array)
+        if not 0 <= i < len(self.array):
+            raise IndexError('ShaArray index out of range')
+        return self.raw[i * 20:i * 20 + 20]
+
+    def __iter__(self):
+        raw = self.raw
+        return (raw[i:i + 20] for i in range(0, len(raw), 20))
+
+    def __repr__(self):
+        return '<ShaArray: %d SHAs>' % len(self.array)
+
+    @property
+    def sorted(self):
+        """ Sorted 'S20' array, built on the first access """
+        if self._sorted is None:
+            self._sorted = np.sort(self.array)
+        return self._sorted
+
+    def __contains__(self, sha):
+        try:
+            key = GitObject._to_key(sha)
+        except ValueError:
+            return False
+        data = self.sorted
+        i = np.searchsorted(data, key)
+        return bool(i < len(data) and data[i] == key.rstrip(b'\x00'))
+
+    def isin(self, shas):
+        """ Vectorized membership: boolean array, True for SHAs of this
+        array which are also in `shas` """
+        return np.isin(self.array, _to_sha_array(shas).array)
+
+    def hex(self):
+        """ Hex SHAs, as a list of str """
+        hexed = binascii.hexlify(self.raw).decode('ascii')
+        return [hexed[i:i + 40] for i in range(0, len(hexed), 40)]
+
+    def intersection(self, other):
+        return ShaArray(np.intersect1d(
+            self.array, _to_sha_array(other).array).tobytes())
+
+    def union(self, other):
+        return ShaArray(np.union1d(
+            self.array, _to_sha_array(other).array).tobytes())
+
+    def difference(self, other):
+        return ShaArray(np.setdiff1d(
+            self.array, _to_sha_array(other).array).tobytes())
+
+    __and__ = intersection
+    __or__ = union
+    __sub__ = difference
+
+
+def _to_sha_array(shas):
+    """ Convert an iterable of SHAs or objects to a ShaArray """
+    if isinstance(shas, ShaArray):
+        return shas
+    return ShaArray(b''.join(GitObject._to_key(sha) for sha in shas))
+
+
+class LRUCache(object):
+    """ Thread-safe LRU cache, bounded by the total length of cached values
+
+    Args:
+        capacity (int): max total length of values, in bytes
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """ Get a cached value or `None` if it is not cached """
+        with self._lock:
+            try:
+                # pop and insert again to mark as recently used
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Cache a value, evicting least recently used values if needed """
+        size = len(value)
+        if size > self.capacity:
+            return
+        with self._lock:
+            old_value = self._data.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self._data[key] = value
+            self.size += size
+            while self.size > self.capacity:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Get cache counters
+
+        Returns:
+            Dict[str, int]: hits, misses, evictions, count of cached values,
+                their total size and the cache capacity
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'count': len(self._data),
+            'size': self.size,
+            'capacity': self.capacity,
+        }
+
+
+# process-wide cache of decompressed commits and trees, disabled by default
+OBJECT_CACHE = None  # type: LRUCache
+
+
+def cache_objects(capacity=256 * 1024 ** 2):
+    """ Enable process-wide cache of decompressed commits and trees.
+    Since trees are heavily shared between commits and forks, this saves
+    a lot of reads and decompression when walking project histories.
+
+        >>> cache = cache_objects(2 * 1024 ** 3)  # doctest: +SKIP
+        >>> cache.stats()  # doctest: +SKIP
+        {'hits': 0, 'misses': 0, 'evictions': 0, ...}
+
+    Args:
+        capacity (int): cache size in bytes of decompressed content.
+            0 disables caching.
+
+    Returns:
+        Optional[LRUCache]: the cache object, or None if it is disabled
+    """
+    global OBJECT_CACHE
+    OBJECT_CACHE = LRUCache(capacity) if capacity else None
+    return OBJECT_CACHE
+
+
+# Memos are stored as JSON, with bytes as hex strings. Unlike marshal or
+# pickle, it doesn't change between Python versions, and loading a file
+# from somebody else can't produce anything but plain values
+def _memo_default(value):
+    if isinstance(value, bytes):
+        return {'$bytes': binascii.hexlify(value).decode('ascii')}
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _memo_hook(obj):
+    if len(obj) == 1 and '$bytes' in obj:
+        return binascii.unhexlify(obj['$bytes'])
+    return obj
+
+
+def _memo_dumps(value):
+    return json.dumps(value, default=_memo_default, sort_keys=True,
+                      separators=(',', ':')).encode('utf8')
+
+
+def _memo_loads(data):
+    return json.loads(data.decode('utf8'), object_hook=_memo_hook)
+
+
+class MemoStore(object):
+    """ Persistent memo of values derived from the data, such as
+    `Project.head`, kept in a local SQLite database between runs.
+
+    Memos are keyed by the object, the property and versions of the data
+    types it depends on (see `memoized`), so that a newer dataset version
+    simply misses the old memos. Those are never accessed again and thus
+    are the first to go once stored values exceed `max_size`.
+    It is safe to share the file between threads and processes.
+
+        >>> memo = use_memo('/tmp/oscar_memo.db')  # doctest: +SKIP
+        >>> memo.stats()  # doctest: +SKIP
+        {'hits': 0, 'misses': 0, 'evictions': 0, ...}
+
+    Args:
+        path (str): path to the database file, created if doesn't exist
+        max_size (int): max total length of stored values, in bytes
+    """
+    # number of writes between size checks
+    check_every = 1024
+    # granularity of access times, to avoid a write on every hit
+    touch_interval = 3600
+
+    def __init__(self, path, max_size=1024 ** 3):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        # connections inherited from the parent process should neither be
+        # used nor closed in the child, so they are just kept referenced
+        self._inherited = []
+        self._connect()
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads or processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        if conn is not None:
+            self._inherited.append(conn)
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        # auto_vacuum only has effect before the table is created
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE IF NOT EXISTS memo ('
+                     'key BLOB PRIMARY KEY, value BLOB NOT NULL, '
+                     'accessed INTEGER NOT NULL)')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS memo_accessed ON memo (accessed)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def key(name, obj_key, versions):
+        """ Make a memo key for property `name` of the object `obj_key`.
+        oscar version is also a part of the key, since the way values are
+        derived might change between releases.
+        """
+        return hashlib.sha1(_memo_dumps(
+            (__version__, name, obj_key, versions))).digest()
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM memo').fetchone()[0]
+
+    @property
+    def size(self):
+        """ Total length of stored values, in bytes """
+        return self._connect().execute(
+            'SELECT COALESCE(SUM(LENGTH(value)), 0) FROM memo').fetchone()[0]
+
+    def get(self, key, default=None):
+        """ Get a stored value, or `default` if there is none """
+        conn = self._connect()
+        row = conn.execute('SELECT value, accessed FROM memo WHERE key = ?',
+                           (sqlite3.Binary(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        now = int(time.time())
+        if now - row[1] > self.touch_interval:
+            conn.execute('UPDATE memo SET accessed = ? WHERE key = ?',
+                         (now, sqlite3.Binary(key)))
+        return _memo_loads(bytes(row[0]))
+
+    def put(self, key, value):
+        """ Store a value, removing least recently used ones if needed.
+        Values have to be made of JSON types and bytes; others are silently
+        skipped. Tuples are loaded back as lists.
+        """
+        try:
+            data = _memo_dumps(value)
+        except (TypeError, ValueError):
+            return
+        if len(data) > self.max_size:
+            return
+        self._connect().execute(
+            'INSERT OR REPLACE INTO memo VALUES (?, ?, ?)',
+            (sqlite3.Binary(key), sqlite3.Binary(data), int(time.time())))
+        self._writes += 1
+        if not self._writes % self.check_every and self.size > self.max_size:
+            self.compact()
+
+    def compact(self):
+        """ Remove least recently used values to fit into 90% of `max_size`,
+        and release free space to the file system.
+
+        Returns:
+            int: total length of the remaining values, in bytes
+        """
+        conn = self._connect()
+        size = self.size
+        target = self.max_size * 9 // 10 if size > self.max_size else size
+        while size > target:
+            rows = conn.execute('SELECT key, LENGTH(value) FROM memo '
+                                'ORDER BY accessed LIMIT 1024').fetchall()
+            if not rows:
+                break
+            removed = []
+            for key, length in rows:
+                removed.append((key,))
+                size -= length
+                if size <= target:
+                    break
+            conn.executemany('DELETE FROM memo WHERE key = ?', removed)
+            self.evictions += len(removed)
+        # every step frees one page, so results have to be consumed
+        conn.execute('PRAGMA incremental_vacuum').fetchall()
+        return size
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute('DELETE FROM memo')
+        conn.execute('PRAGMA incremental_vacuum').fetchall()
+
+    def stats(self):
+        """ Get memo counters
+
+        Returns:
+            Dict[str, int]: hits, misses and evictions in this process,
+                count of stored values, their total size and the max size
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'count': len(self),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+
+# persistent memo of derived values, disabled by default
+MEMO = None  # type: MemoStore
+_MISSING = object()
+
+
+def use_memo(path, max_size=1024 ** 3):
+    """ Keep selected derived values, such as `Project.head`, in a
+    `MemoStore` at `path`. `None` or an empty path disables it.
+    It is enabled on import if OSCAR_MEMO is set.
+
+    Returns:
+        Optional[MemoStore]: the memo store, or None if it is disabled
+    """
+    global MEMO
+    MEMO = MemoStore(path, max_size) if path else None
+    return MEMO
+
+
+def _dtype_version(dtype):
+    try:
+        return VERSIONS[dtype]
+    except KeyError:  # not available in this environment
+        return None
+
+
+def memoized(dtypes, dump=None, load=None, iterator=False):
+    """ Keep results of a method in `MEMO`, if it is enabled.
+    Use it under `cached_property` or `property`.
+
+    Args:
+        dtypes (Tuple[str]): data types the result depends on. The memo
+            is only used while they have the same versions.
+        dump (callable): convert result (or, for iterators, every item)
+            to a value `MemoStore` can keep, e.g. a Commit to its binary sha.
+        load (callable): reverse of `dump`
+        iterator (bool): the method is a generator. Its items are only
+            stored if it is exhausted, so partial reads don't pollute memos.
+    """
+    def decorator(func):
+        def memo_key(self):
+            versions = tuple(_dtype_version(dtype) for dtype in dtypes)
+            return MEMO.key(
+                self.type + '.' + func.__name__, self.key, versions)
+
+        if iterator:
+            @wraps(func)
+            def wrapper(self):
+                memo = MEMO
+                if memo is None:
+                    for item in func(self):
+                        yield item
+                    return
+                key = memo_key(self)
+                items = memo.get(key, _MISSING)
+                if items is not _MISSING:
+                    for item in items:
+                        yield load(item) if load else item
+                    return
+                items = []
+                for item in func(self):
+                    items.append(dump(item) if dump else item)
+                    yield item
+                memo.put(key, items)
+            return wrapper
+
+        @wraps(func)
+        def wrapper(self):
+            memo = MEMO
+            if memo is None:
+                return func(self)
+            key = memo_key(self)
+            value = memo.get(key, _MISSING)
+            if value is not _MISSING:
+                return load(value) if load else value
+            value = func(self)
+            memo.put(key, dump(value) if dump else value)
+            return value
+        return wrapper
+    return decorator
+
+
+if os.environ.get('OSCAR_MEMO'):
+    use_memo(os.environ['OSCAR_MEMO'])
+
+
 class CommitTimezone(tzinfo):
     # TODO: replace with datetime.timezone once Py2 support is ended
     # a lightweight version of pytz._FixedOffset
@@ -482,111 +1529,1208 @@ def parse_commit_date(bytes timestamp, bytes tz):
 
     return dt
 
-cdef extern from 'Python.h':
-    object PyBytes_FromStringAndSize(char *s, Py_ssize_t len)
+# commit timezones are reused, since there are only few dozens of them
+cdef dict _TIMEZONES = {}  # type: Dict[int, CommitTimezone]
+
+
+def _commit_datetime(int64_t ts, int tz_minutes):
+    """ Same as parse_commit_date(), but from already parsed values """
+    if ts < 0 or ts > time.time():
+        return None
+    tz = _TIMEZONES.get(tz_minutes)
+    if tz is None:
+        tz = _TIMEZONES.setdefault(tz_minutes, CommitTimezone(0, tz_minutes))
+    return datetime.fromtimestamp(ts, tz)
+
+
+cdef inline bint _is_space(unsigned char c):
+    # same as bytes.strip(): space, \t, \n, \v, \f, \r
+    return c == 32 or 9 <= c <= 13
+
+
+cdef bint _parse_date(const unsigned char *buf, Py_ssize_t ts_start,
+                      Py_ssize_t ts_end, Py_ssize_t tz_end,
+                      int64_t *ts, int *tz_minutes):
+    """ Parse author/committer timestamp and timezone, e.g. `1337145807 +1100`.
+    Timezone starts at ts_end + 1.
+    Returns False if they are invalid, with the same rules as
+    parse_commit_date() """
+    cdef:
+        Py_ssize_t i, tz_start = ts_end + 1
+        int64_t value = 0
+        int sign = 1, hours, minutes
+    if ts_end <= ts_start or ts_end - ts_start > 10:
+        return False
+    for i in range(ts_start, ts_end):
+        if not 48 <= buf[i] <= 57:
+            return False
+        value = value * 10 + buf[i] - 48
+    if value > 0xFFFFFFFF:
+        return False
+    if value > _c_time(NULL):  # timestamp is in the future
+        return False
+    if tz_end - tz_start < 4:
+        return False
+    if buf[tz_start] == 45:  # -
+        sign = -1
+    for i in range(tz_end - 4, tz_end):
+        if not 48 <= buf[i] <= 57:
+            return False
+    hours = (buf[tz_end - 4] - 48) * 10 + buf[tz_end - 3] - 48
+    minutes = (buf[tz_end - 2] - 48) * 10 + buf[tz_end - 1] - 48
+    if tz_end - tz_start > 4 and (
+            buf[tz_end - 5] < 48 or buf[tz_end - 5] > 57):
+        # something like `+1100`, the most common case. Anything else, like
+        # `+01100` or `1100`, is left to the slow path
+        ts[0] = value
+        tz_minutes[0] = sign * (hours * 60 + minutes)
+        return True
+    return False
+
+
+cdef class CommitRecord:
+    """ Compact representation of a parsed commit.
+    Unlike `Commit`, it does not create any objects for the tree, parents or
+    dates; timestamps are kept as epoch ints and timezones as offsets in
+    minutes, so that bulk analytics can skip datetime conversion entirely.
+
+    Attributes:
+        tree_sha (bytes): binary SHA of the root tree
+        parent_shas (Tuple[bytes]): binary SHAs of parents
+        author (bytes), committer (bytes): Name <email>
+        authored_ts (int), committed_ts (int): unix timestamps,
+            -1 if invalid
+        author_tz (int), committer_tz (int): timezone offsets, in minutes
+        message (bytes): first line of the commit message
+        full_message (bytes): full commit message
+        signature (Optional[bytes]): PGP signature
+        encoding (Optional[str]): commit encoding, if specified
+    """
+    cdef readonly:
+        bytes header, tree_sha, author, committer
+        bytes message, full_message, signature
+        tuple parent_shas
+        object encoding
+        int64_t authored_ts, committed_ts
+        int author_tz, committer_tz
+
+    @property
+    def authored_at(self):
+        """ timezone-aware datetime or None (if invalid) """
+        return _commit_datetime(self.authored_ts, self.author_tz)
+
+    @property
+    def committed_at(self):
+        """ timezone-aware datetime or None (if invalid) """
+        return _commit_datetime(self.committed_ts, self.committer_tz)
+
+
+cdef bytes _PGP_END = b'-----END PGP SIGNATURE-----'
+
+
+cdef CommitRecord _parse_commit(bytes data, sha=None):
+    """ Parse a raw commit into a CommitRecord.
+    Fields come in this exact order:
+        tree, parent, author, committer, [gpgsig], [encoding]
+    """
+    cdef:
+        const unsigned char *buf
+        Py_ssize_t header_end, pos, eol, start, end, sp, sp2, key_len
+        CommitRecord rec = CommitRecord.__new__(CommitRecord)
+        list parent_shas = []
+        bint reading_signature = False
+        bint valid
+        bytes signature = None, value
+        int64_t ts
+        int tz
+    header_end = data.find(b'\n\n') if data else -1
+    if header_end < 0:  # Sometimes data == b''
+        raise ObjectNotFound()
+    buf = data
+    rec.header = data[:header_end]
+    rec.full_message = data[header_end + 2:]
+    rec.message = rec.full_message.split(b'\n', 1)[0]
+    rec.authored_ts = rec.committed_ts = -1
+
+    pos = 0
+    while pos <= header_end:
+        eol = pos
+        while eol < header_end and buf[eol] != 10:  # \n
+            eol += 1
+        start, end = pos, eol
+        pos = eol + 1
+        if reading_signature:
+            # examples:
+            #   1cc6f4418dcc09f64dcbb0410fec76ceaa5034ab
+            #   cbbc685c45bdff4da5ea0984f1dd3a73486b4556
+            signature += data[start:end]
+            while start < end and _is_space(buf[start]):
+                start += 1
+            while end > start and _is_space(buf[end - 1]):
+                end -= 1
+            if end - start == len(_PGP_END) and memcmp(
+                    buf + start, <const char *>_PGP_END, end - start) == 0:
+                rec.signature = signature
+                reading_signature = False
+            continue
+
+        if start < end and buf[start] == 32:
+            # mergetag object, not supported (yet?)
+            # example: c1313c68c7f784efaf700fbfb771065840fc260a
+            continue
+
+        while start < end and _is_space(buf[start]):
+            start += 1
+        while end > start and _is_space(buf[end - 1]):
+            end -= 1
+        if start == end:  # sometimes there is an empty line after gpgsig
+            continue
+
+        sp = start
+        while sp < end and buf[sp] != 32:
+            sp += 1
+        if sp == end:
+            raise ValueError('Unexpected header in commit %s' % (sha or ''))
+        key_len = sp - start
+        value = data[sp + 1:end]
+        if key_len == 4 and memcmp(buf + start, b'tree', 4) == 0:
+            # value is bytes holding hex values -> need to decode
+            rec.tree_sha = binascii.unhexlify(value)
+        elif key_len == 6 and memcmp(buf + start, b'parent', 6) == 0:
+            # multiple parents possible
+            parent_shas.append(binascii.unhexlify(value))
+        elif (key_len == 6 and memcmp(buf + start, b'author', 6) == 0) or (
+                key_len == 9 and memcmp(buf + start, b'committer', 9) == 0):
+            # author name can have arbitrary number of spaces while
+            # timestamp is guaranteed to have one, so search from the end
+            sp2 = end - 1
+            while sp2 > sp and buf[sp2] != 32:
+                sp2 -= 1
+            start = sp2 - 1
+            while start > sp and buf[start] != 32:
+                start -= 1
+            if start <= sp:
+                raise ValueError('Unexpected header in commit %s' % (sha or ''))
+            valid = _parse_date(buf, start + 1, sp2, end, &ts, &tz)
+            if not valid:
+                # slow path for unusual values
+                dt = parse_commit_date(data[start + 1:sp2], data[sp2 + 1:end])
+                if dt is not None:
+                    valid = True
+                    ts = int(data[start + 1:sp2])
+                    tz = dt.utcoffset().days * 1440 + dt.utcoffset().seconds // 60
+            if key_len == 6:  # author
+                rec.author = data[sp + 1:start]
+                if valid:
+                    rec.authored_ts, rec.author_tz = ts, tz
+            else:
+                rec.committer = data[sp + 1:start]
+                if valid:
+                    rec.committed_ts, rec.committer_tz = ts, tz
+        elif key_len == 6 and memcmp(buf + start, b'gpgsig', 6) == 0:
+            signature = value
+            reading_signature = True
+        elif key_len == 8 and memcmp(buf + start, b'encoding', 8) == 0:
+            rec.encoding = value.decode('ascii')
+    rec.parent_shas = tuple(parent_shas)
+    return rec
+
+
+cdef extern from 'tcutil.h':
+    ctypedef struct TCXSTR:  # extensible string
+        pass
+
+    bint tcpathunlock(const char *path)
+    TCXSTR *tcxstrnew()
+    void tcxstrdel(TCXSTR *xstr)
+    const void *tcxstrptr(const TCXSTR *xstr)
+    int tcxstrsize(const TCXSTR *xstr)
+
+
+cdef extern from '<pthread.h>' nogil:
+    ctypedef unsigned int pthread_key_t
+    int pthread_key_delete(pthread_key_t key)
 
 
 cdef extern from 'tchdb.h':
     ctypedef struct TCHDB:  # type of structure for a hash database
-        pass
+        void *mmtx  # mutex for method, set by tchdbsetmutex
+        void *eckey  # key for thread specific error code
+        char *rpath  # real path for locking
+        int fd  # file descriptor of the database file
+        uint64_t iter  # offset of the iterator
 
     cdef enum:  # enumeration for open modes
         HDBOREADER = 1 << 0,  # open as a reader
+        HDBOWRITER = 1 << 1,  # open as a writer
+        HDBOCREAT = 1 << 2,  # writer creating
         HDBONOLCK = 1 << 4,  # open without locking
 
+    cdef enum:  # error codes, from tcutil.h
+        TCENOREC = 22  # no record found
+
     const char *tchdberrmsg(int ecode)
     TCHDB *tchdbnew()
+    void tchdbdel(TCHDB *hdb)
     int tchdbecode(TCHDB *hdb)
+    bint tchdbsetmutex(TCHDB *hdb)
+    bint tchdbtune(TCHDB *hdb, int64_t bnum, int8_t apow, int8_t fpow,
+                   uint8_t opts)
     bint tchdbopen(TCHDB *hdb, const char *path, int omode)
     bint tchdbclose(TCHDB *hdb)
-    void *tchdbget(TCHDB *hdb, const void *kbuf, int ksiz, int *sp)
-    bint tchdbiterinit(TCHDB *hdb)
-    void *tchdbiternext(TCHDB *hdb, int *sp)
+    uint64_t tchdbrnum(TCHDB *hdb)
+    uint64_t tchdbfsiz(TCHDB *hdb)
+    bint tchdbput(TCHDB *hdb, const void *kbuf, int ksiz,
+                  const void *vbuf, int vsiz)
+    # reads and iteration are done with GIL released
+    void *tchdbget(TCHDB *hdb, const void *kbuf, int ksiz, int *sp) nogil
+    bint tchdbiterinit(TCHDB *hdb) nogil
+    void *tchdbiternext(TCHDB *hdb, int *sp) nogil
+    bint tchdbiternext3(TCHDB *hdb, TCXSTR *kxstr, TCXSTR *vxstr) nogil
 
 
 cdef class Hash:
-    """Object representing a Tokyocabinet Hash table"""
+    """Object representing a Tokyocabinet Hash table.
+    It is opened read-only, unless `writer=True` is passed; writers create
+    the file if it does not exist, e.g. to generate test fixtures.
+    `buckets` sets the size of the hash table of a new file.
+
+    Reads are done without GIL if `concurrent` is True, which is the case
+    unless the process ran out of pthread keys for tokyocabinet locks
+    (there are 1024 per process); reads of such handles hold the GIL.
+
+    Iterations of keys and items can run on the same handle at once, e.g.
+    a pooled one used by several threads; each has its own position.
+    """
     cdef TCHDB* _db
     cdef bytes filename
-
-    def __cinit__(self, char *path, nolock=True):
-        cdef int mode = HDBOREADER
+    cdef bint opened
+    cdef readonly bint concurrent
+    # tokyocabinet has one iterator per database; it is shared by all
+    # iterations, which save and restore its position under this lock
+    cdef object _iter_lock
+
+    def __cinit__(self, char *path, nolock=True, writer=False, buckets=0):
+        cdef int mode = HDBOWRITER | HDBOCREAT if writer else HDBOREADER
         if nolock:
             mode |= HDBONOLCK
         self._db = tchdbnew()
         self.filename = path
+        self._iter_lock = Lock()
         if self._db is NULL:
             raise MemoryError()
+        # inherited handles hold pthread keys and path locks of this file
+        TCH_POOL._check_fork()
+        # reads are done without GIL, so concurrent access from multiple
+        # threads has to be guarded by tokyocabinet's own rwlock.
+        # Every lock takes a pthread key, which are limited to 1024 per
+        # process; without a lock, reads just keep the GIL
+        self.concurrent = tchdbsetmutex(self._db)
+        if not self.concurrent:
+            warnings.warn('Failed to create a lock for .tch files, reads of '
+                          'some of them will hold the GIL: ' + self._error(),
+                          RuntimeWarning)
+        # number of hash buckets of a new database; tokyocabinet default
+        # is 131071, i.e. ~1Mb per file even if it is almost empty
+        if buckets and not tchdbtune(self._db, buckets, -1, -1, 0):
+            raise IOError('Failed to tune .tch file "%s": '
+                          % self.filename + self._error())
         cdef bint result = tchdbopen(self._db, path, mode)
         if not result:
             raise IOError('Failed to open .tch file "%s": ' % self.filename
                           + self._error())
+        self.opened = True
 
     def _error(self):
         cdef int code = tchdbecode(self._db)
         cdef bytes msg = tchdberrmsg(code)
         return msg.decode('ascii')
 
-    def __iter__(self):
-        cdef:
-            bint result = tchdbiterinit(self._db)
+    cdef uint64_t _iter_init(self) except 0:
+        """ Start an iteration; returns position of the first record """
+        cdef bint result
+        with self._iter_lock:
+            if self._db is NULL:
+                raise IOError('.tch file "%s" is detached' % self.filename)
+            if self.concurrent:
+                with nogil:
+                    result = tchdbiterinit(self._db)
+            else:
+                result = tchdbiterinit(self._db)
+            if not result:
+                raise IOError('Failed to iterate .tch file "%s": '
+                              % self.filename + self._error())
+            return self._db.iter
+
+    cdef char *_iter_next(self, uint64_t *pos, int *sp) except? NULL:
+        """ Read the key at `pos` and advance it; NULL at the end """
+        cdef char *buf
+        with self._iter_lock:
+            if self._db is NULL:
+                raise IOError('.tch file "%s" is detached' % self.filename)
+            self._db.iter = pos[0]
+            if self.concurrent:
+                with nogil:
+                    buf = <char *>tchdbiternext(self._db, sp)
+            else:
+                buf = <char *>tchdbiternext(self._db, sp)
+            pos[0] = self._db.iter
+        return buf
+
+    cdef bint _iter_next3(self, uint64_t *pos, TCXSTR *kxstr,
+                          TCXSTR *vxstr) except -1:
+        """ Read the record at `pos` and advance it; False at the end """
+        cdef bint result
+        with self._iter_lock:
+            if self._db is NULL:
+                raise IOError('.tch file "%s" is detached' % self.filename)
+            self._db.iter = pos[0]
+            if self.concurrent:
+                with nogil:
+                    result = tchdbiternext3(self._db, kxstr, vxstr)
+            else:
+                result = tchdbiternext3(self._db, kxstr, vxstr)
+            pos[0] = self._db.iter
+        return result
+
+    def __iter__(self):
+        cdef:
             char *buf
             int sp
             bytes key
-        if not result:
-            raise IOError('Failed to iterate .tch file "%s": ' % self.filename
-                          + self._error())
+            uint64_t pos = self._iter_init()
         while True:
-            buf = <char *>tchdbiternext(self._db, &sp)
+            buf = self._iter_next(&pos, &sp)
             if buf is NULL:
                 break
             key = PyBytes_FromStringAndSize(buf, sp)
             free(buf)
             yield key
 
-    cdef bytes read(self, bytes key):
+    def items(self, uint64_t readahead=SCAN_READAHEAD):
+        """ Iterate (key, value) pairs in the order of records in the file.
+        Unlike iterating keys and reading their values, it reads every record
+        once, sequentially, so dumping a whole relation is a single scan.
+
+        Args:
+            readahead (int): how many bytes ahead of the current record the
+                kernel is asked to prefetch; 0 to leave it to the kernel
+
+        Yields:
+            Tuple[bytes, bytes]: raw keys and values
+        """
+        cdef:
+            uint64_t prefetched = 0
+            uint64_t pos = self._iter_init()
+            int fd = self._db.fd
+            TCXSTR *kxstr
+            TCXSTR *vxstr
+        posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        kxstr = tcxstrnew()
+        vxstr = tcxstrnew()
+        try:
+            while True:
+                # request the next chunk when a half of the previous is read
+                if readahead and pos + readahead // 2 >= prefetched:
+                    posix_fadvise(fd, pos, readahead, POSIX_FADV_WILLNEED)
+                    prefetched = pos + readahead
+                if not self._iter_next3(&pos, kxstr, vxstr):
+                    break
+                yield (PyBytes_FromStringAndSize(
+                           <const char *>tcxstrptr(kxstr), tcxstrsize(kxstr)),
+                       PyBytes_FromStringAndSize(
+                           <const char *>tcxstrptr(vxstr), tcxstrsize(vxstr)))
+        finally:
+            tcxstrdel(kxstr)
+            tcxstrdel(vxstr)
+
+    cdef char *_get(self, char *k, int ksize, int *sp) except? NULL:
+        cdef char *buf
+        if self._db is NULL:
+            raise IOError('.tch file "%s" is detached' % self.filename)
+        if not self.concurrent:
+            buf = <char *>tchdbget(self._db, k, ksize, sp)
+        else:
+            with nogil:
+                buf = <char *>tchdbget(self._db, k, ksize, sp)
+        # NULL is returned both for missing keys and I/O errors, e.g. if
+        # the storage host went away. The latter have to fail loudly,
+        # so that reads can fail over to a replica
+        if buf is NULL and tchdbecode(self._db) != TCENOREC:
+            raise IOError('Failed to read .tch file "%s": ' % self.filename
+                          + self._error())
+        return buf
+
+    cdef bytes read(self, bytes key, dtype=None, shard=None):
+        # dtype and shard label the recorded Stats event
         cdef:
             char *k = key
             char *buf
             int sp
             int ksize=len(key)
-        buf = <char *>tchdbget(self._db, k, ksize, &sp)
+            double start = _clock() if _STATS_ON else 0
+        buf = self._get(k, ksize, &sp)
         if buf is NULL:
+            if start:
+                _track('hash_read', dtype, shard, 0, start)
             raise ObjectNotFound()
         cdef bytes value = PyBytes_FromStringAndSize(buf, sp)
         free(buf)
+        if start:
+            _track('hash_read', dtype, shard, sp, start)
         return value
 
     def __getitem__(self, bytes key):
         return self.read(key)
 
-    def __del__(self):
+    def get_many(self, keys, dtype=None, shard=None):
+        """ Read values of several keys in one call.
+        Unlike `.read()`, missing keys do not raise ObjectNotFound.
+
+        Args:
+            keys (Iterable[bytes]): keys to read
+            dtype (str), shard (int): labels of the recorded `Stats` event
+
+        Returns:
+            List[Optional[bytes]]: values in the same order as keys,
+                `None` for missing keys
+        """
+        cdef:
+            list res = []
+            bytes key
+            char *k
+            char *buf
+            int sp, ksize
+            Py_ssize_t nbytes = 0
+            double start = _clock() if _STATS_ON else 0
+        for key in keys:
+            k = key
+            ksize = len(key)
+            buf = self._get(k, ksize, &sp)
+            if buf is NULL:
+                res.append(None)
+                continue
+            res.append(PyBytes_FromStringAndSize(buf, sp))
+            free(buf)
+            nbytes += sp
+        if start:
+            _track('hash_read', dtype, shard, nbytes, start)
+        return res
+
+    def put(self, bytes key, bytes value):
+        """ Store a value; the database has to be opened with `writer=True`
+        """
+        if self._db is NULL:
+            raise IOError('.tch file "%s" is detached' % self.filename)
+        cdef bint result = tchdbput(self._db, <char *>key, len(key),
+                                    <char *>value, len(value))
+        if not result:
+            raise IOError('Failed to write to .tch file "%s": '
+                          % self.filename + self._error())
+
+    def __setitem__(self, bytes key, bytes value):
+        self.put(key, value)
+
+    def __len__(self):
+        """ Number of records """
+        if self._db is NULL:
+            raise IOError('.tch file "%s" is detached' % self.filename)
+        return tchdbrnum(self._db)
+
+    @property
+    def file_size(self):
+        if self._db is NULL:
+            raise IOError('.tch file "%s" is detached' % self.filename)
+        return tchdbfsiz(self._db)
+
+    def close(self):
+        """ Close the database, flushing writes to disk """
+        if not self.opened:
+            return
+        self.opened = False
         cdef bint result = tchdbclose(self._db)
         if not result:
             raise IOError('Failed to close .tch "%s": ' % self.filename
                           + self._error())
 
+    def _detach(self):
+        """ Drop a database inherited from the parent process.
+        Its locks might be held by parent threads that don't exist in this
+        process, so unlike `.close()`, it only closes the file descriptor.
+        """
+        if self._db is NULL:
+            return
+        if self.opened:
+            _close_fd(self._db.fd)
+            # let this process open the file again
+            tcpathunlock(self._db.rpath)
+        self.opened = False
+        # the structure is leaked: freeing it would destroy the locks.
+        # The pthread key is released though; it takes no lock, and
+        # otherwise new handles in this process might run out of keys
+        if self._db.mmtx is not NULL:
+            pthread_key_delete((<pthread_key_t *>self._db.eckey)[0])
+        self._db = NULL
+
+    def __del__(self):
+        self.close()
+
     def __dealloc__(self):
-        free(self._db)
+        # also releases the lock and its pthread key
+        if self._db is not NULL:
+            tchdbdel(self._db)
+
+
+def _max_open_tch():
+    """ Default capacity of `HandlePool`: a half of the descriptor limit """
+    if os.environ.get('OSCAR_MAX_OPEN_TCH'):
+        return int(os.environ['OSCAR_MAX_OPEN_TCH'])
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if limit == resource.RLIM_INFINITY:
+            limit = 8192
+    except (ImportError, ValueError):
+        limit = 1024
+    # tokyocabinet locks take a pthread key, and there are only 1024 of them
+    return max(16, min(limit // 2, 1000))
+
+
+class HandlePool(object):
+    """ Pool of open TokyoCabinet databases, to save few milliseconds on
+    opening a .tch file on every read.
+
+    The number of open handles is bounded by `capacity`, by default a half
+    of the descriptor limit (`ulimit -n`) or `OSCAR_MAX_OPEN_TCH`; least
+    recently used handles are evicted and closed as soon as threads still
+    reading from them are done. Hits take no locks.
+
+    TokyoCabinet handles keep state, such as locks, which can't be shared
+    with forked processes (e.g. `multiprocessing` workers). Children start
+    with an empty pool, release pthread keys of inherited handles and open
+    files again on demand.
+
+    To avoid latency of opening files on the first reads, e.g. in a
+    long-running service, open them in advance:
+
+        >>> TCH_POOL.warmup(['commit_random', 'blob_offset'])  # doctest: +SKIP
+    """
+    def __init__(self, capacity=None):
+        self.capacity = capacity or _max_open_tch()
+        self.opened = 0
+        self.evictions = 0
+        self._handles = OrderedDict()  # type: Dict[bytes, Hash]
+        self._lock = Lock()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        self._check_fork()
+        return len(self._handles)
+
+    def __contains__(self, path):
+        self._check_fork()
+        return path in self._handles
+
+    def _check_fork(self):
+        # without os.register_at_fork (Python < 3.7), forks are only
+        # noticed when the pool or a new Hash is used in the child
+        if not _AT_FORK and self._pid != os.getpid():
+            self._after_fork()
+
+    def get(self, bytes path):
+        """ Get an open database, opening it if necessary """
+        self._check_fork()
+        handle = self._handles.get(path)
+        if handle is not None:
+            try:  # C implementation of OrderedDict makes it atomic
+                self._handles.move_to_end(path)
+            except KeyError:  # evicted by another thread; it still works
+                pass
+            return handle
+        with self._lock:
+            handle = self._handles.get(path)
+            if handle is None:
+                handle = Hash(path)
+                self._handles[path] = handle
+                self.opened += 1
+                while len(self._handles) > self.capacity:
+                    self._handles.popitem(last=False)
+                    self.evictions += 1
+        return handle
+
+    def warmup(self, dtypes, shards=None):
+        """ Open all shards of the given data types in advance.
+        If there are replicas, only the preferred one is opened.
+
+        Args:
+            dtypes (Iterable[str]): data types, e.g. 'commit_random'
+            shards (Iterable[int]): only open these shards
+
+        Returns:
+            int: number of open handles
+        """
+        for dtype in dtypes:
+            _, locations, paths = PATHS.routes(dtype)
+            for shard in (range(len(paths)) if shards is None else shards):
+                self.get(paths[shard][ROUTER.best(locations)])
+        return len(self._handles)
 
+    def clear(self):
+        """ Forget all handles; they are closed once not in use """
+        with self._lock:
+            self._handles.clear()
+        _clear_bins()
 
-# Pool of open TokyoCabinet databases to save few milliseconds on opening
-cdef dict _TCH_POOL = {}  # type: Dict[str, Hash]
-TCH_LOCK = Lock()
+    def stats(self):
+        """ Get pool counters
+
+        Returns:
+            Dict[str, int]: number of files opened and evicted, currently
+                open files and the pool capacity
+        """
+        return {
+            'opened': self.opened,
+            'evictions': self.evictions,
+            'count': len(self._handles),
+            'capacity': self.capacity,
+        }
+
+    def _before_fork(self):
+        # no file is being opened while forking
+        self._lock.acquire()
+
+    def _after_fork_parent(self):
+        self._lock.release()
+
+    def _after_fork(self):
+        for handle in self._handles.values():
+            handle._detach()
+        self._handles = OrderedDict()
+        self._lock = Lock()
+        self._pid = os.getpid()
+        global _BIN_POOL, BIN_LOCK
+        # BIN_LOCK might have been held by another thread of the parent
+        _BIN_POOL = {}
+        BIN_LOCK = Lock()
+
+
+TCH_POOL = HandlePool()
+_AT_FORK = hasattr(os, 'register_at_fork')  # Python 3.7+
+if _AT_FORK:
+    os.register_at_fork(before=TCH_POOL._before_fork,
+                        after_in_parent=TCH_POOL._after_fork_parent,
+                        after_in_child=TCH_POOL._after_fork)
+
+
+def _get_tch(bytes path):
+    """ Get an open Hash() from the pool """
+    return TCH_POOL.get(path)
+
+
+cdef inline uint64_t _fnv64(const unsigned char *buf, Py_ssize_t size) nogil:
+    """ 64-bit FNV-1a hash """
+    cdef:
+        uint64_t h = 0xcbf29ce484222325ULL
+        Py_ssize_t i
+    for i in range(size):
+        h = (h ^ buf[i]) * 0x100000001b3ULL
+    return h
 
-def _get_tch(char *path):
-    """ Cache Hash() objects """
-    if path in _TCH_POOL:
-        return _TCH_POOL[path]
+
+cdef inline uint64_t _mix64(uint64_t x) nogil:
+    """ splitmix64 finalizer, to derive the second hash from the first """
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL
+    return x ^ (x >> 31)
+
+
+_BLOOM_MAGIC = b'OSCARBF1'
+# magic, number of bits, number of hashes, number of keys, .tch file size
+_BLOOM_HEADER = struct.Struct('<8sQQQQ')
+
+
+cdef class BloomFilter:
+    """ A Bloom filter of keys of a .tch file, to skip disk reads of keys
+    that are not there, e.g. commits referenced by relations but missing
+    from `commit_random`.
+
+    Filters are built offline with `build_filters()` and are stored next
+    to .tch files, as `<name>.tch.bloom`, or in `OSCAR_FILTERS_DIR` if the
+    data directories are read-only. Lookups use a filter automatically
+    if it exists and matches the number of records and the size of the
+    .tch file; otherwise, e.g. after a new version of the data was
+    released, the filter is ignored with a warning until it is rebuilt.
+
+        >>> bloom = BloomFilter(1000, error_rate=0.01)
+        >>> bloom.add(b'key')
+        >>> b'key' in bloom, b'missing' in bloom
+        (True, False)
+    """
+    cdef readonly uint64_t bits, hashes, count, source_size
+    cdef object _data
+    cdef Py_buffer _view
+    cdef bint _attached, _writable
+    cdef unsigned char *_buf
+
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError('Invalid error rate: %s' % error_rate)
+        capacity = max(capacity, 1)
+        bits = int(-capacity * log(error_rate) / log(2) ** 2)
+        bits = max(64, (bits + 63) // 64 * 64)
+        hashes = max(1, int(round(bits * log(2) / capacity)))
+        self._attach(bytearray(bits // 8), True, bits, hashes, 0, 0)
+
+    cdef _attach(self, data, bint writable, uint64_t bits, uint64_t hashes,
+                 uint64_t count, uint64_t source_size):
+        PyObject_GetBuffer(
+            data, &self._view, PyBUF_WRITABLE if writable else PyBUF_SIMPLE)
+        self._attached = True
+        self._data = data
+        self._writable = writable
+        self._buf = <unsigned char *>self._view.buf
+        self.bits = bits
+        self.hashes = hashes
+        self.count = count
+        self.source_size = source_size
+
+    def __dealloc__(self):
+        if self._attached:
+            PyBuffer_Release(&self._view)
+
+    cdef bint _contains(self, const unsigned char *key, Py_ssize_t size,
+                        bint add) nogil:
+        cdef:
+            uint64_t h = _fnv64(key, size)
+            uint64_t step = _mix64(h) | 1
+            uint64_t i, bit
+            bint found = True
+        for i in range(self.hashes):
+            bit = (h + i * step) % self.bits
+            if not self._buf[bit >> 3] & (1 << (bit & 7)):
+                if not add:
+                    return False
+                found = False
+                self._buf[bit >> 3] |= 1 << (bit & 7)
+        return found
+
+    def add(self, bytes key):
+        """ Add a key to the filter; keys are assumed to be unique """
+        if not self._writable:
+            raise TypeError('Filters loaded from disk are read-only')
+        self._contains(<const unsigned char *>PyBytes_AS_STRING(key),
+                       PyBytes_GET_SIZE(key), True)
+        self.count += 1
+
+    def __contains__(self, bytes key):
+        return self._contains(<const unsigned char *>PyBytes_AS_STRING(key),
+                              PyBytes_GET_SIZE(key), False)
+
+    def dump(self, path, source_size=0):
+        """ Save the filter to a file.
+        `source_size` is the size of the .tch file it was built from """
+        self.source_size = source_size
+        # write and rename to avoid partial reads by other processes
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            fh.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, self.bits, self.hashes,
+                                        self.count, source_size))
+            fh.write(self._data)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """ Load a filter saved with `.dump()`. The file is memory mapped,
+        so that processes on the same host share it """
+        with open(path, 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) < _BLOOM_HEADER.size:
+            raise ValueError('Not a key filter: %s' % path)
+        magic, bits, hashes, count, source_size = _BLOOM_HEADER.unpack(
+            data[:_BLOOM_HEADER.size])
+        if magic != _BLOOM_MAGIC or not bits or \
+                len(data) != _BLOOM_HEADER.size + bits // 8:
+            raise ValueError('Not a key filter or truncated: %s' % path)
+        cdef BloomFilter bloom = BloomFilter.__new__(BloomFilter)
+        bloom._attach(memoryview(data)[_BLOOM_HEADER.size:], False,
+                      bits, hashes, count, source_size)
+        return bloom
+
+
+# Pool of key filters of .tch files, `None` if there is no (valid) filter
+cdef dict _FILTER_POOL = {}  # type: Dict[bytes, Optional[BloomFilter]]
+FILTERS_DIR = os.environ.get('OSCAR_FILTERS_DIR')
+
+
+def _filter_path(path):
+    """ Location of the key filter of a .tch file """
+    if isinstance(path, bytes):
+        path = path.decode('ascii')
+    if FILTERS_DIR:
+        return os.path.join(FILTERS_DIR, os.path.basename(path) + '.bloom')
+    return path + '.bloom'
+
+
+cdef _get_filter(bytes path, Hash db):
+    if path in _FILTER_POOL:
+        return _FILTER_POOL[path]
+    bloom = None
+    filter_path = _filter_path(path)
+    if os.path.exists(filter_path):
+        try:
+            bloom = BloomFilter.load(filter_path)
+        except (IOError, OSError, ValueError) as e:
+            warnings.warn('Ignoring broken key filter %s: %s' % (
+                filter_path, e))
+        else:
+            if bloom.count != len(db) or bloom.source_size != db.file_size:
+                warnings.warn('Key filter %s is outdated, ignoring it. Please '
+                              'rebuild it with build_filters()' % filter_path)
+                bloom = None
+    _FILTER_POOL[path] = bloom
+    return bloom
+
+
+def build_filter(path, error_rate=0.01):
+    """ Build the key filter of a single .tch file, see `build_filters()`
+
+    Returns:
+        int: number of keys
+    """
+    if not isinstance(path, bytes):
+        path = path.encode('ascii')
+    cdef Hash db = _get_tch(path)
+    bloom = BloomFilter(len(db), error_rate)
+    for key in db:
+        bloom.add(key)
+    bloom.dump(_filter_path(path), db.file_size)
+    _FILTER_POOL.pop(path, None)
+    return bloom.count
+
+
+def _build_filter(task):
+    """ Process pool worker for `build_filters()` """
+    shard, path, error_rate = task
+    return shard, path, build_filter(path, error_rate)
+
+
+def build_filters(dtype, shards=None, error_rate=0.01, processes=None):
+    """ Build (or refresh, after a new version of the data is released)
+    key filters of all shards of a data type, see `BloomFilter`.
+    Filters are built for all replicas, unless they are stored in the
+    shared `OSCAR_FILTERS_DIR`:
+
+        >>> for shard, keys in build_filters('commit_random', processes=16):
+        ...     print(shard, keys)  # doctest: +SKIP
+
+    At 1% false positive rate, filters take ~1.2 bytes per key.
+
+    Args:
+        dtype (str): data type, e.g. 'commit_random'
+        shards (Iterable[int]): only build filters for these shards
+        error_rate (float): false positive rate
+        processes (int): number of processes, defaults to the number of CPUs
+
+    Yields:
+        Tuple[int, int]: (shard, number of keys)
+    """
+    _, _, paths = PATHS.routes(dtype)
+    tasks = []
+    filter_paths = set()
+    for shard in (range(len(paths)) if shards is None else shards):
+        for path in paths[shard]:
+            if _filter_path(path) not in filter_paths:
+                filter_paths.add(_filter_path(path))
+                tasks.append((shard, path, error_rate))
+    pool = multiprocessing.Pool(processes)
     try:
-        TCH_LOCK.acquire()
-        # in multithreading environment this can cause race condition,
-        # so we need a lock
-        if path not in _TCH_POOL:
-            _TCH_POOL[path] = Hash(path)
+        for shard, path, count in pool.imap_unordered(_build_filter, tasks):
+            _FILTER_POOL.pop(path, None)
+            yield shard, count
     finally:
-        TCH_LOCK.release()
-    return _TCH_POOL[path]
+        pool.terminate()
+
+
+# Pool of memory mapped blob content files (.bin), to avoid open/close
+# syscalls on every blob read. Maps are read-only, so they are thread-safe
+cdef dict _BIN_POOL = {}  # type: Dict[str, mmap.mmap]
+BIN_LOCK = Lock()
+
+def _get_bin(path, size=0):
+    """ Cache read-only memory maps of .bin files
+
+    Args:
+        path (str): path to the .bin file
+        size (int): minimum size of the mapping. A cached mapping shorter
+            than this is stale, i.e. the file was regenerated, and is
+            mapped again.
+    """
+    bin_map = _BIN_POOL.get(path)
+    if bin_map is not None and len(bin_map) >= size:
+        return bin_map
+    with BIN_LOCK:
+        bin_map = _BIN_POOL.get(path)
+        if bin_map is None or len(bin_map) < size:
+            with open(path, 'rb') as fh:
+                try:
+                    bin_map = mmap.mmap(
+                        fh.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # empty files can't be mapped; treat them as missing
+                    # so that _route() fails over to the next replica
+                    raise IOError('Empty .bin file: %s' % path)
+            _BIN_POOL[path] = bin_map
+    return bin_map
+
+
+def _clear_bins():
+    """ Forget cached .bin mappings, closing those not in use """
+    global _BIN_POOL
+    with BIN_LOCK:
+        bins, _BIN_POOL = _BIN_POOL, {}
+    for bin_map in bins.values():
+        try:
+            bin_map.close()
+        except BufferError:
+            # blob data is still referenced; the mapping is closed
+            # once the last memoryview is gone
+            pass
+
+
+class ReplicaRouter(object):
+    """ Choose which replica of a shard to read, see `PathRegistry`.
+
+    Reads go to the replica with the lowest observed latency (exponential
+    moving average). Every `probe_every`th read goes to another replica,
+    so that a host that got faster is noticed. Replicas failing with
+    IOError are skipped for `cooldown` seconds; the read is retried on the
+    next best replica, without restarting the process.
+
+    Replicas are identified by location (data directory), so that a slow
+    host is avoided for all data types stored there.
+
+        >>> ROUTER.status()  # doctest: +SKIP
+        {'/da4_fast/All.sha1c': {'latency': 0.0002, 'down': False}, ...}
+    """
+    def __init__(self, cooldown=60.0, probe_every=128, smoothing=0.2):
+        self.cooldown = cooldown
+        self.probe_every = probe_every
+        self.smoothing = smoothing
+        self._latency = {}  # type: Dict[str, float]
+        # location -> time.time() when to try it again
+        self._down = {}  # type: Dict[str, float]
+        self._reads = 0
+        # reads come from thread pools and lookup server workers
+        self._lock = Lock()
+
+    def _rank(self, locations):
+        """ Indexes of healthy locations by latency, and of the ones that
+        are down by the time they will be tried again. The lock is held """
+        latency = self._latency
+        healthy = []
+        down = []
+        now = time.time() if self._down else 0
+        for i, location in enumerate(locations):
+            if self._down.get(location, 0) > now:
+                down.append(i)
+            else:
+                healthy.append(i)
+        # replicas never read have zero latency, so all are tried early on
+        healthy.sort(key=lambda i: latency.get(locations[i], 0.0))
+        down.sort(key=lambda i: self._down[locations[i]])
+        return healthy, down
+
+    def order(self, locations):
+        """ Indexes of locations in the order to try them, best first.
+        It counts as a read, so it might put a probe first """
+        with self._lock:
+            healthy, down = self._rank(locations)
+            self._reads += 1
+            reads = self._reads
+        if len(healthy) > 1 and not reads % self.probe_every:
+            probe = healthy.pop(
+                1 + (reads // self.probe_every) % (len(healthy) - 1))
+            healthy.insert(0, probe)
+        return healthy + down
+
+    def best(self, locations):
+        """ Index of the preferred location, e.g. to open files in advance.
+        Unlike `order()`, it doesn't affect routing of reads """
+        with self._lock:
+            healthy, down = self._rank(locations)
+        return (healthy or down)[0]
+
+    def observe(self, location, seconds):
+        """ Record time of a successful read """
+        with self._lock:
+            previous = self._latency.get(location)
+            if previous is None:
+                self._latency[location] = seconds
+            else:
+                self._latency[location] = \
+                    previous + self.smoothing * (seconds - previous)
+
+    def fail(self, location):
+        """ Skip the location for a while after a failed read """
+        now = time.time()
+        with self._lock:
+            was_up = self._down.get(location, 0) <= now
+            self._down[location] = now + self.cooldown
+        if was_up:
+            warnings.warn('Storage location %s failed, switching to replicas '
+                          'for %d seconds' % (location, self.cooldown))
+
+    def status(self):
+        """ Get observed latency and availability of known locations """
+        now = time.time()
+        with self._lock:
+            return {location: {'latency': self._latency.get(location),
+                               'down': self._down.get(location, 0) > now}
+                    for location in set(self._latency) | set(self._down)}
+
+    def reset(self):
+        """ Forget observed latencies and failures """
+        with self._lock:
+            self._latency.clear()
+            self._down.clear()
+            self._reads = 0
+
+
+ROUTER = ReplicaRouter()
+
+
+def _route(tuple locations, tuple paths, func, *args):
+    """ Call `func(path, *args)` on replicas of a shard, best first,
+    until one doesn't fail with IOError """
+    if len(paths) == 1:
+        return func(paths[0], *args)
+    cdef double start
+    error = None
+    for i in ROUTER.order(locations):
+        start = _clock()
+        try:
+            result = func(paths[i], *args)
+        except (IOError, OSError) as e:
+            ROUTER.fail(locations[i])
+            error = e
+            continue
+        ROUTER.observe(locations[i], _clock() - start)
+        return result
+    raise error
+
+
+def _tch_get(bytes path, bytes key, dtype=None, shard=None):
+    cdef Hash db = _get_tch(path)
+    bloom = _get_filter(path, db)
+    if bloom is not None and key not in bloom:
+        return None
+    try:
+        return db.read(key, dtype, shard)
+    except KeyError:
+        return None
+
+
+def _tch_get_many(bytes path, list keys, dtype=None, shard=None):
+    cdef Hash db = _get_tch(path)
+    bloom = _get_filter(path, db)
+    if bloom is None:
+        return db.get_many(keys, dtype, shard)
+    cdef list res = [None] * len(keys)
+    cdef list idxs = [i for i, key in enumerate(keys) if key in bloom]
+    for i, value in zip(idxs, db.get_many(
+            [keys[i] for i in idxs], dtype, shard)):
+        res[i] = value
+    return res
+
+
+cdef uint8_t _shard(bytes key, bint use_fnv_keys, uint8_t prefix_length):
+    """ Get the shard number (file prefix) of an object key """
+    cdef uint8_t p
+    if use_fnv_keys:
+        p = fnvhash(key)
+    else:
+        p = key[0]
+    return p & ((1 << prefix_length) - 1)
+
+
+def _read_many(list keys, str dtype, bint use_fnv_keys, int workers=0):
+    """ Read .tch values for many keys, visiting every shard only once
+
+    Args:
+        keys (List[bytes]): object keys
+        dtype (str): data type, e.g. 'commit_random'
+        use_fnv_keys (bool): whether the keys are sharded by FNV hash
+        workers (int): if positive, read shards concurrently using a pool
+            of this many threads. Reads are done with GIL released, so this
+            allows to overlap disk latency of different shards.
+
+    Returns:
+        List[Optional[bytes]]: values in the same order as keys,
+            `None` for missing keys
+    """
+    client = _lookup_client()
+    if client is not None:
+        return client.get_many(dtype, keys, use_fnv_keys)
+    prefix_length, locations, paths = PATHS.routes(dtype)
+    cdef:
+        dict groups = {}
+        list res = [None] * len(keys)
+        list idxs
+        Py_ssize_t i
+        bytes key
+    for i, key in enumerate(keys):
+        groups.setdefault(_shard(key, use_fnv_keys, prefix_length), []).append(i)
+
+    def read_group(group):
+        prefix, idxs = group
+        start = _clock() if _STATS_ON else 0
+        values = _route(locations, paths[prefix], _tch_get_many,
+                        [keys[i] for i in idxs], dtype, prefix)
+        if start:
+            _track('read_many', dtype, prefix,
+                   sum(len(value) for value in values if value), start)
+        return idxs, values
+
+    if workers > 0 and len(groups) > 1:
+        pool = ThreadPool(min(workers, len(groups)))
+        try:
+            results = pool.imap_unordered(read_group, groups.items())
+            for idxs, values in results:
+                for i, value in zip(idxs, values):
+                    res[i] = value
+        finally:
+            pool.terminate()
+        return res
+
+    for group in groups.items():
+        idxs, values = read_group(group)
+        for i, value in zip(idxs, values):
+            res[i] = value
+    return res
+
+
+def fetch_parallel(objects, dtype, workers=8):
+    """ Read `dtype` values of many objects, reading shards concurrently.
+    TokyoCabinet reads are done with GIL released, so a pool of threads
+    can keep several disks (or a RAID) busy from a single process.
+
+        >>> commits = [Commit(sha) for sha in shas]  # doctest: +SKIP
+        >>> fetch_parallel(commits, 'commit_random', workers=16)  # doctest: +SKIP
+
+    Args:
+        objects (Iterable[_Base]): objects of the same type
+        dtype (str): data type, e.g. 'commit_random' or 'author_commits'
+        workers (int): number of threads
+
+    Returns:
+        List[Optional[bytes]]: raw values in the same order as objects,
+            `None` for missing keys
+    """
+    objects = list(objects)
+    if not objects:
+        return []
+    return _read_many([obj.key for obj in objects], dtype,
+                      objects[0].use_fnv_keys, workers)
 
 
 class _Base(object):
@@ -595,6 +2739,8 @@ class _Base(object):
     # fnv keys are used for non-git objects, such as files, projects and authors
     use_fnv_keys = True  # type: bool
     _keys_registry_dtype = None  # type: str
+    # cached property holding decoded values of the keys registry
+    _keys_registry_property = 'commit_shas'  # type: str
 
     def __init__(self, key):
         self.key = key
@@ -615,83 +2761,308 @@ class _Base(object):
 
     def __str__(self):
         return (binascii.hexlify(self.key).decode('ascii')
-                if isinstance(self.key, bytes_type) else self.key)
+                if isinstance(self.key, bytes) else self.key)
+
+    def _stats_shard(self, dtype):
+        """ Shard of the object in `dtype` files, to label `Stats` events.
+        It is only needed if stats are enabled; None otherwise """
+        if not _STATS_ON:
+            return None
+        return _shard(self.key, self.use_fnv_keys, PATHS.routes(dtype)[0])
 
     def resolve_path(self, dtype):
         """ Get path to a file using data type and object key (for sharding)
         """
-        path, prefix_length = PATHS[dtype]
-
-        cdef uint8_t p
-        if self.use_fnv_keys:
-            p = fnvhash(self.key)
-        else:
-            p = nth_byte(self.key, 0)
-        cdef uint8_t prefix = p & (2**prefix_length - 1)
-        return path.format(key=prefix)
+        prefix_length, locations, paths = PATHS.routes(dtype)
+        paths = paths[_shard(self.key, self.use_fnv_keys, prefix_length)]
+        return paths[ROUTER.best(locations)].decode('ascii')
 
     def read_tch(self, dtype):
         """ Resolve the path and read .tch"""
-        path = self.resolve_path(dtype).encode('ascii')
-        try:
-            return _get_tch(path)[self.key]
-        except KeyError:
-            return None
+        client = _lookup_client()
+        if client is not None:
+            return client.get(dtype, self.key, self.use_fnv_keys)
+        prefix_length, locations, paths = PATHS.routes(dtype)
+        cdef uint8_t shard = _shard(self.key, self.use_fnv_keys, prefix_length)
+        cdef double start = _clock() if _STATS_ON else 0
+        value = _route(locations, paths[shard], _tch_get, self.key,
+                       dtype, shard)
+        if start:
+            _track('read_tch', dtype, shard, len(value or b''), start)
+        return value
+
+    @classmethod
+    def _to_key(cls, key):
+        """ Convert an object or its id, as accepted by the constructor,
+        to the storage key """
+        if isinstance(key, _Base):
+            return key.key
+        if isinstance(key, str):
+            return key.encode('utf8')
+        return key
+
+    @classmethod
+    def fetch_many(cls, keys, dtype, workers=0):
+        """ Read `dtype` values of many objects at once.
+        Keys are grouped by shard, so that every .tch file is visited once
+        per call instead of once per key.
+
+            >>> Commit.fetch_many(shas, 'commit_random')  # doctest: +SKIP
+
+        Args:
+            keys (Iterable): objects or their ids, e.g. SHAs for git objects
+            dtype (str): data type, e.g. 'commit_random' or 'project_commits'
+            workers (int): if positive, read shards concurrently using
+                this many threads, see `fetch_parallel()`
+
+        Returns:
+            List[Optional[bytes]]: raw values in the same order as keys,
+                `None` for missing keys
+        """
+        return _read_many([cls._to_key(key) for key in keys], dtype,
+                          cls.use_fnv_keys, workers)
 
     @classmethod
-    def all_keys(cls):
+    def _scan_dtype(cls):
+        """ Data type used to iterate all objects of this type """
+        if not cls._keys_registry_dtype:
+            raise NotImplementedError
+        return cls._keys_registry_dtype
+
+    @classmethod
+    def shards(cls, part=None, of=None):
+        """ Get shard numbers used to iterate all objects of this type.
+
+        Shards can be split into `of` disjoint partitions; `part` is the
+        zero-based number of the partition to return. Partitioning is
+        deterministic, so the same `part` and `of` always give the same
+        shards, e.g. to split a full scan across cluster nodes:
+
+            >>> Commit.shards(part=1, of=4)  # doctest: +SKIP
+            [1, 5, 9, ...]
+
+        Returns:
+            List[int]: shard numbers
+        """
+        _, prefix_length = PATHS[cls._scan_dtype()]
+        total = 2 ** prefix_length
+        if part is None and of is None:
+            return list(range(total))
+        if part is None or not of or not 0 <= part < of:
+            raise ValueError('Invalid partition %s of %s' % (part, of))
+        return list(range(part, total, of))
+
+    @classmethod
+    def _select_shards(cls, shards=None, part=None, of=None):
+        if shards is None:
+            return cls.shards(part, of)
+        if part is not None or of is not None:
+            raise ValueError('shards and part/of are mutually exclusive')
+        total = len(cls.shards())
+        shards = list(shards)
+        for shard in shards:
+            if not 0 <= shard < total:
+                raise ValueError('Invalid shard number: %s' % shard)
+        return shards
+
+    @classmethod
+    def all_keys(cls, shards=None, part=None, of=None):
         """ Iterate keys of all objects of the given type
         This might be useful to get a list of all projects, or a list of
         all file names.
 
+        Args:
+            shards (Iterable[int]): only iterate these shards
+            part (int), of (int): only iterate `part`th of `of` partitions
+                of shards, see `.shards()`
+
         Yields:
             bytes: objects key
         """
-        if not cls._keys_registry_dtype:
-            raise NotImplemented
-
-        base_path, prefix_length = PATHS[cls._keys_registry_dtype]
-        for file_prefix in range(2 ** prefix_length):
-            for key in _get_tch(base_path.format(key=file_prefix).encode('ascii')):
+        _, locations, paths = PATHS.routes(cls._scan_dtype())
+        for file_prefix in cls._select_shards(shards, part, of):
+            for key in _route(locations, paths[file_prefix], _get_tch):
                 yield key
 
     @classmethod
-    def all(cls):
-        for key in cls.all_keys():
-            yield cls(key)
+    def all_items(cls, dtype=None, shards=None, part=None, of=None,
+                  decoder=None):
+        """ Iterate keys of all objects of the given type together with
+        their relation values, e.g. all projects and their commits:
+
+            >>> for key, shas in Project.all_items(decoder=slice20):
+            ...     print(key, len(shas))  # doctest: +SKIP
+
+        Every shard is read in one sequential pass, without looking up
+        values key by key, see `Hash.items()`.
+
+        Args:
+            dtype (str): a relation sharded the same way as the keys
+                registry, e.g. 'project_authors' for projects; defaults
+                to the keys registry itself
+            shards (Iterable[int]): only iterate these shards
+            part (int), of (int): only iterate `part`th of `of` partitions
+                of shards, see `.shards()`
+            decoder (Callable[[bytes], object]): function to apply to raw
+                values, e.g. `slice20` or `decomp`; values are raw bytes
+                by default
+
+        Yields:
+            Tuple[bytes, object]: object key and its relation value
+        """
+        _, locations, paths = PATHS.routes(dtype or cls._scan_dtype())
+        for file_prefix in cls._select_shards(shards, part, of):
+            db = _route(locations, paths[file_prefix], _get_tch)
+            for key, value in db.items():
+                yield key, (value if decoder is None else decoder(value))
+
+    @classmethod
+    def all(cls, shards=None, part=None, of=None, with_values=False):
+        """ Iterate all objects of the given type.
+        Parameters are the same as in `.all_keys()`
+
+        If `with_values` is True, relation of the keys registry (i.e.
+        `commit_shas` of projects, files and authors) is read along with
+        keys and pre-populated, see `.all_items()`.
+        """
+        if not with_values:
+            for key in cls.all_keys(shards, part, of):
+                yield cls(key)
+            return
+        prop = cls._keys_registry_property
+        for key, value in cls.all_items(shards=shards, part=part, of=of):
+            obj = cls(key)
+            setattr(obj, '_' + prop, slice20(value))
+            yield obj
+
+    @classmethod
+    def map_shards(cls, func, processes=None, shards=None, part=None,
+                   of=None):
+        """ Apply `func` to all objects of this type, one shard at a time,
+        using a pool of processes.
+
+        `func` is called once per shard with an iterator of the shard objects
+        (i.e. the same as `.all(shards=[shard])`), and must be picklable,
+        i.e. defined at the module level. Results are yielded as soon as
+        each shard is done, so the caller can keep track of progress:
+
+            >>> def count(commits):
+            ...     return sum(1 for _ in commits)
+            >>> for shard, n in Commit.map_shards(count, processes=32):
+            ...     print(shard, n)  # doctest: +SKIP
+
+        Failed shards do not stop processing of other shards. Instead, a
+        warning is issued and `ShardError` listing all failed shards is
+        raised at the end. These shards can be re-run using `shards=`.
+
+        Args:
+            func (Callable): function to apply to shard iterators
+            processes (int): number of processes, defaults to the number of
+                CPUs
+            shards, part, of: shards to process, same as in `.all_keys()`
+
+        Yields:
+            Tuple[int, object]: (shard, func result)
+        """
+        tasks = [(cls, func, shard)
+                 for shard in cls._select_shards(shards, part, of)]
+        failed = []
+        pool = multiprocessing.Pool(processes)
+        try:
+            for shard, result, error in pool.imap_unordered(_map_shard, tasks):
+                if error is not None:
+                    warnings.warn('Failed to process shard %d of %s:\n%s' % (
+                        shard, cls.__name__, error))
+                    failed.append(shard)
+                    continue
+                yield shard, result
+        finally:
+            pool.terminate()
+        if failed:
+            raise ShardError('Failed shards: %s' % sorted(failed),
+                             sorted(failed))
+
+
+def _map_shard(task):
+    """ Process pool worker for `_Base.map_shards()` """
+    cls, func, shard = task
+    try:
+        return shard, func(cls.all(shards=(shard,))), None
+    except Exception:
+        return shard, None, traceback.format_exc()
 
 
 class GitObject(_Base):
     use_fnv_keys = False
 
     @classmethod
-    def all(cls):
-        """ Iterate ALL objects of this type (all projects, all times) """
+    def _to_key(cls, key):
+        if isinstance(key, GitObject):
+            return key.bin_sha
+        if isinstance(key, (str, bytes)) and len(key) == 40:
+            return binascii.unhexlify(key)
+        if isinstance(key, bytes) and len(key) == 20:
+            return key
+        raise ValueError('Invalid SHA1 hash: %s' % key)
+
+    @classmethod
+    def _scan_dtype(cls):
+        return cls.type + '_sequential_idx'
+
+    @classmethod
+    def all(cls, shards=None, part=None, of=None, with_data=False):
+        """ Iterate ALL objects of this type (all projects, all times)
+
+        Args:
+            shards, part, of: shards to iterate, same as `_Base.all_keys()`
+            with_data (bool): read object content from the sequential .bin
+                files along with the index. Files are read in one pass with
+                large buffered reads, so a full scan does not need to
+                look up every object in the random access storage.
+        """
         base_idx_path, prefix_length = PATHS[cls.type + '_sequential_idx']
         base_bin_path, prefix_length = PATHS[cls.type + '_sequential_bin']
-        for key in range(2**prefix_length):
+        cdef uint64_t offset, length, pos
+        for key in cls._select_shards(shards, part, of):
             idx_path = base_idx_path.format(key=key)
-            bin_path = base_bin_path.format(key=key)
-            datafile = open(bin_path, "rb")
-            for line in open(idx_path):
-                chunks = line.strip().split(";")
-                offset, comp_length, sha = chunks[1:4]
-                if len(chunks) > 4:  # cls.type == "blob":
-                    # usually, it's true for blobs;
-                    # however, some blobs follow common pattern
-                    sha = chunks[4]
-
-                obj = cls(sha)
-                # obj.data = decomp(datafile.read(int(comp_length)))
-
-                yield obj
-            datafile.close()
+            datafile = None
+            if with_data:
+                datafile = open(base_bin_path.format(key=key), 'rb',
+                                SEQUENTIAL_BUFFER_SIZE)
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(datafile.fileno(), 0, 0,
+                                     os.POSIX_FADV_SEQUENTIAL)
+            pos = 0
+            try:
+                with open(idx_path) as idx_file:
+                    for line in idx_file:
+                        chunks = line.strip().split(";")
+                        offset_str, length_str, sha = chunks[1:4]
+                        if len(chunks) > 4:  # cls.type == "blob":
+                            # usually, it's true for blobs;
+                            # however, some blobs follow common pattern
+                            sha = chunks[4]
+
+                        obj = cls(sha)
+                        if datafile is not None:
+                            offset = int(offset_str)
+                            length = int(length_str)
+                            if offset != pos:
+                                datafile.seek(offset)
+                            # pre-populate cached_property
+                            obj._data = decomp(datafile.read(length))
+                            pos = offset + length
+
+                        yield obj
+            finally:
+                if datafile is not None:
+                    datafile.close()
 
     def __init__(self, sha):
-        if isinstance(sha, str_type) and len(sha) == 40:
+        if isinstance(sha, str) and len(sha) == 40:
             self.sha = sha
             self.bin_sha = binascii.unhexlify(sha)
-        elif isinstance(sha, bytes_type) and len(sha) == 20:
+        elif isinstance(sha, bytes) and len(sha) == 20:
             self.bin_sha = sha
             self.sha = binascii.hexlify(sha).decode('ascii')
         else:
@@ -704,7 +3075,19 @@ class GitObject(_Base):
         if self.type not in ('commit', 'tree'):
             raise NotImplementedError
         # default implementation will only work for commits and trees
-        return decomp(self.read_tch(self.type + '_random'))
+        dtype = self.type + '_random'
+        cache = OBJECT_CACHE
+        if cache is None:
+            return _decomp_value(
+                self.read_tch(dtype), dtype, self._stats_shard(dtype))
+        key = (self.type, self.bin_sha)
+        data = cache.get(key)
+        if data is None:
+            data = _decomp_value(
+                self.read_tch(dtype), dtype, self._stats_shard(dtype))
+            if data is not None:
+                cache.put(key, data)
+        return data
 
     @classmethod
     def string_sha(cls, data):
@@ -762,42 +3145,287 @@ class Blob(GitObject):
             raise ObjectNotFound('Blob data not found (bad sha?)')
         return unber(value)
 
-    @cached_property
-    def data(self):
-        """ Content of the blob """
-        offset, length = self.position
-        # no caching here to stay thread-safe
-        with open(self.resolve_path('blob_data'), 'rb') as fh:
-            fh.seek(offset)
-            return decomp(fh.read(length))
+    @cached_property
+    def data(self):
+        """ Content of the blob """
+        client = _lookup_client()
+        if client is not None:
+            data = client.get('blob_data', self.bin_sha)
+            if data is None:
+                raise ObjectNotFound('Blob data not found (bad sha?)')
+            return data
+        offset, length = self.position
+        prefix_length, locations, paths = PATHS.routes('blob_data')
+        cdef uint8_t shard = _shard(self.bin_sha, False, prefix_length)
+        cdef double start = _clock() if _STATS_ON else 0
+        # a memoryview slice doesn't copy compressed data out of the mmap
+        raw_data = memoryview(_route(
+            locations, paths[shard], _get_bin, offset + length))[
+            offset:offset + length]
+        if start:
+            _track('blob_data', 'blob_data', shard, length, start)
+        return _decomp_value(raw_data, 'blob_data', shard)
+
+    @classmethod
+    def read_many(cls, shas):
+        """ Read content of many blobs at once.
+        Offsets of all blobs are resolved first; then, every .bin file is
+        read in ascending offset order. On HDD, it turns random reads into
+        nearly sequential ones.
+
+        Args:
+            shas (Iterable): blobs or their SHA hashes
+
+        Returns:
+            List[Optional[bytes]]: blob content in the same order as shas,
+                `None` for missing blobs
+        """
+        keys = [cls._to_key(sha) for sha in shas]
+        client = _lookup_client()
+        if client is not None:
+            return client.get_many('blob_data', keys)
+        positions = _read_many(keys, 'blob_offset', False)
+        prefix_length, locations, paths = PATHS.routes('blob_data')
+        cdef:
+            dict groups = {}
+            list res = [None] * len(keys)
+            Py_ssize_t i
+            uint64_t offset, length
+        for i, (key, position) in enumerate(zip(keys, positions)):
+            if position is None:
+                continue
+            offset, length = unber(position)
+            groups.setdefault(_shard(key, False, prefix_length), []).append(
+                (offset, length, i))
+
+        for prefix, chunks in groups.items():
+            chunks.sort()
+            data = memoryview(_route(
+                locations, paths[prefix], _get_bin,
+                max(offset + length for offset, length, _ in chunks)))
+            values = _decomp_many(
+                [data[offset:offset + length] for offset, length, _ in chunks],
+                'blob_data', prefix)
+            for (offset, length, i), value in zip(chunks, values):
+                res[i] = value
+        return res
+
+    @cached_property
+    def commit_shas(self):
+        """ SHAs of Commits in which this blob have been
+        introduced or modified.
+
+        **NOTE: commits removing this blob are not included**
+        """
+        return slice20(self.read_tch('blob_commits'))
+
+    @cached_property
+    def commit_sha_array(self):
+        """ Same as `commit_shas`, as a compact `ShaArray` (requires numpy) """
+        return ShaArray(self.read_tch('blob_commits'))
+
+    @property
+    def commits(self):
+        """ Commits where this blob has been added or changed
+
+        **NOTE: commits removing this blob are not included**
+        """
+        return (Commit(bin_sha) for bin_sha in self.commit_shas)
+
+    @cached_property
+    def first_author(self):
+        """ get time, first author and first commit for the blob
+        """
+        return _parse_first_author(self.read_tch('blob_first_author'))
+
+
+def _parse_first_author(bytes value):
+    """ Parse a `blob_first_author` value: `<time>;<author>;<commit sha>`
+
+    Returns:
+        Tuple[str, str, str]: time, author and hex sha of the commit
+    """
+    cdef Py_ssize_t n = len(value)
+    timestamp, author = value[:n - 21].decode('utf8', 'replace').split(
+        ';', 1)
+    return timestamp, author, binascii.hexlify(value[n - 20:]).decode('ascii')
+
+
+def _blob_sha(path):
+    """ Process pool worker for `scan_directory()`: blob SHA of a file.
+    Like in git, symlinks are hashed as the path they point to """
+    try:
+        if os.path.islink(path):
+            target = os.readlink(path)
+            if not isinstance(target, bytes):
+                # undecodable names are kept as surrogates, see PEP 383
+                target = os.fsencode(target)
+            return path, Blob.string_sha(target)
+        return path, Blob.file_sha(path)
+    except (IOError, OSError):
+        return path, None
+
+
+def _walk_files(path):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+        # os.walk lists symlinks to directories with directories, but
+        # doesn't follow them. Like git, record them as links instead
+        for dirname in dirnames:
+            dir_path = os.path.join(dirpath, dirname)
+            if os.path.islink(dir_path):
+                yield dir_path
+
+
+def _first_commits(list bin_shas, int max_commits=1000):
+    """ Resolve first author and commit of many blobs, see
+    `scan_directory()`. If `blob_first_author` is not available on this
+    host, the earliest of `blob_commits` is used; blobs with more than
+    `max_commits` commits, e.g. an empty file, are skipped, since it
+    would take reading all of them.
+
+    Returns:
+        List[Optional[Tuple[str, str]]]: (author, hex commit sha) of blobs
+    """
+    try:
+        values = Blob.fetch_many(bin_shas, 'blob_first_author')
+    except KeyError:  # relation is not available on this host
+        pass
+    else:
+        return [value and _parse_first_author(value)[1:] for value in values]
+
+    try:
+        values = Blob.fetch_many(bin_shas, 'blob_commits')
+    except KeyError:
+        return [None] * len(bin_shas)
+    commit_lists = [slice20(value) if value is not None
+                    and len(value) <= 20 * max_commits else ()
+                    for value in values]
+    commits = list({sha for shas in commit_lists for sha in shas})
+    records = dict(zip(commits, _commit_records(commits) or ()))
+    res = []
+    for shas in commit_lists:
+        first = None
+        for sha in shas:
+            record = records.get(sha)
+            if record is not None and record[0] >= 0 \
+                    and (first is None or record[0] < first[0]):
+                first = (record[0], record[2], sha)
+        res.append(first and (
+            first[1].decode('utf8', 'replace'),
+            binascii.hexlify(first[2]).decode('ascii')))
+    return res
+
+
+def scan_directory(path, workers=None, batch_size=4096, max_commits=1000):
+    """ Find origins of all files in a local directory, e.g. a vendored
+    source tree:
+
+        >>> for path, sha, author, commit in scan_directory('vendor/'):
+        ...     print(path, author, commit)  # doctest: +SKIP
+
+    Files are hashed as git blobs by a pool of processes, with streaming
+    reads. SHAs are resolved in batches, so every `blob_first_author`
+    shard is visited once per batch. Records are streamed in the order
+    files are hashed. `.git` directories are skipped. Symlinks, including
+    those to directories, are not followed but hashed as links, like git
+    stores them.
+
+    Args:
+        path (str): directory (or a single file) to scan
+        workers (int): number of hashing processes, defaults to the number
+            of CPUs; 0 to hash files in this process
+        batch_size (int): number of files to resolve at once
+        max_commits (int): if `blob_first_author` is not available, blobs
+            found in more commits (e.g. a stock LICENSE) are not resolved
+
+    Yields:
+        Tuple[str, Optional[str], Optional[str], Optional[str]]: file path,
+            blob hex SHA (`None` if the file is not readable), first author
+            and hex SHA of the first commit introducing the blob (`None` if
+            the blob is not known)
+    """
+    if workers == 0:
+        hashed = (_blob_sha(file_path) for file_path in _walk_files(path))
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        hashed = pool.imap_unordered(_blob_sha, _walk_files(path), 64)
+    try:
+        while True:
+            batch = [item for _, item in zip(range(batch_size), hashed)]
+            if not batch:
+                return
+            known = [i for i, (_, sha) in enumerate(batch) if sha is not None]
+            origins = dict(zip(known, _first_commits(
+                [binascii.unhexlify(batch[i][1]) for i in known],
+                max_commits)))
+            for i, (file_path, sha) in enumerate(batch):
+                origin = origins.get(i) or (None, None)
+                yield file_path, sha, origin[0], origin[1]
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-    @cached_property
-    def commit_shas(self):
-        """ SHAs of Commits in which this blob have been
-        introduced or modified.
 
-        **NOTE: commits removing this blob are not included**
-        """
-        return slice20(self.read_tch('blob_commits'))
+cdef list _parse_tree(bytes data):
+    """ Get offsets of entries in a raw tree, see Tree.offsets() """
+    cdef:
+        const unsigned char *buf = data
+        Py_ssize_t i = 0, n = len(data), start, name_start
+        list res = []
+    while i < n:
+        # mode
+        start = i
+        while i < n and buf[i] != 32:  # 32 is space
+            i += 1
+        # file name
+        i += 1
+        name_start = i
+        while i < n and buf[i] != 0:
+            i += 1
+        # sha
+        res.append((start, name_start, i + 1))
+        i += 21
+    return res
 
-    @property
-    def commits(self):
-        """ Commits where this blob has been added or changed
 
-        **NOTE: commits removing this blob are not included**
-        """
-        return (Commit(bin_sha) for bin_sha in self.commit_shas)
+def _walk_tree(tree):
+    """ Recursive part of Tree.traverse(), lazy and without memoization """
+    for mode, fname, sha in tree:
+        yield mode, fname, sha
+        # trees are always 40000:
+        # https://stackoverflow.com/questions/1071241
+        if mode == b'40000':
+            prefix = fname + b'/'
+            for mode2, fname2, sha2 in _walk_tree(Tree(sha)):
+                yield mode2, prefix + fname2, sha2
 
-    @cached_property
-    def first_author(self):
-        """ get time, first author and first commit for the blob
-        """
-        buf = self .read_tch ('blob_first_author')
-        buf0 = buf [0:len(buf)-21]
-        cmt_sha = buf [(len(buf)-20):len(buf)]
-        (Time, Author) = buf0 .decode('ascii') .split(";")
-        return (Time, Author, cmt_sha .hex())
 
+cdef list _flatten_tree(tree, dict memo):
+    """ Recursive part of Tree.traverse() with a memo """
+    cdef:
+        list flat = memo.get(tree.bin_sha)
+        bytes mode, fname, sha, prefix
+    if flat is not None:
+        return flat
+    flat = []
+    for mode, fname, sha in tree:
+        flat.append((mode, fname, sha))
+        # trees are always 40000:
+        # https://stackoverflow.com/questions/1071241
+        if mode == b'40000':
+            prefix = fname + b'/'
+            for mode2, fname2, sha2 in _flatten_tree(Tree(sha), memo):
+                flat.append((mode2, prefix + fname2, sha2))
+    memo[tree.bin_sha] = flat
+    return flat
 
 
 class Tree(GitObject):
@@ -852,27 +3480,42 @@ class Tree(GitObject):
         ...     for line in Tree("954829887af5d9071aa92c427133ca2cdd0813cc"))
         True
         """
-        # unfortunately, Py2 cython doesn't know how to instantiate bytes from
-        # memoryviews. TODO: reuse libgit2 git_tree__parse_raw
-        data = self.data
+        cdef:
+            bytes data = self.data
+            Py_ssize_t start, name_start, sha_start
+            double started = _clock() if _STATS_ON else 0
+        entries = _parse_tree(data)
+        if started:
+            _track('tree_parse', 'tree_random',
+                   self._stats_shard('tree_random'), len(data), started)
+        for start, name_start, sha_start in entries:
+            yield (data[start:name_start - 1], data[name_start:sha_start - 1],
+                   data[sha_start:sha_start + 20])
+
+    def offsets(self):
+        """ Get offsets of tree entries in `.data`, without copying anything.
 
-        i = 0
-        while i < len(data):
-            # mode
-            start = i
-            while i < len(data) and nth_byte(data, i) != 32:  # 32 is space
-                i += 1
-            mode = data[start:i]
-            i += 1
-            # file name
-            start = i
-            while i < len(data) and <char> nth_byte(data, i) != 0:
-                i += 1
-            fname = data[start:i]
-            # sha
-            start = i + 1
-            i += 21
-            yield mode, fname, data[start:i]
+        Returns:
+            List[Tuple[int, int, int]]: 3-tuples of (start, name_start,
+                sha_start) offsets, so that for every entry:
+                mode = data[start:name_start - 1],
+                filename = data[name_start:sha_start - 1],
+                sha = data[sha_start:sha_start + 20]
+        """
+        return _parse_tree(self.data)
+
+    def views(self):
+        """ Same as iterating the tree, but yields memoryviews over `.data`
+        instead of copies of mode, filename and sha.
+
+        >>> [bytes(fname) for _, fname, _ in Tree(
+        ...     "954829887af5d9071aa92c427133ca2cdd0813cc").views()][:2]
+        [b'__init__.py', b'admin.py']
+        """
+        data = memoryview(self.data)
+        for start, name_start, sha_start in _parse_tree(self.data):
+            yield (data[start:name_start - 1], data[name_start:sha_start - 1],
+                   data[sha_start:sha_start + 20])
 
     def __len__(self):
         return len(self.files)
@@ -882,18 +3525,30 @@ class Tree(GitObject):
             return item.key in self.files
         elif isinstance(item, Blob):
             return item.bin_sha in self.blob_shas
-        elif isinstance(item, str_type) and len(item) == 40:
+        elif isinstance(item, str) and len(item) == 40:
             item = binascii.unhexlify(item)
-        elif not isinstance(item, bytes_type):
+        elif not isinstance(item, bytes):
             return False
 
         return item in self.blob_shas or item in self.files
 
-    def traverse(self):
+    def traverse(self, memo=None):
         """ Recursively traverse the tree
         This will generate 3-tuples of the same format as direct tree
         iteration, but will recursively include subtrees content.
 
+        Entries are generated lazily. To expand identical subtrees only once,
+        e.g. to list files of all commits in a project, pass the same `memo`
+        dict; flattened subtrees are then memoized by SHA:
+
+            >>> memo = {}
+            >>> for commit in project.commits:  # doctest: +SKIP
+            ...     files = list(commit.tree.traverse(memo))
+
+        Args:
+            memo (Optional[dict]): flattened subtrees, binary SHA -> list of
+                entries. Note that it might take a lot of memory.
+
         Yields:
             Tuple[bytes, bytes, bytes]: (mode, filename, blob/tree sha)
 
@@ -904,13 +3559,9 @@ class Tree(GitObject):
         >>> len(list(c.tree.traverse()))
         36
         """
-        for mode, fname, sha in self:
-            yield mode, fname, sha
-            # trees are always 40000:
-            # https://stackoverflow.com/questions/1071241
-            if mode == b'40000':
-                for mode2, fname2, sha2 in Tree(sha).traverse():
-                    yield mode2, fname + b'/' + fname2, sha2
+        if memo is None:
+            return _walk_tree(self)
+        return iter(_flatten_tree(self, memo))
 
     @cached_property
     def str(self):
@@ -955,6 +3606,147 @@ class Tree(GitObject):
         return (Blob(sha) for sha in self.blob_shas)
 
 
+cdef dict _tree_entries(bytes bin_sha):
+    """ Map file names in a tree to (mode, sha) """
+    if bin_sha is None:
+        return {}
+    return {fname: (mode, sha) for mode, fname, sha in Tree(bin_sha)}
+
+
+cdef _collect_files(bytes tree_sha, bytes prefix, dict files, dict memo):
+    """ Add all files of a tree to `files`, as path -> blob sha """
+    for mode, fname, sha in _flatten_tree(Tree(tree_sha), memo):
+        if mode != b'40000':
+            files[prefix + fname] = sha
+
+
+cdef _diff_trees(bytes old_sha, bytes new_sha, bytes prefix, list changed,
+                 dict added, dict deleted, dict memo):
+    """ Recursive part of Commit.__sub__(), comparing two trees.
+    Modified files are appended to `changed`, added and deleted files are
+    added to the corresponding dicts as path -> blob sha """
+    cdef:
+        dict old_entries = _tree_entries(old_sha)
+        dict new_entries = _tree_entries(new_sha)
+        bytes fname, path, mode, sha, old_mode, old_sha2
+        bint is_tree, old_is_tree
+    for fname, (mode, sha) in new_entries.items():
+        path = prefix + fname
+        old = old_entries.get(fname)
+        if old is not None and old[1] == sha:
+            # identical file or subtree
+            continue
+        is_tree = mode == b'40000'
+        if old is None:
+            if is_tree:
+                _collect_files(sha, path + b'/', added, memo)
+            else:
+                added[path] = sha
+            continue
+        old_mode, old_sha2 = old
+        old_is_tree = old_mode == b'40000'
+        if is_tree and old_is_tree:
+            _diff_trees(old_sha2, sha, path + b'/', changed, added, deleted,
+                        memo)
+        elif not is_tree and not old_is_tree:
+            changed.append((path, path, old_sha2, sha))
+        else:  # a file replaced by a directory or vice versa
+            if old_is_tree:
+                _collect_files(old_sha2, path + b'/', deleted, memo)
+            else:
+                deleted[path] = old_sha2
+            if is_tree:
+                _collect_files(sha, path + b'/', added, memo)
+            else:
+                added[path] = sha
+
+    for fname, (mode, sha) in old_entries.items():
+        if fname in new_entries:
+            continue
+        path = prefix + fname
+        if mode == b'40000':
+            _collect_files(sha, path + b'/', deleted, memo)
+        else:
+            deleted[path] = sha
+
+
+cdef dict _fingerprint(bytes data):
+    """ Count bytes per content chunk, similar to git diffcore-delta.
+    A chunk ends with a newline or after 64 bytes.
+
+    Returns:
+        Dict[int, int]: chunk hash -> total length of such chunks
+    """
+    cdef:
+        const unsigned char *buf = data
+        Py_ssize_t i, n = len(data), chunk_len = 0
+        uint32_t h = 0x811c9dc5
+        dict res = {}
+    for i in range(n):
+        h = (h ^ buf[i]) * 0x01000193
+        chunk_len += 1
+        if buf[i] == 10 or chunk_len == 64:
+            res[h] = res.get(h, 0) + chunk_len
+            h = 0x811c9dc5
+            chunk_len = 0
+    if chunk_len:
+        res[h] = res.get(h, 0) + chunk_len
+    return res
+
+
+cdef list _match_renames(dict added, dict deleted, double threshold):
+    """ Find pairs of deleted and added files with similar content.
+    Blobs are read in one batch; pairs are compared via an inverted index of
+    content chunks, so files without common chunks are never compared.
+
+    Returns:
+        List[Tuple[bytes, bytes]]: (deleted path, added path) pairs
+    """
+    cdef:
+        list added_paths = list(added)
+        list deleted_paths = list(deleted)
+        list contents = Blob.read_many(
+            [added[path] for path in added_paths]
+            + [deleted[path] for path in deleted_paths])
+        Py_ssize_t n_added = len(added_paths), size
+        dict index = {}, sizes = {}, common, fp
+        list candidates = []
+        double score
+        set used_added = set(), used_deleted = set()
+        list res = []
+
+    for path, content in zip(deleted_paths, contents[n_added:]):
+        if not content:
+            continue
+        sizes[path] = len(content)
+        for h, cnt in _fingerprint(content).items():
+            index.setdefault(h, []).append((path, cnt))
+
+    for path, content in zip(added_paths, contents[:n_added]):
+        if not content:
+            continue
+        size = len(content)
+        common = {}
+        for h, cnt in _fingerprint(content).items():
+            for deleted_path, deleted_cnt in index.get(h, ()):
+                common[deleted_path] = common.get(deleted_path, 0) + min(
+                    cnt, deleted_cnt)
+        for deleted_path, cnt in common.items():
+            score = <double>cnt / max(size, sizes[deleted_path])
+            if score > threshold:
+                candidates.append((score, path, deleted_path))
+
+    # the best matches first
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    for score, path, deleted_path in candidates:
+        if path in used_added or deleted_path in used_deleted:
+            continue
+        used_added.add(path)
+        used_deleted.add(deleted_path)
+        res.append((deleted_path, path))
+    return res
+
+
 class Commit(GitObject):
     """ A git commit object.
 
@@ -1014,169 +3806,58 @@ class Commit(GitObject):
             raise AttributeError(
                 '\'%s\'has no attribute \'%s\'' % (self.__class__.__name__, attr))
 
+        record = self.__dict__.get('_record')
+        if record is not None:
+            # dates are converted to datetime on the first access
+            value = getattr(record, attr)
+            setattr(self, attr, value)
+            return value
+
         for a in attrs:
             setattr(self, a, None)
         self._parse()
         return getattr(self, attr)
 
-    # def _parse2(self):
-    #     # TODO: port to Cython
-    #     # Py: 22.6usec, Cy:
-    #     cdef:
-    #         const unsigned char[:] data = self.data
-    #         uint32_t data_len = len(self.data)
-    #         uint32_t start, end, sol, eol = 101
-    #         list parent_shas = []
-    #         bytes timestamp, timezone
-    #     # fields come in this exact order:
-    #     # tree, parent, author, committer, [gpgsig], [encoding]
-    #     if data[0:5] != b'tree ': raise ValueError('Malformed commit')
-    #     self.tree = Tree(binascii.unhexlify(data[5:5+40]))
-    #
-    #     if data[45:45+8] != b'\nparent ': raise ValueError('Malformed commit')
-    #     parent_shas.append(binascii.unhexlify(data[53:53+40]))
-    #
-    #     if data[93:93+8] != b'\nauthor ': raise ValueError('Malformed commit')
-    #     # eol is initialized at 101 already
-    #     while data[eol] != b'\n': eol += 1
-    #     end = eol - 1
-    #     start = end
-    #     while data[start] != b' ': start -= 1
-    #     timezone = data[start+1:end]
-    #     end = start-1
-    #     start = end
-    #     while data[start] != b' ': start -= 1
-    #     timestamp = data[start+1:end]
-    #     self.authored_at = parse_commit_date(timestamp, timezone)
-    #     self.author = bytes(data[101:start-1])
-    #
-    #     sol = eol
-    #     eol += 1
-    #     if data[sol:sol+11] != b'\ncommitter ': raise ValueError('Malformed commit')
-    #     while data[eol] != b'\n': eol += 1
-    #     end = eol - 1
-    #     start = end
-    #     while data[start] != b' ': start -= 1
-    #     timezone = data[start+1:end]
-    #     end = start-1
-    #     start = end
-    #     while data[start] != b' ': start -= 1
-    #     timestamp = data[start+1:end]
-    #     self.committed_at = parse_commit_date(timestamp, timezone)
-    #     self.committer = bytes(data[101:start-1])
-    #
-    #
-    #     for field, field_len in ((b'tree', 5), (b'parent', 7)):
-    #     for field, field_len in ((b'author', 7), (b'committer', 10)):
-    #
-    #
-    #     self.header = bytes(data[0:i])
-    #     start = i
-    #     self.header, self.full_message = self.data.split(b'\n\n', 1)
-    #     self.message = self.full_message.split(b'\n', 1)[0]
-    #     cdef list parent_shas = []
-    #     cdef bytes signature = None
-    #     cdef bint reading_signature = False
-    #     for line in self.header.split(b'\n'):
-    #         if reading_signature:
-    #             # examples:
-    #             #   1cc6f4418dcc09f64dcbb0410fec76ceaa5034ab
-    #             #   cbbc685c45bdff4da5ea0984f1dd3a73486b4556
-    #             signature += line
-    #             if line.strip() == b'-----END PGP SIGNATURE-----':
-    #                 self.signature = signature
-    #                 reading_signature = False
-    #             continue
-    #
-    #         if line.startswith(b' '):  # mergetag object, not supported (yet?)
-    #             # example: c1313c68c7f784efaf700fbfb771065840fc260a
-    #             continue
-    #
-    #         line = line.strip()
-    #         if not line:  # sometimes there is an empty line after gpgsig
-    #             continue
-    #         try:
-    #             key, value = line.split(b' ', 1)
-    #         except ValueError:
-    #             raise ValueError('Unexpected header in commit ' + self.sha)
-    #         # fields come in this exact order:
-    #         # tree, parent, author, committer, [gpgsig], [encoding]
-    #         if key == b'tree':
-    #             # value is bytes holding hex values -> need to decode
-    #             self.tree = Tree(binascii.unhexlify(value))
-    #         elif key == b'parent':  # multiple parents possible
-    #             parent_shas.append(binascii.unhexlify(value))
-    #         elif key == b'author':
-    #             # author name can have arbitrary number of spaces while
-    #             # timestamp is guaranteed to have one, so rsplit
-    #             self.author, timestamp, timezone = value.rsplit(b' ', 2)
-    #             self.authored_at = parse_commit_date(timestamp, timezone)
-    #         elif key == b'committer':
-    #             # same logic as author
-    #             self.committer, timestamp, timezone = value.rsplit(b' ', 2)
-    #             self.committed_at = parse_commit_date(timestamp, timezone)
-    #         elif key == b'gpgsig':
-    #             signature = value
-    #             reading_signature = True
-    #         elif key == b'encoding':
-    #             self.encoding = value.decode('ascii')
-    #     self.parent_shas = tuple(parent_shas)
-
     def _parse(self):
-        try:
-            self.header, self.full_message = self.data.split(b'\n\n', 1)
-        except ValueError:   # Sometimes self.data == b''
-            raise ObjectNotFound()
-        self.message = self.full_message.split(b'\n', 1)[0]
-        cdef list parent_shas = []
-        cdef bytes signature = None
-        cdef bint reading_signature = False
-        for line in self.header.split(b'\n'):
-            if reading_signature:
-                # examples:
-                #   1cc6f4418dcc09f64dcbb0410fec76ceaa5034ab
-                #   cbbc685c45bdff4da5ea0984f1dd3a73486b4556
-                signature += line
-                if line.strip() == b'-----END PGP SIGNATURE-----':
-                    self.signature = signature
-                    reading_signature = False
-                continue
+        data = self.data
+        cdef double start = _clock() if _STATS_ON else 0
+        cdef CommitRecord record = _parse_commit(data, self.sha)
+        if start:
+            _track('commit_parse', 'commit_random',
+                   self._stats_shard('commit_random'), len(data), start)
+        self.header = record.header
+        self.full_message = record.full_message
+        self.message = record.message
+        self.tree = None if record.tree_sha is None else Tree(record.tree_sha)
+        self.parent_shas = record.parent_shas
+        self.author = record.author
+        self.committer = record.committer
+        self.signature = record.signature
+        if record.encoding is not None:
+            self.encoding = record.encoding
+        self._record = record
+        # let __getattr__ convert dates lazily
+        self.__dict__.pop('authored_at', None)
+        self.__dict__.pop('committed_at', None)
 
-            if line.startswith(b' '):  # mergetag object, not supported (yet?)
-                # example: c1313c68c7f784efaf700fbfb771065840fc260a
-                continue
+    @classmethod
+    def parse_many(cls, data):
+        """ Parse many raw commits at once, without instantiating `Commit`s.
+        This is useful for bulk analytics, e.g.:
 
-            line = line.strip()
-            if not line:  # sometimes there is an empty line after gpgsig
-                continue
-            try:
-                key, value = line.split(b' ', 1)
-            except ValueError:
-                raise ValueError('Unexpected header in commit ' + self.sha)
-            # fields come in this exact order:
-            # tree, parent, author, committer, [gpgsig], [encoding]
-            if key == b'tree':
-                # value is bytes holding hex values -> need to decode
-                self.tree = Tree(binascii.unhexlify(value))
-            elif key == b'parent':  # multiple parents possible
-                parent_shas.append(binascii.unhexlify(value))
-            elif key == b'author':
-                # author name can have arbitrary number of spaces while
-                # timestamp is guaranteed to have one, so rsplit
-                self.author, timestamp, timezone = value.rsplit(b' ', 2)
-                self.authored_at = parse_commit_date(timestamp, timezone)
-            elif key == b'committer':
-                # same logic as author
-                self.committer, timestamp, timezone = value.rsplit(b' ', 2)
-                self.committed_at = parse_commit_date(timestamp, timezone)
-            elif key == b'gpgsig':
-                signature = value
-                reading_signature = True
-            elif key == b'encoding':
-                self.encoding = value.decode('ascii')
-        self.parent_shas = tuple(parent_shas)
-
-    def __sub__(self, parent, threshold=0.5):
+            >>> raw = Commit.fetch_many(shas, 'commit_random')  # doctest: +SKIP
+            >>> records = Commit.parse_many(decomp_many(raw))  # doctest: +SKIP
+
+        Args:
+            data (Iterable[Optional[bytes]]): decompressed commit content
+
+        Returns:
+            List[Optional[CommitRecord]]: parsed commits, `None` for empty or
+                missing (`None`) input values
+        """
+        return [_parse_commit(value) if value else None for value in data]
+
+    def __sub__(self, parent, threshold=0.5, rename_limit=1000):
         """ Compare two Commits.
 
         Args:
@@ -1199,6 +3880,9 @@ class Commit(GitObject):
             - setup.py.old was edited and renamed to setup.py:
                 `('setup.py.old', 'setup.py', 'old_file_sha', 'new_file_sha')`
 
+        Paths are full paths from the root tree; subtrees having the same SHA
+        in both commits are skipped without reading them.
+
         Detecting the last one is computationally expensive. You can adjust this
         behaviour by passing the `threshold` parameter, which is 0.5 by default.
         It means that if roughly 50% of the file content is the same,
@@ -1207,59 +3891,46 @@ class Commit(GitObject):
         If threshold is set to 0, any pair of deleted and added file will be
         considered renamed and edited; this last case doesn't make much sense so
         don't set it too low.
+
+        Similar to git, content similarity is estimated by the share of
+        content chunks (lines, or 64 bytes if lines are longer) in common.
+        If there are more than `rename_limit` ** 2 pairs of added and deleted
+        files, only exact renames are detected.
         """
-        if parent.sha not in self.parent_shas:
+        if parent.bin_sha not in self.parent_shas:
             warnings.warn("Comparing non-adjacent commits might be "
                           "computationally expensive. Proceed with caution.")
 
-        # filename: (blob sha before, blob sha after)
-        new_files = self.tree.files
-        new_paths = set(new_files.keys())
-        old_files = parent.tree.files
-        old_paths = set(old_files.keys())
-
-        # unchanged_paths
-        for fname in new_paths.intersection(old_paths):
-            if new_files[fname] != old_files[fname]:
-                # i.e. the Blob sha is the same
-                yield fname, fname, old_files[fname], new_files[fname]
-
-        added_paths = new_paths - old_paths
-        deleted_paths = old_paths - new_paths
-
-        if threshold >= 1:  # i.e. only exact matches are considered
-            for fname in added_paths:
-                yield None, fname, None, new_files[fname]
-            for fname in deleted_paths:
-                yield fname, None, old_files[fname], None
-            return
-
-        # search for matches
-        sm = difflib.SequenceMatcher()
-        added_blobs = {f: Blob(new_files[f]) for f in added_paths}
-        deleted_blobs = {f: Blob(old_files[f]) for f in deleted_paths}
-        # for each added blob, try to find a match in deleted blobs
-        #   if there is a match, signal a rename and remove from deleted
-        #   if there is no match, signal a new file
-        # unused deleted blobs are indeed deleted
-        for added_fname, added_blob in added_blobs.items():
-            sm.set_seq1(added_blob)
-            matched = False
-            for deleted_fname, deleted_blob in deleted_blobs.items():
-                sm.set_seq2(deleted_blob)
-                # use quick checks first (lower bound by length diff)
-                if sm.real_quick_ratio() > threshold \
-                        and sm.quick_ratio() > threshold \
-                        and sm.ratio() > threshold:
-                    yield deleted_fname, added_fname, deleted_blob, added_blob
-                    del(deleted_blobs[deleted_fname])
-                    matched = True
-                    break
-            if not matched:  # this is a new file
-                yield None, added_fname, None, added_blob
-
-        for deleted_fname, deleted_blob in deleted_blobs.items():
-            yield deleted_fname, None, deleted_blob, None
+        changed = []  # type: List[Tuple[bytes, bytes, bytes, bytes]]
+        added = {}  # type: Dict[bytes, bytes]
+        deleted = {}  # type: Dict[bytes, bytes]
+        _diff_trees(parent.tree.bin_sha, self.tree.bin_sha, b'',
+                    changed, added, deleted, {})
+        for change in changed:
+            yield change
+
+        # exact renames: the same blob sha
+        deleted_paths = {}
+        for fname, sha in deleted.items():
+            deleted_paths.setdefault(sha, []).append(fname)
+        for added_fname, sha in list(added.items()):
+            if deleted_paths.get(sha):
+                deleted_fname = deleted_paths[sha].pop()
+                del added[added_fname]
+                del deleted[deleted_fname]
+                yield deleted_fname, added_fname, sha, sha
+
+        if threshold < 1 and added and deleted \
+                and len(added) * len(deleted) <= rename_limit ** 2:
+            for deleted_fname, added_fname in _match_renames(
+                    added, deleted, threshold):
+                yield (deleted_fname, added_fname,
+                       deleted.pop(deleted_fname), added.pop(added_fname))
+
+        for fname, sha in added.items():
+            yield None, fname, None, sha
+        for fname, sha in deleted.items():
+            yield fname, None, sha, None
 
     @property
     def parents(self):
@@ -1311,6 +3982,11 @@ class Commit(GitObject):
         """
         return slice20(self.read_tch('commit_children'))
 
+    @cached_property
+    def child_sha_array(self):
+        """ Same as `child_shas`, as a compact `ShaArray` (requires numpy) """
+        return ShaArray(self.read_tch('commit_children'))
+
     @property
     def children(self):
         """ A generator of children `Commit` objects
@@ -1393,6 +4069,399 @@ class Tag(GitObject):
     type = 'tag'
 
 
+cdef int _tz_minutes(bytes tz):
+    """ Convert a timezone like b'-0400' to the offset in minutes """
+    if len(tz) != 5 or tz[:1] not in (b'+', b'-') or not tz[1:].isdigit():
+        return 0
+    cdef int minutes = int(tz[1:3]) * 60 + int(tz[3:5])
+    return -minutes if tz[:1] == b'-' else minutes
+
+
+cdef tuple _parse_commit_data(bytes value):
+    """ Parse a commit_data (c2dat) value:
+        time;timezone;author;tree;parents (colon separated)
+
+    Author names might contain semicolons, so the first two and the last two
+    fields are split off first.
+
+    Returns:
+        Tuple[int, int, bytes, bytes, Tuple[bytes]]: authored timestamp
+            (-1 if invalid), timezone offset in minutes, author,
+            binary tree SHA and binary parent SHAs
+    """
+    ts, tz, rest = value.split(b';', 2)
+    author, tree, parents = rest.rsplit(b';', 2)
+    try:
+        authored_ts = int(ts)
+    except ValueError:
+        authored_ts = -1
+    # same rules as parse_commit_date(): negative or future dates are invalid
+    if authored_ts < 0 or authored_ts > _c_time(NULL):
+        authored_ts = -1
+    return (authored_ts, _tz_minutes(tz), author,
+            binascii.unhexlify(tree),
+            tuple(binascii.unhexlify(sha) for sha in parents.split(b':') if sha))
+
+
+def _commit_records(list shas):
+    """ Read many commits using commit_data, where available, or parsing
+    the full commits otherwise. Keys are read in shard-grouped batches.
+
+    Returns:
+        List[Optional[tuple]]: `_parse_commit_data()` like tuples in the same
+            order as shas, `None` for missing commits
+    """
+    cdef CommitRecord record
+    try:
+        values = _read_many(shas, 'commit_data', False)
+    except KeyError:  # relation is not available on this host
+        values = [None] * len(shas)
+    result = [value and _parse_commit_data(value) for value in values]
+
+    missing = [i for i, value in enumerate(result) if value is None]
+    cache = OBJECT_CACHE
+    raw = {}
+    if cache is not None:
+        # every lookup counts as a hit or a miss, so look up only once
+        for i in missing:
+            data = cache.get(('commit', shas[i]))
+            if data is not None:
+                raw[i] = data
+    fetch = [i for i in missing if i not in raw]
+    raw.update(zip(fetch, _decomp_many(_read_many(
+        [shas[i] for i in fetch], 'commit_random', False),
+        'commit_random', None)))
+    for i in missing:
+        data = raw[i]
+        if not data:
+            continue
+        record = _parse_commit(data, shas[i])
+        result[i] = (record.authored_ts, record.author_tz, record.author,
+                     record.tree_sha, record.parent_shas)
+    return result
+
+
+def _neighbors(ptr, idx, nodes):
+    """ Concatenated CSR rows `nodes` of a (ptr, idx) adjacency """
+    starts = ptr[nodes]
+    lengths = ptr[nodes + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return idx[:0]
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return idx[offsets + np.arange(total)]
+
+
+class CommitGraph(object):
+    """ Commit graph of a set of commits, usually a project, stored in
+    numpy arrays. It is built once, using batched reads of commit_data,
+    so that topology queries do not need to parse any commits.
+
+    Nodes are numbered in the order of SHAs passed to the constructor;
+    commits missing from the dataset or made by ignored authors are
+    skipped. Unlike `Project.__iter__`, commits that are only available
+    in commit_data (c2dat), but not in commit_random, are included.
+    Only edges between the nodes are kept.
+
+        >>> g = Project('user2589_minicms').graph  # doctest: +SKIP
+        >>> g.merge_base(sha1, sha2)  # doctest: +SKIP
+
+    Attributes:
+        shas (List[bytes]): binary SHAs of nodes
+        time (np.ndarray): int64 authored timestamps, -1 if invalid
+        root (np.ndarray): bool, True for commits without any parents
+        parent_ptr, parent_idx (np.ndarray): parents in CSR format, i.e.
+            parents of node `i` are `parent_idx[parent_ptr[i]:parent_ptr[i+1]]`
+            The first parent, if it is in the graph, always comes first.
+        child_ptr, child_idx (np.ndarray): children in CSR format
+        first_parent (np.ndarray): node of the first parent,
+            -1 if there is no parents or the parent is not in the graph
+        generation (np.ndarray): one plus the length of the longest path
+            to a root, i.e. 1 for roots; an ancestor always has a
+            smaller generation than its descendants
+    """
+
+    def __init__(self, shas):
+        if np is None:
+            raise ImportError('CommitGraph requires numpy')
+        shas = list(OrderedDict.fromkeys(Commit._to_key(sha) for sha in shas))
+        records = _commit_records(shas)
+        self.shas = []
+        self._index = {}  # type: Dict[bytes, int]
+        nodes = []
+        for bin_sha, record in zip(shas, records):
+            if record is not None and record[2] not in IGNORED_AUTHORS:
+                self._index[bin_sha] = len(self.shas)
+                self.shas.append(bin_sha)
+                nodes.append(record)
+
+        n = len(nodes)
+        # parent SHAs of nodes which are not in the graph
+        self._outside = {}  # type: Dict[int, bytes]
+        self.time = np.fromiter((r[0] for r in nodes), np.int64, n)
+        self.root = np.fromiter((not r[4] for r in nodes), np.bool_, n)
+        self.first_parent = np.full(n, -1, np.int32)
+        ptr = [0]
+        idx = []
+        for node, record in enumerate(nodes):
+            for i, parent_sha in enumerate(record[4]):
+                parent = self._index.get(parent_sha)
+                if parent is None:
+                    if i == 0:
+                        self._outside[node] = parent_sha
+                    continue
+                if i == 0:
+                    self.first_parent[node] = parent
+                idx.append(parent)
+            ptr.append(len(idx))
+        self.parent_ptr = np.array(ptr, np.int64)
+        self.parent_idx = np.array(idx, np.int32)
+
+        childs = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.parent_ptr))
+        order = np.argsort(self.parent_idx, kind='stable')
+        self.child_idx = childs[order]
+        self.child_ptr = np.zeros(n + 1, np.int64)
+        np.cumsum(np.bincount(self.parent_idx, minlength=n),
+                  out=self.child_ptr[1:])
+
+        # Kahn's algorithm, one level of the graph at a time
+        self.generation = np.zeros(n, np.int32)
+        pending = np.diff(self.parent_ptr)
+        frontier = np.flatnonzero(pending == 0)
+        level = 1
+        while frontier.size:
+            self.generation[frontier] = level
+            children = _neighbors(self.child_ptr, self.child_idx, frontier)
+            np.subtract.at(pending, children, 1)
+            children = np.unique(children)
+            frontier = children[pending[children] == 0]
+            level += 1
+
+    @classmethod
+    def from_project(cls, project):
+        """ Build the graph of all commits in a `Project` """
+        return cls(project.commit_shas)
+
+    def __len__(self):
+        return len(self.shas)
+
+    def __contains__(self, sha):
+        return Commit._to_key(sha) in self._index
+
+    def index(self, sha):
+        """ Get node number of a commit; raises KeyError if not in graph """
+        return self._index[Commit._to_key(sha)]
+
+    def _effective_time(self):
+        """ Authored time to order commits by.
+        Sometimes (very rarely) commit dates are wrong; dates earlier than
+        the earliest root commit are considered invalid, like in
+        `Project.commits`. Invalid dates are replaced with 0 """
+        time = self.time
+        roots = time[self.root & (time >= 0)]
+        min_time = max(int(roots.min()) if roots.size else 0, 0)
+        return np.where(time >= min_time, time, 0)
+
+    @property
+    def heads(self):
+        """ Nodes without children """
+        return np.flatnonzero(np.diff(self.child_ptr) == 0)
+
+    @property
+    def head(self):
+        """ Binary SHA of the latest commit without children """
+        heads = self.heads
+        if not heads.size:
+            return None
+        return self.shas[heads[np.argmax(self._effective_time()[heads])]]
+
+    @property
+    def latest(self):
+        """ Binary SHA of the latest commit """
+        if not self.shas:
+            return None
+        return self.shas[np.argmax(self._effective_time())]
+
+    @property
+    def tail(self):
+        """ Binary SHA of the first root commit which is a first parent
+        of some other commit """
+        targets = np.zeros(len(self.shas), np.bool_)
+        targets[self.first_parent[self.first_parent >= 0]] = True
+        candidates = np.flatnonzero(targets & self.root)
+        return self.shas[candidates[0]] if candidates.size else None
+
+    def parents(self, sha):
+        """ Binary SHAs of parents within the graph """
+        node = self.index(sha)
+        return tuple(self.shas[i] for i in self.parent_idx[
+            self.parent_ptr[node]:self.parent_ptr[node + 1]])
+
+    def children(self, sha):
+        """ Binary SHAs of children within the graph """
+        node = self.index(sha)
+        return tuple(self.shas[i] for i in self.child_idx[
+            self.child_ptr[node]:self.child_ptr[node + 1]])
+
+    def first_parent_of(self, sha):
+        """ Binary SHA of the first parent, even if it is not in the graph,
+        or None for root commits """
+        node = self.index(sha)
+        parent = self.first_parent[node]
+        if parent >= 0:
+            return self.shas[parent]
+        return self._outside.get(node)
+
+    def first_parent_chain(self, sha=None):
+        """ Binary SHAs of commits following first parents only, starting
+        from `sha` (the latest commit by default) until a root commit or
+        a commit which is not in the graph """
+        node = self.index(sha) if sha is not None else (
+            np.argmax(self._effective_time()) if self.shas else -1)
+        first_parent = self.first_parent
+        while node >= 0:
+            yield self.shas[node]
+            node = first_parent[node]
+
+    def _reachable(self, nodes):
+        """ Boolean mask of nodes reachable from `nodes` by parent links,
+        including `nodes` themselves """
+        mask = np.zeros(len(self.shas), np.bool_)
+        frontier = np.unique(np.asarray(nodes, np.int32))
+        mask[frontier] = True
+        while frontier.size:
+            frontier = _neighbors(self.parent_ptr, self.parent_idx, frontier)
+            frontier = np.unique(frontier[~mask[frontier]])
+            mask[frontier] = True
+        return mask
+
+    def ancestors(self, sha):
+        """ Binary SHAs of all ancestors of a commit within the graph """
+        node = self.index(sha)
+        mask = self._reachable([node])
+        mask[node] = False
+        return tuple(self.shas[i] for i in np.flatnonzero(mask))
+
+    def is_ancestor(self, ancestor, sha):
+        """ Check if `ancestor` is reachable from `sha` by parent links.
+        Like `git merge-base --is-ancestor`, a commit is its own ancestor """
+        a, b = self.index(ancestor), self.index(sha)
+        if self.generation[a] >= self.generation[b]:
+            return a == b
+        return bool(self._reachable([b])[a])
+
+    def merge_base(self, sha1, sha2):
+        """ Binary SHA of the best common ancestor of two commits,
+        i.e. the one with the highest generation, or None """
+        common = np.flatnonzero(self._reachable([self.index(sha1)])
+                                & self._reachable([self.index(sha2)]))
+        if not common.size:
+            return None
+        return self.shas[common[np.argmax(self.generation[common])]]
+
+
+_TIMELINE_FREQS = ('day', 'week', 'month')
+
+
+class Timeline(object):
+    """ Activity of a set of commits, e.g. of an author or a project,
+    stored in numpy arrays. It is built from batched reads of commit_data,
+    so none of the commits have to be decompressed or parsed in full.
+
+    Commits missing from the dataset are skipped; so are commits made by
+    ignored authors, unless `skip_ignored` is False.
+
+        >>> tl = Author('user2589 <valiev.m@gmail.com>').timeline()  # doctest: +SKIP
+        >>> weeks, counts = tl.counts('week')  # doctest: +SKIP
+
+    Attributes:
+        shas (List[bytes]): binary SHAs of commits
+        time (np.ndarray): int64 authored timestamps, -1 if invalid
+        tz (np.ndarray): int16 timezone offsets, in minutes
+        author (np.ndarray): int32 indexes in `authors`
+        authors (List[bytes]): distinct commit authors
+        parents (np.ndarray): int16 number of parents, e.g. 2+ for merges
+    """
+
+    def __init__(self, shas, skip_ignored=True):
+        if np is None:
+            raise ImportError('Timeline requires numpy')
+        shas = list(OrderedDict.fromkeys(Commit._to_key(sha) for sha in shas))
+        self.shas = []
+        self.authors = []
+        author_ids = {}  # type: Dict[bytes, int]
+        nodes = []
+        for bin_sha, record in zip(shas, _commit_records(shas)):
+            if record is None \
+                    or (skip_ignored and record[2] in IGNORED_AUTHORS):
+                continue
+            author_id = author_ids.get(record[2])
+            if author_id is None:
+                author_id = author_ids[record[2]] = len(self.authors)
+                self.authors.append(record[2])
+            self.shas.append(bin_sha)
+            nodes.append((record[0], record[1], author_id, len(record[4])))
+
+        n = len(nodes)
+        self.time = np.fromiter((r[0] for r in nodes), np.int64, n)
+        self.tz = np.fromiter((r[1] for r in nodes), np.int16, n)
+        self.author = np.fromiter((r[2] for r in nodes), np.int32, n)
+        self.parents = np.fromiter((r[3] for r in nodes), np.int16, n)
+
+    def __len__(self):
+        return len(self.shas)
+
+    def counts(self, freq='week', local=False, mask=None):
+        """ Number of commits per day, week (starting on Monday) or month.
+        Commits with invalid dates, including dates in the future, are not
+        counted.
+
+        Args:
+            freq (str): 'day', 'week' or 'month'
+            local (bool): bin by the local time of authors instead of UTC
+            mask (np.ndarray): bool, count only these commits, e.g.
+                `timeline.parents < 2` to exclude merges
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: datetime64 starts of consecutive
+                periods, from the first to the last active one,
+                and int64 commit counts, including zeros
+        """
+        if freq not in _TIMELINE_FREQS:
+            raise ValueError('freq must be one of %s' % (_TIMELINE_FREQS,))
+        valid = self.time >= 0
+        if mask is not None:
+            valid &= mask
+        time = self.time[valid]
+        if local:
+            time = time + self.tz[valid].astype(np.int64) * 60
+        days = time // 86400
+        if freq == 'day':
+            bins = days
+        elif freq == 'week':
+            # weeks start on Monday, and 1970-01-05 was 4 days after epoch
+            bins = (days - 4) // 7
+        else:
+            bins = days.astype('datetime64[D]').astype(
+                'datetime64[M]').astype(np.int64)
+        if not bins.size:
+            unit = 'datetime64[M]' if freq == 'month' else 'datetime64[D]'
+            return np.array([], unit), np.array([], np.int64)
+
+        first = bins.min()
+        counts = np.bincount(bins - first).astype(np.int64)
+        periods = np.arange(first, first + len(counts))
+        if freq == 'month':
+            return periods.astype('datetime64[M]'), counts
+        if freq == 'week':
+            periods = periods * 7 + 4
+        return periods.astype('datetime64[D]'), counts
+
+
+# data types Project history properties depend on, to key their memos
+_HISTORY_DTYPES = ('project_commits', 'commit_data', 'commit_random')
+
+
 class Project(_Base):
     """
     Projects are iterable:
@@ -1415,7 +4484,7 @@ class Project(_Base):
     _keys_registry_dtype = 'project_commits'
 
     def __init__(self, uri):
-        if isinstance(uri, str_type):
+        if isinstance(uri, str):
             uri = uri.encode('ascii')
         self.uri = uri
         super(Project, self).__init__(uri)
@@ -1442,13 +4511,17 @@ class Project(_Base):
     def __contains__(self, item):
         if isinstance(item, Commit):
             key = item.key
-        elif isinstance(item, bytes_type) and len(item) == 20:
+        elif isinstance(item, bytes) and len(item) == 20:
             key = item
-        elif isinstance(item, str_type) and len(item) == 40:
+        elif isinstance(item, str) and len(item) == 40:
             key = binascii.unhexlify(item)
         else:
             return False
-        return key in self.commit_shas
+        # use whichever of the two is already loaded
+        if np is None or (hasattr(self, '_commit_shas')
+                          and not hasattr(self, '_commit_sha_array')):
+            return key in self.commit_shas
+        return key in self.commit_sha_array
 
     @cached_property
     def commit_shas(self):
@@ -1459,8 +4532,17 @@ class Project(_Base):
         ('2dbcd43f077f2b5511cc107d63a0b9539a6aa2a7',
          '7572fc070c44f85e2a540f9a5a05a95d1dd2662d')
         """
+        if hasattr(self, '_commit_sha_array'):
+            return tuple(self._commit_sha_array)
         return slice20(self.read_tch('project_commits'))
 
+    @cached_property
+    def commit_sha_array(self):
+        """ Same as `commit_shas`, as a compact `ShaArray` (requires numpy) """
+        if hasattr(self, '_commit_shas'):
+            return ShaArray(b''.join(self._commit_shas))
+        return ShaArray(self.read_tch('project_commits'))
+
     @property
     def commits(self):
         """ A generator of all Commit objects in the project.
@@ -1486,14 +4568,40 @@ class Project(_Base):
             yield c
 
     @cached_property
+    def graph(self):
+        """ Commit graph of the project, see `CommitGraph`.
+        Requires numpy.
+
+        >>> g = Project('user2589_minicms').graph
+        >>> len(g) > 60
+        True
+        """
+        return CommitGraph.from_project(self)
+
+    def timeline(self):
+        """ Activity of the project, see `Timeline`. Requires numpy.
+
+        >>> weeks, counts = Project('user2589_minicms').timeline().counts()
+        >>> counts.sum() > 60
+        True
+        """
+        return Timeline(self.commit_shas)
+
+    @cached_property
+    @memoized(_HISTORY_DTYPES, dump=lambda c: c and c.bin_sha,
+              load=lambda sha: sha and Commit(sha))
     def head(self):
-        """ Get the HEAD commit of the repository
+        """ Get the HEAD commit of the repository.
+        It is kept in `MEMO`, if enabled.
 
         >>> Project('user2589_minicms').head
         <Commit: f2a7fcdc51450ab03cb364415f14e634fa69b62c>
         >>> Project('RoseTHERESA_SimpleCMS').head
         <Commit: a47afa002ccfd3e23920f323b172f78c5c970250>
         """
+        if np is not None:
+            sha = self.graph.head
+            return sha and Commit(sha)
         # Sometimes (very rarely) commit dates are wrong, so the latest commit
         # is not actually the head. The magic below is to account for this
         commits = {c.sha: c for c in self.commits}
@@ -1505,16 +4613,20 @@ class Project(_Base):
         # and continued with a separate chain of commits.
         # in this case, let's just use the latest one
         # actually, storing refs would make it much simpler
-        return sorted((commits[sha] for sha in heads),
-                      key=lambda c: c.authored_at or DAY_Z)[len(commits)-1]
+        return max((commits[sha] for sha in heads),
+                   key=lambda c: c.authored_at or DAY_Z)
 
     @cached_property
+    @memoized(_HISTORY_DTYPES)
     def tail(self):
-        """ Get the first commit SHA by following first parents
+        """ Get the first commit SHA by following first parents.
+        It is kept in `MEMO`, if enabled.
 
         >>> Project(b'user2589_minicms').tail
         '1e971a073f40d74a1e72e07c682e1cba0bae159b'
         """
+        if np is not None:
+            return self.graph.tail
         commits = {c.bin_sha: c for c in self.commits}
         pts = set(c.parent_shas[0] for c in commits.values() if c.parent_shas)
         for bin_sha, c in commits.items():
@@ -1522,10 +4634,13 @@ class Project(_Base):
                 return bin_sha
 
     @property
+    @memoized(_HISTORY_DTYPES, dump=lambda c: c.bin_sha, load=Commit,
+              iterator=True)
     def commits_fp(self):
         """ Get a commit chain by following only the first parent, to mimic
         https://git-scm.com/docs/git-log#git-log---first-parent .
-        Thus, you only get a small subset of the full commit tree:
+        Thus, you only get a small subset of the full commit tree.
+        Complete chains are kept in `MEMO`, if enabled:
 
         >>> p = Project(b'user2589_minicms')
         >>> set(c.sha for c in p.commits_fp).issubset(p.commit_shas)
@@ -1552,11 +4667,21 @@ class Project(_Base):
         #   simplified version (argmax): ~153 seconds
         #   self.head(): ~190 seconds
 
-        # at this point we know all commits are in the dataset
-        # (validated in __iter___)
-        result = []
-        commits = {c.sha: c for c in self.commits}
-        commit = max(commits.values(), key=lambda c: c.authored_at or DAY_Z)
+        commits = {}
+        if np is not None:
+            graph = self.graph
+            sha = None
+            for sha in graph.first_parent_chain():
+                yield Commit(sha)
+            # continue outside of the project, if the chain leaves it
+            first_parent = sha and graph.first_parent_of(sha)
+            commit = first_parent and Commit(first_parent)
+        else:
+            # at this point we know all commits are in the dataset
+            # (validated in __iter___)
+            commits = {c.bin_sha: c for c in self.commits}
+            commit = max(commits.values(),
+                         key=lambda c: c.authored_at or DAY_Z)
 
         while commit:
             try:  # here there is no guarantee commit is in the dataset
@@ -1607,7 +4732,7 @@ class File(_Base):
     _keys_registry_dtype = 'file_commits'
 
     def __init__(self, path):
-        if isinstance(path, str_type):
+        if isinstance(path, str):
             path = path.encode('utf8')
         self.path = path
         super(File, self).__init__(path)
@@ -1640,6 +4765,11 @@ class File(_Base):
         """
         return slice20(self.read_tch('file_commits'))
 
+    @cached_property
+    def commit_sha_array(self):
+        """ Same as `commit_shas`, as a compact `ShaArray` (requires numpy) """
+        return ShaArray(self.read_tch('file_commits'))
+
     @property
     def commits(self):
         """ All commits changing the file
@@ -1680,7 +4810,7 @@ class Author(_Base):
     _keys_registry_dtype = 'author_commits'
 
     def __init__(self, full_email):
-        if isinstance(full_email, str_type):
+        if isinstance(full_email, str):
             full_email = full_email.encode('utf8')
         self.full_email = full_email
         super(Author, self).__init__(full_email)
@@ -1701,6 +4831,11 @@ class Author(_Base):
         """
         return slice20(self.read_tch('author_commits'))
 
+    @cached_property
+    def commit_sha_array(self):
+        """ Same as `commit_shas`, as a compact `ShaArray` (requires numpy) """
+        return ShaArray(self.read_tch('author_commits'))
+
     @property
     def commits(self):
         """ A generator of all Commit objects authored by the Author
@@ -1714,6 +4849,16 @@ class Author(_Base):
         """
         return (Commit(sha) for sha in self.commit_shas)
 
+    def timeline(self):
+        """ Activity of the author, see `Timeline`. Requires numpy.
+        Unlike for projects, it is not affected by `IGNORED_AUTHORS`.
+
+        >>> tl = Author('user2589 <valiev.m@gmail.com>').timeline()
+        >>> len(tl.authors)
+        1
+        """
+        return Timeline(self.commit_shas, skip_ignored=False)
+
     @cached_property
     def file_names(self):
         data = decomp(self.read_tch('author_files'))
@@ -1735,23 +4880,640 @@ class Author(_Base):
     #     data = decomp(self.read_tch('author_trpath'))
     #     return tuple(path for path in (data and data.split(";")))
 
-# temporary data for local test
-# TODO: remove once commit parse
-#
-# c = Commit("1cc6f4418dcc09f64dcbb0410fec76ceaa5034ab")
-# c._data = b'tree 0a2def6627be9bf2f3c7c2a84eb1e2feb0e7c03e\n' \
-#           b'parent d55f5fb86e5892dd1673a9c6cf5e3fdff8c5d93b\n' \
-#           b'author AlecGoldstein123 <34690976+AlecGoldstein123@users.noreply.github.com> 1513882101 -0500\n' \
-#           b'committer GitHub <noreply@github.com> 1513882101 -0500\n' \
-#           b'gpgsig -----BEGIN PGP SIGNATURE-----\n' \
-#           b' \n' \
-#           b' wsBcBAABCAAQBQJaPAH1CRBK7hj4Ov3rIwAAdHIIACYBs+bTOv7clJSYr9NT0gbX\n' \
-#           b' zb4XeJJADvDISZUJChwebEENDue5+GX+dX03ILptRizVVnASwNZR30DENeJNcOpw\n' \
-#           b' WqXKho+AV0H0C91x8CIbICnDjdgGdcyKFBCWQ8lBV6BjiRwGXFKJU6dyt480lzs8\n' \
-#           b' Eu2PqpTg59Xr/msd4vTrQofSoRwu8kW8KXBWou6G1f9KVCoOXWvhRmiLngFupyPV\n' \
-#           b' 0jbNLOe6IQ37xrvvSULCiBmemeYfAJSUywMPIPFyUpzZc2+jKDOcxJeKrRxzmQM0\n' \
-#           b' XKeHQIqKSQOVPB/SB7i2Pnxf/UBObaa4kiFoDGHp5IjolgMC+4pFuF2mOE5pbcQ=\n' \
-#           b' =cWKt\n' \
-#           b' -----END PGP SIGNATURE-----\n' \
-#           b' \n\n' \
-#           b'Add files via upload'
+def _split_names(bytes value):
+    """ Decode a semicolon separated relation, e.g. commit_projects """
+    data = decomp(value)
+    return [name for name in (data and data.split(b';')) or []
+            if name and name != b'EMPTY']
+
+
+def _commit_authors(list keys):
+    """ Commit authors come from commit_data or full commits """
+    return [record and (record[2],) for record in _commit_records(keys)]
+
+
+def _commit_parents(list keys):
+    return [record and record[4] for record in _commit_records(keys)]
+
+
+# (source type, relation) -> (data type, decoder, target class)
+# data type None means the values are read by the decoder itself
+_HOPS = {
+    ('project', 'commits'): ('project_commits', slice20, Commit),
+    ('project', 'authors'): ('project_authors', _split_names, Author),
+    ('commit', 'projects'): ('commit_projects', _split_names, Project),
+    ('commit', 'children'): ('commit_children', slice20, Commit),
+    ('commit', 'files'): ('commit_files', _split_names, File),
+    ('commit', 'authors'): (None, _commit_authors, Author),
+    ('commit', 'parents'): (None, _commit_parents, Commit),
+    ('blob', 'commits'): ('blob_commits', slice20, Commit),
+    ('file', 'commits'): ('file_commits', slice20, Commit),
+    ('author', 'commits'): ('author_commits', slice20, Commit),
+    ('author', 'projects'): ('author_projects', _split_names, Project),
+    ('author', 'files'): ('author_files', _split_names, File),
+}
+
+
+class Query(object):
+    """ Lazy multi-hop relation query, e.g. projects of all commits
+    of an author:
+
+        >>> q = query(Author('user2589 <valiev.m@gmail.com>'))
+        >>> for project in q.commits().projects().distinct():  # doctest: +SKIP
+        ...     print(project.uri)
+
+    Every hop reads relations in batches: objects seen before are skipped,
+    and keys of a batch are grouped by shard, so each .tch file is visited
+    once per batch. Results are streamed; only one batch per hop is kept in
+    memory, so `limit()` or breaking out of the loop stops reading early.
+
+    Queries are immutable, i.e. every method returns a new query.
+    """
+
+    def __init__(self, objects, batch_size=4096, steps=()):
+        self.objects = objects
+        self.batch_size = batch_size
+        self.steps = steps
+
+    def _chain(self, *step):
+        return Query(self.objects, self.batch_size, self.steps + (step,))
+
+    def commits(self):
+        return self._chain('_hop', 'commits')
+
+    def projects(self):
+        return self._chain('_hop', 'projects')
+
+    def authors(self):
+        return self._chain('_hop', 'authors')
+
+    def files(self):
+        return self._chain('_hop', 'files')
+
+    def children(self):
+        return self._chain('_hop', 'children')
+
+    def parents(self):
+        return self._chain('_hop', 'parents')
+
+    def distinct(self):
+        """ Skip repeated objects """
+        return self._chain('_distinct', None)
+
+    def filter(self, func):
+        """ Keep only objects for which `func(obj)` is true """
+        return self._chain('_filter', func)
+
+    def limit(self, n):
+        """ Stop after `n` objects """
+        return self._chain('_limit', n)
+
+    def __iter__(self):
+        stream = iter(self.objects)
+        for method, arg in self.steps:
+            stream = getattr(self, method)(stream, arg)
+        return stream
+
+    def _batches(self, stream):
+        batch = []
+        for obj in stream:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _hop(self, stream, relation):
+        seen = set()
+        for batch in self._batches(stream):
+            groups = OrderedDict()  # type: Dict[Tuple[str, bool], list]
+            for obj in batch:
+                if (obj.type, obj.key) in seen:
+                    continue
+                seen.add((obj.type, obj.key))
+                groups.setdefault((obj.type, obj.use_fnv_keys), []
+                                  ).append(obj.key)
+
+            for (obj_type, use_fnv_keys), keys in groups.items():
+                try:
+                    dtype, decoder, target = _HOPS[(obj_type, relation)]
+                except KeyError:
+                    raise ValueError('%s objects have no %s relation' % (
+                        obj_type.capitalize(), relation))
+                if dtype is None:
+                    values = decoder(keys)
+                else:
+                    values = (value and decoder(value) for value in
+                              _read_many(keys, dtype, use_fnv_keys))
+                for value in values:
+                    for key in value or ():
+                        yield target(key)
+
+    def _distinct(self, stream, _):
+        seen = set()
+        for obj in stream:
+            if (obj.type, obj.key) not in seen:
+                seen.add((obj.type, obj.key))
+                yield obj
+
+    def _filter(self, stream, func):
+        return (obj for obj in stream if func(obj))
+
+    def _limit(self, stream, n):
+        if n <= 0:
+            return
+        for i, obj in enumerate(stream):
+            yield obj
+            if i + 1 >= n:
+                return
+
+
+def query(objects, batch_size=4096):
+    """ Start a relation query from an object or an iterable of objects,
+    see `Query` """
+    if isinstance(objects, _Base):
+        objects = (objects,)
+    return Query(objects, batch_size)
+
+
+def _fetch_commit_data(list shas):
+    """ Read and decompress many commits, see `AsyncLoader.commits()` """
+    return _decomp_many(
+        _read_many(shas, 'commit_random', False), 'commit_random', None)
+
+
+def _running_loop():
+    import asyncio
+    # get_running_loop is only available in Python 3.7+
+    return getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+
+
+class AsyncLoader(object):
+    """ asyncio interface to load objects without blocking the event loop.
+    Use the module level instance, `oscar.aio`:
+
+        >>> commit = await aio.load(Commit(sha))  # doctest: +SKIP
+        >>> commit.author  # doctest: +SKIP
+        >>> data = await aio.blob_data(blob_sha)  # doctest: +SKIP
+        >>> async for commit in aio.commits(Project(uri)):  # doctest: +SKIP
+        ...     print(commit.author)
+
+    Blocking reads run in thread pools, one per storage tier, so that slow
+    HDD reads of blob content do not starve random access to .tch files on
+    SSD. Concurrent requests for the same value share a single read.
+
+    Args:
+        ssd_workers (int): max concurrent reads of .tch files
+        hdd_workers (int): max concurrent reads of blob content
+        batch_size (int): number of commits read at once by `commits()`
+    """
+    # attributes loaded by `load()` for relation objects
+    relations = {
+        'project': ('commit_shas',),
+        'author': ('commit_shas',),
+        'file': ('commit_shas',),
+    }
+
+    def __init__(self, ssd_workers=32, hdd_workers=4, batch_size=256):
+        self.workers = {'ssd': ssd_workers, 'hdd': hdd_workers}
+        self.batch_size = batch_size
+        self._executors = {}
+        self._pending = {}
+        self._lock = Lock()
+
+    def configure(self, ssd_workers=None, hdd_workers=None, batch_size=None):
+        """ Change concurrency limits; running reads are not affected """
+        if ssd_workers is not None:
+            self.workers['ssd'] = ssd_workers
+        if hdd_workers is not None:
+            self.workers['hdd'] = hdd_workers
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        """ Stop worker threads; they are restarted on the next request """
+        with self._lock:
+            executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=wait)
+
+    def _executor(self, tier):
+        with self._lock:
+            if tier not in self._executors:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executors[tier] = ThreadPoolExecutor(
+                    self.workers[tier], thread_name_prefix='oscar-' + tier)
+            return self._executors[tier]
+
+    async def _run(self, tier, key, func, *args):
+        """ Run func(*args) in the tier's executor; concurrent calls with
+        the same key, unless it is None, share the result """
+        import asyncio
+        loop = _running_loop()
+        if key is None:
+            return await loop.run_in_executor(self._executor(tier), func, *args)
+        key = (id(loop), tier) + key
+        future = self._pending.get(key)
+        if future is None:
+            future = loop.run_in_executor(self._executor(tier), func, *args)
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        # cancellation of one caller should not cancel the others
+        return await asyncio.shield(future)
+
+    async def _attr(self, tier, obj, attr):
+        """ Load a cached_property of obj in the executor """
+        value = await self._run(tier, (obj.type, obj.key, attr),
+                                getattr, obj, attr)
+        setattr(obj, '_' + attr, value)
+        return value
+
+    async def load(self, obj):
+        """ Load content of a git object, or the main relation of other
+        objects (e.g. `commit_shas` of a `Project`), so that accessing them
+        afterwards does not block. Returns the same object.
+        """
+        if obj.type == 'blob':
+            await self.blob_data(obj)
+        elif isinstance(obj, GitObject):
+            await self._attr('ssd', obj, 'data')
+            if obj.type == 'commit':
+                obj.author  # parse, it is cheap comparing to reading
+        else:
+            for attr in self.relations.get(obj.type, ()):
+                await self._attr('ssd', obj, attr)
+        return obj
+
+    async def read_tch(self, obj, dtype):
+        """ Non-blocking `obj.read_tch(dtype)` """
+        return await self._run('ssd', (obj.type, obj.key, dtype),
+                               obj.read_tch, dtype)
+
+    async def blob_data(self, blob):
+        """ Get blob content by its SHA or `Blob` object.
+        The offset is read on the SSD tier, the content on the HDD tier """
+        if not isinstance(blob, Blob):
+            blob = Blob(blob)
+        await self._attr('ssd', blob, 'position')
+        return await self._attr('hdd', blob, 'data')
+
+    async def commits(self, project):
+        """ Async generator of commits of a `Project`, same as iterating
+        the project. Commits are read in batches, prefetching the next batch
+        while the current one is consumed. """
+        import asyncio
+        shas = await self._attr('ssd', project, 'commit_shas')
+        batches = [list(shas[i:i + self.batch_size])
+                   for i in range(0, len(shas), self.batch_size)]
+        future = None
+        for i, batch in enumerate(batches):
+            if future is None:
+                future = asyncio.ensure_future(
+                    self._run('ssd', None, _fetch_commit_data, batch))
+            values = await future
+            future = None
+            if i + 1 < len(batches):
+                future = asyncio.ensure_future(self._run(
+                    'ssd', None, _fetch_commit_data, batches[i + 1]))
+            try:
+                for sha, data in zip(batch, values):
+                    if data is None:
+                        continue
+                    commit = Commit(sha)
+                    commit._data = data
+                    if commit.author not in IGNORED_AUTHORS:
+                        yield commit
+            except BaseException:  # e.g. the consumer stopped early
+                if future is not None:
+                    future.cancel()
+                raise
+
+
+aio = AsyncLoader()
+
+
+def _recv_exact(sock, Py_ssize_t size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 ** 2))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# Messages are lists of Optional[bytes] fields. Unlike marshal or pickle,
+# decoding them can't produce anything else, whoever sent them
+def _send_msg(sock, fields):
+    parts = [struct.pack('>I', len(fields))]
+    for field in fields:
+        if field is None:
+            parts.append(struct.pack('>i', -1))
+        else:
+            parts.append(struct.pack('>i', len(field)))
+            parts.append(field)
+    data = b''.join(parts)
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def _recv_msg(sock):
+    cdef Py_ssize_t pos = 4, end, count, size
+    end, = struct.unpack('>I', _recv_exact(sock, 4))
+    data = _recv_exact(sock, end)
+    if end < 4:
+        raise ValueError('Malformed lookup message')
+    count, = struct.unpack_from('>I', data)
+    fields = []
+    for _ in range(count):
+        if pos + 4 > end:
+            raise ValueError('Malformed lookup message')
+        size, = struct.unpack_from('>i', data, pos)
+        pos += 4
+        if size < 0:
+            fields.append(None)
+            continue
+        if pos + size > end:
+            raise ValueError('Malformed lookup message')
+        fields.append(data[pos:pos + size])
+        pos += size
+    return fields
+
+
+def _check_peer(sock):
+    """ Refuse to talk to processes of other users. The socket file is only
+    accessible to its owner, but it might have been created by someone else
+    before the server started """
+    if not hasattr(socket, 'SO_PEERCRED'):  # Linux only
+        return
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    if uid != os.getuid():
+        raise OSError('Lookup socket peer belongs to another user (uid %d)'
+                      % uid)
+
+
+# the server reads data directly even if the client is enabled in its process
+_SERVER_THREAD = threading.local()
+_LOOKUP_CLIENT = None  # type: LookupClient
+
+
+cdef _lookup_client():
+    client = _LOOKUP_CLIENT
+    if client is None or getattr(_SERVER_THREAD, 'active', False):
+        return None
+    return client
+
+
+class LookupServer(object):
+    """ A local server owning .tch handles, blob files and an LRU cache,
+    shared by worker processes over a unix socket. Usually started by
+    `serve()`; clients are enabled by `use_lookup_server()`.
+
+    Requests of concurrent clients are collected for `window` seconds,
+    merged, deduplicated and read in shard-grouped batches.
+
+    The socket is only accessible to the user running the server, and
+    connections of other users (e.g. root) are refused.
+
+    Args:
+        path (str): unix socket path
+        cache_size (int): LRU cache capacity, in bytes
+        window (float): time to wait for more requests to batch, seconds
+        workers (int): number of threads to read shards of a batch
+    """
+
+    def __init__(self, path, cache_size=256 * 1024 ** 2, window=0.0005,
+                 workers=8):
+        self.path = path
+        self.cache = LRUCache(cache_size)
+        self.window = window
+        self.workers = workers
+        self.batches = 0  # number of batch reads, for monitoring
+        self._queue = queue.Queue()
+        self._socket = None
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        # nobody can connect before listen(), so there is no race
+        os.chmod(self.path, 0o600)
+        self._socket.listen(128)
+        batcher = threading.Thread(target=self._batch_loop)
+        batcher.daemon = True
+        batcher.start()
+        try:
+            while True:
+                try:
+                    conn, _ = self._socket.accept()
+                except (OSError, socket.error):  # closed by shutdown()
+                    break
+                handler = threading.Thread(target=self._handle, args=(conn,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            self._queue.put(None)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def shutdown(self):
+        if self._socket is not None:
+            self._socket.shutdown(socket.SHUT_RDWR)
+            self._socket.close()
+
+    def _handle(self, conn):
+        try:
+            _check_peer(conn)
+            while True:
+                request = _recv_msg(conn)
+                if len(request) < 2 or None in request:
+                    raise ValueError('Malformed lookup request')
+                dtype = request[0].decode('ascii')
+                use_fnv_keys = request[1] == b'\x01'
+                try:
+                    # the first field of a reply is the error name, if any
+                    reply = [None] + self.lookup(
+                        dtype, use_fnv_keys, request[2:])
+                except Exception as e:
+                    reply = [type(e).__name__.encode('ascii'),
+                             str(e).encode('utf8', 'replace')]
+                _send_msg(conn, reply)
+        except (EOFError, OSError, socket.error, ValueError, struct.error):
+            pass
+        finally:
+            conn.close()
+
+    def lookup(self, dtype, use_fnv_keys, keys):
+        """ Get values of keys, from the cache or from a batched read.
+        `dtype` 'blob_data' means blob content. """
+        cache = self.cache
+        res = [cache.get((dtype, key)) for key in keys]
+        missing = [key for key, value in zip(keys, res) if value is None]
+        if missing:
+            request = [dtype, use_fnv_keys, missing, threading.Event(), None]
+            self._queue.put(request)
+            request[3].wait()
+            if isinstance(request[4], Exception):
+                raise request[4]
+            values = request[4]
+            res = [values.get(key) if value is None else value
+                   for key, value in zip(keys, res)]
+        return res
+
+    def _batch_loop(self):
+        _SERVER_THREAD.active = True
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            requests = [request]
+            deadline = _clock() + self.window
+            while True:
+                remaining = deadline - _clock()
+                try:
+                    request = (self._queue.get(timeout=remaining)
+                               if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                requests.append(request)
+
+            groups = OrderedDict()
+            for request in requests:
+                groups.setdefault((request[0], request[1]), OrderedDict()
+                                  ).update((key, None) for key in request[2])
+            results = {}
+            for (dtype, use_fnv_keys), keys in groups.items():
+                try:
+                    results[(dtype, use_fnv_keys)] = self._read(
+                        dtype, use_fnv_keys, list(keys))
+                except Exception as e:
+                    results[(dtype, use_fnv_keys)] = e
+            self.batches += 1
+            for request in requests:
+                request[4] = results[(request[0], request[1])]
+                request[3].set()
+
+    def _read(self, dtype, use_fnv_keys, keys):
+        if dtype == 'blob_data':
+            values = Blob.read_many(keys)
+        else:
+            values = _read_many(keys, dtype, use_fnv_keys, self.workers)
+        res = {}
+        for key, value in zip(keys, values):
+            if value is not None:
+                self.cache.put((dtype, key), value)
+                res[key] = value
+        return res
+
+
+class LookupClient(object):
+    """ Client of a `LookupServer`. Connections are per thread and
+    are re-established after fork.
+    Requests taking longer than `timeout` seconds fail with IOError """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        # connections of all threads, to close them
+        self._connections = set()
+        self._lock = Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.fileno() < 0 \
+                or self._local.pid != os.getpid():
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.settimeout(self.timeout)
+            try:
+                conn.connect(self.path)
+                _check_peer(conn)
+            except (OSError, socket.error):
+                conn.close()
+                raise
+            with self._lock:
+                self._connections.add(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _drop(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+        conn.close()
+
+    def close(self):
+        """ Close connections of all threads; they are re-established
+        on the next request """
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def get_many(self, dtype, keys, use_fnv_keys=False):
+        """ Same as `_read_many()`, but served by the lookup server """
+        keys = list(keys)
+        conn = None
+        try:
+            conn = self._connection()
+            _send_msg(conn, [dtype.encode('ascii'),
+                             b'\x01' if use_fnv_keys else b'\x00'] + keys)
+            reply = _recv_msg(conn)
+            if not reply:
+                raise ValueError('Malformed lookup reply')
+        except (EOFError, OSError, socket.error, ValueError,
+                struct.error) as e:
+            if conn is not None:
+                self._drop(conn)
+            self._local.conn = None
+            raise IOError('Lookup server at %s is not available: %s'
+                          % (self.path, e))
+        error = reply[0]
+        if error is not None:
+            message = b''.join(reply[1:]).decode('utf8', 'replace')
+            if error == b'KeyError':
+                raise KeyError(message)
+            raise IOError('Lookup server failed: %s: %s'
+                          % (error.decode('ascii', 'replace'), message))
+        if len(reply) != len(keys) + 1:
+            raise IOError('Lookup server returned %d values for %d keys'
+                          % (len(reply) - 1, len(keys)))
+        return reply[1:]
+
+    def get(self, dtype, key, use_fnv_keys=False):
+        return self.get_many(dtype, [key], use_fnv_keys)[0]
+
+
+def use_lookup_server(path, timeout=60.0):
+    """ Read data through a `LookupServer` listening at `path`, instead of
+    opening files in this process. `None` disables it.
+    It is enabled on import if OSCAR_LOOKUP_SOCKET is set. """
+    global _LOOKUP_CLIENT
+    if _LOOKUP_CLIENT is not None:
+        _LOOKUP_CLIENT.close()
+    _LOOKUP_CLIENT = path and LookupClient(path, timeout)
+
+
+def serve(path, cache_size=256 * 1024 ** 2, window=0.0005, workers=8):
+    """ Run a `LookupServer` until interrupted, e.g.:
+
+        $ python -c "import oscar; oscar.serve('/tmp/oscar.sock')" &
+        $ export OSCAR_LOOKUP_SOCKET=/tmp/oscar.sock
+    """
+    server = LookupServer(path, cache_size, window, workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if os.environ.get('OSCAR_LOOKUP_SOCKET'):
+    use_lookup_server(os.environ['OSCAR_LOOKUP_SOCKET'])
@@ -0,0 +1,167 @@
+#!python3
+"""
+Benchmarks of the hot paths, on a synthetic dataset generated by
+tests/fixtures/generate_fixtures.py. The same parameters always produce
+the same data, so timings are comparable across runs and commits:
+
+    PYTHONPATH=. python tests/benchmark.py --json before.json
+    # ... change something, make build
+    PYTHONPATH=. python tests/benchmark.py --compare before.json
+
+Every benchmark is timed several times; the best time is reported as the
+most stable estimate, along with the median. With `--compare`, the exit code
+is 1 if any benchmark got slower than `--threshold`.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'fixtures'))
+import generate_fixtures  # sets OSCAR_TEST, has to be imported before oscar
+
+import oscar
+
+
+def benchmarks(samples):
+    """ Get {name: (function, number of operations per call)} """
+    import pyximport
+    pyximport.install(inplace=True, language_level='3str')
+    import benchmark_cy
+
+    commits = [oscar.Commit(sha) for sha in samples['commit'][:200]]
+    trees = [oscar.Tree(sha) for sha in samples['tree'][:200]]
+    commit_data = [c.data for c in commits]
+    raw_commits = [c.read_tch('commit_random') for c in commits]
+    offsets = [oscar.Blob(sha).read_tch('blob_offset')
+               for sha in samples['blob'][:200]]
+    pairs = [(c, oscar.Commit(c.parent_shas[0]))
+             for c in commits if c.parent_shas][:20]
+    key = commits[0].bin_sha
+    db = oscar._get_tch(commits[0].resolve_path('commit_random').encode())
+    keys = [c.bin_sha for c in commits if c.resolve_path('commit_random')
+            == commits[0].resolve_path('commit_random')]
+
+    def parse_commits():
+        for data in commit_data:
+            c = oscar.Commit(key)
+            c._data = data
+            c.author  # parses the commit
+
+    def parse_trees():
+        for tree in trees:
+            tuple(iter(tree))
+
+    def traverse():
+        for tree in trees[:20]:
+            tuple(oscar.Tree(tree.bin_sha).traverse())
+
+    def diff():
+        for commit, parent in pairs:
+            tuple(oscar.Commit(commit.bin_sha) - parent)
+
+    def heads():
+        for uri in samples['project']:
+            oscar.Project(uri).head
+
+    def decomp():
+        for raw in raw_commits:
+            oscar.decomp(raw)
+
+    def hash_read():
+        for k in keys:
+            db[k]
+
+    return {
+        'unber': (lambda: benchmark_cy.unber(offsets[0], 1000), 1000),
+        'lzf_length': (
+            lambda: benchmark_cy.lzf_length(raw_commits[0], 1000), 1000),
+        'fnvhash': (lambda: benchmark_cy.fnvhash(
+            b'user2589_minicms', 1000), 1000),
+        'decomp': (decomp, len(raw_commits)),
+        'Hash.read': (hash_read, len(keys)),
+        'Tree.__iter__': (parse_trees, len(trees)),
+        'Tree.traverse': (traverse, len(trees[:20])),
+        'Commit._parse': (parse_commits, len(commit_data)),
+        'Commit.__sub__': (diff, len(pairs)),
+        'Project.head': (heads, len(samples['project'])),
+    }
+
+
+def measure(func, ops, repeat):
+    """ Get (best, median) time of one operation, in microseconds """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = sorted(t / number / ops * 1e6
+                   for t in timer.repeat(repeat=repeat, number=number))
+    return times[0], times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--data', help='directory of a generated dataset; '
+                        'by default, a temporary one is created')
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--commits', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('-k', dest='only', help='run only benchmarks '
+                        'containing this string')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='compare to results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown to report as a regression')
+    args = parser.parse_args()
+
+    tmpdir = None
+    data_dir = args.data
+    if data_dir is None:
+        data_dir = tmpdir = tempfile.mkdtemp(prefix='oscar_benchmark_')
+    try:
+        if not os.path.isfile(os.path.join(data_dir, 'samples.json')):
+            generate_fixtures.generate(data_dir, args.projects, args.commits)
+        # paths are resolved on the first use, so it is not too late
+        os.environ.update(generate_fixtures.env(data_dir))
+        with open(os.path.join(data_dir, 'samples.json')) as fh:
+            samples = json.load(fh)
+
+        baseline = {}
+        if args.compare:
+            with open(args.compare) as fh:
+                baseline = json.load(fh)
+
+        results = {}
+        regressions = []
+        print('%-16s %12s %12s %10s' % ('benchmark', 'best, us', 'median, us',
+                                        'vs base'))
+        for name, (func, ops) in benchmarks(samples).items():
+            if args.only and args.only not in name:
+                continue
+            func()  # warm up caches and handle pools
+            best, median = measure(func, ops, args.repeat)
+            results[name] = {'best': best, 'median': median}
+            ratio = ''
+            if name in baseline:
+                change = best / baseline[name]['best'] - 1
+                ratio = '%+.1f%%' % (change * 100)
+                if change > args.threshold:
+                    regressions.append(name)
+            print('%-16s %12.3f %12.3f %10s' % (name, best, median, ratio))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=1, sort_keys=True)
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+# cython: language_level=3str
+"""
+Loops over C-level functions of oscar for tests/benchmark.py; these functions
+are not accessible from Python code, and Python-level loop overhead would
+dominate their timings anyway.
+"""
+
+cimport oscar
+
+
+def unber(bytes buf, int number):
+    for _ in range(number):
+        oscar.unber(buf)
+
+
+def lzf_length(bytes raw_data, int number):
+    for _ in range(number):
+        oscar.lzf_length(raw_data)
+
+
+def fnvhash(bytes data, int number):
+    for _ in range(number):
+        oscar.fnvhash(data)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic OSCAR dataset for local testing and benchmarks.
+
+Unlike create_fixtures.py, it needs neither production data nor the Py2-only
+tokyocabinet bindings: .tch files are written by `oscar.Hash`, i.e. through
+the bundled lib/tchdb.c, so oscar has to be built first (`make build`).
+
+Projects are linear histories with occasional merges of short side
+branches; every commit changes a few files in a nested directory layout.
+All objects are valid git objects, i.e. SHAs match the content.
+
+    python tests/fixtures/generate_fixtures.py /tmp/oscar_data --projects 20
+    source /tmp/oscar_data/oscar.env
+
+`oscar.env` points OSCAR_* variables to the generated data;
+`samples.json` lists keys of the generated objects, e.g. for benchmarks.
+"""
+
+import os
+# oscar refuses to import outside of the cluster unless in test mode
+os.environ.setdefault('OSCAR_TEST', '1')
+
+import argparse
+import binascii
+from collections import defaultdict
+import hashlib
+import json
+import random
+import struct
+
+import lzf
+
+from oscar import Hash
+
+# relations version suffix, e.g. c2pFullR.0.tch
+VERSION = 'R'
+TIMEZONES = (b'+0000', b'-0400', b'-0700', b'+0100', b'+0530', b'+1100')
+WORDS = (b'import', b'return', b'self', b'data', b'value', b'def', b'class',
+         b'for', b'in', b'if', b'else', b'None', b'True', b'print', b'key')
+
+
+def ber(*numbers):
+    """ Perl BER packing, the reverse of `oscar.unber` """
+    res = bytearray()
+    for num in numbers:
+        chunk = [num & 0x7f]
+        num >>= 7
+        while num:
+            chunk.append(0x80 | (num & 0x7f))
+            num >>= 7
+        res.extend(reversed(chunk))
+    return bytes(res)
+
+
+def comp(data):
+    """ Perl Compress::LZF compression, the reverse of `oscar.decomp`.
+    The header is the uncompressed length, encoded like UTF-8 """
+    if not data:
+        return b''
+    compressed = lzf.compress(data)
+    if compressed is None:  # incompressible
+        return b'\x00' + data
+    usize = len(data)
+    if usize < 0x80:
+        return struct.pack('B', usize) + compressed
+    length = 2
+    while usize >= 1 << (5 * length + 1):
+        length += 1
+    header = [(0xff << (8 - length)) & 0xff | usize >> (6 * (length - 1))]
+    header.extend(0x80 | ((usize >> (6 * i)) & 0x3f)
+                  for i in range(length - 2, -1, -1))
+    return bytes(header) + compressed
+
+
+def fnvhash(data):
+    """ 32 bit FNV-1a, same as `oscar.fnvhash` """
+    hval = 0x811c9dc5
+    for b in bytearray(data):
+        hval = ((hval ^ b) * 0x01000193) & 0xffffffff
+    return hval
+
+
+def git_sha(obj_type, data):
+    return hashlib.sha1(b'%s %d\x00%s' % (obj_type, len(data), data)).digest()
+
+
+class ShardedHash(object):
+    """ A set of .tch files sharded the same way oscar reads them """
+
+    def __init__(self, path_template, key_length, use_fnv_keys,
+                 buckets=4093):
+        self.path_template = path_template
+        self.key_length = key_length
+        self.use_fnv_keys = use_fnv_keys
+        self.buckets = buckets
+        self.dbs = {}
+
+    def shard(self, key):
+        if self.use_fnv_keys:
+            prefix = fnvhash(key) & 0xff
+        else:
+            prefix = bytearray(key)[0]
+        return prefix & ((1 << self.key_length) - 1)
+
+    def db(self, prefix):
+        if prefix not in self.dbs:
+            path = self.path_template.format(key=prefix)
+            self.dbs[prefix] = Hash(path.encode('utf8'), writer=True,
+                                    buckets=self.buckets)
+        return self.dbs[prefix]
+
+    def __setitem__(self, key, value):
+        self.db(self.shard(key)).put(key, value)
+
+    def close(self):
+        # every shard has to exist for oscar to detect the key length
+        for prefix in range(1 << self.key_length):
+            self.db(prefix).close()
+
+
+class ShardedBin(object):
+    """ Sequential .bin/.idx files, plus optional offsets in a .tch """
+
+    def __init__(self, path_template, key_length, offsets=None):
+        self.path_template = path_template
+        self.key_length = key_length
+        self.offsets = offsets
+        self.files = {}
+
+    def append(self, bin_sha, data):
+        prefix = bytearray(bin_sha)[0] & ((1 << self.key_length) - 1)
+        if prefix not in self.files:
+            path = self.path_template.format(key=prefix)
+            self.files[prefix] = [open(path + '.bin', 'wb'),
+                                  open(path + '.idx', 'w'), 0, 0]
+        bin_fh, idx_fh, count, offset = self.files[prefix]
+        raw = comp(data)
+        bin_fh.write(raw)
+        idx_fh.write('%d;%d;%d;%s\n' % (
+            count, offset, len(raw), binascii.hexlify(bin_sha).decode()))
+        if self.offsets is not None:
+            self.offsets[bin_sha] = ber(offset, len(raw))
+        self.files[prefix][2:] = [count + 1, offset + len(raw)]
+
+    def close(self):
+        for prefix in range(1 << self.key_length):
+            if prefix not in self.files:
+                path = self.path_template.format(key=prefix)
+                open(path + '.bin', 'wb').close()
+                open(path + '.idx', 'w').close()
+                continue
+            self.files[prefix][0].close()
+            self.files[prefix][1].close()
+        if self.offsets is not None:
+            self.offsets.close()
+
+
+def tree_data(entries):
+    """ Serialize {name: (mode, bin_sha)} in git order: directories are
+    compared as if they had a trailing slash """
+    def order(name):
+        return name + b'/' if entries[name][0] == b'40000' else name
+    return b''.join(b'%s %s\x00%s' % (entries[name][0], name, entries[name][1])
+                    for name in sorted(entries, key=order))
+
+
+class Generator(object):
+    def __init__(self, output_dir, seed=0, key_length=7,
+                 relation_key_length=5):
+        self.rnd = random.Random(seed)
+        self.dirs = {name: os.path.join(output_dir, name) for name in
+                     ('All.blobs', 'All.sha1c', 'All.sha1o', 'basemaps')}
+        for path in self.dirs.values():
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.key_length = key_length
+        self.relation_key_length = relation_key_length
+
+        sha1c, blobs = self.dirs['All.sha1c'], self.dirs['All.blobs']
+        self.commits = ShardedHash(
+            os.path.join(sha1c, 'commit_{key}.tch'), key_length, False)
+        self.trees = ShardedHash(
+            os.path.join(sha1c, 'tree_{key}.tch'), key_length, False)
+        self.commit_bin = ShardedBin(
+            os.path.join(blobs, 'commit_{key}'), key_length)
+        self.tree_bin = ShardedBin(
+            os.path.join(blobs, 'tree_{key}'), key_length)
+        self.blob_bin = ShardedBin(
+            os.path.join(blobs, 'blob_{key}'), key_length, ShardedHash(
+                os.path.join(self.dirs['All.sha1o'], 'sha1.blob_{key}.tch'),
+                key_length, False))
+
+        self.seen = set()
+        # relations: {dtype: {key: [values]}}
+        self.relations = defaultdict(lambda: defaultdict(list))
+        self.commit_data = {}
+        self.blob_first_author = {}
+        self.samples = defaultdict(list)
+
+    def put_object(self, obj_type, data):
+        bin_sha = git_sha(obj_type, data)
+        if bin_sha in self.seen:
+            return bin_sha
+        self.seen.add(bin_sha)
+        if obj_type == b'blob':
+            self.blob_bin.append(bin_sha, data)
+        elif obj_type == b'tree':
+            self.trees[bin_sha] = comp(data)
+            self.tree_bin.append(bin_sha, data)
+        else:
+            self.commits[bin_sha] = comp(data)
+            self.commit_bin.append(bin_sha, data)
+        self.samples[obj_type.decode()].append(
+            binascii.hexlify(bin_sha).decode())
+        return bin_sha
+
+    def blob(self, lines):
+        return b''.join(b' '.join(self.rnd.choice(WORDS) for _ in range(
+            self.rnd.randint(1, 8))) + b'\n' for _ in range(lines))
+
+    def put_tree(self, files):
+        """ Write trees for {path: blob_sha}, return the root tree SHA """
+        subdirs = defaultdict(dict)
+        entries = {}
+        for path, blob_sha in files.items():
+            if b'/' in path:
+                dirname, rest = path.split(b'/', 1)
+                subdirs[dirname][rest] = blob_sha
+            else:
+                entries[path] = (b'100644', blob_sha)
+        for dirname, subfiles in subdirs.items():
+            entries[dirname] = (b'40000', self.put_tree(subfiles))
+        return self.put_object(b'tree', tree_data(entries))
+
+    def put_commit(self, files, parents, author, ts, message):
+        tree_sha = self.put_tree(files)
+        tz = self.rnd.choice(TIMEZONES)
+        data = b''.join(
+            [b'tree %s\n' % binascii.hexlify(tree_sha)]
+            + [b'parent %s\n' % binascii.hexlify(p) for p in parents]
+            + [b'author %s %d %s\n' % (author, ts, tz),
+               b'committer %s %d %s\n\n%s\n' % (author, ts, tz, message)])
+        bin_sha = self.put_object(b'commit', data)
+        self.commit_data[bin_sha] = b'%d;%s;%s;%s;%s' % (
+            ts, tz, author, binascii.hexlify(tree_sha),
+            b':'.join(binascii.hexlify(p) for p in parents))
+        for parent in parents:
+            self.relations['commit_children'][parent].append(bin_sha)
+        self.relations['author_commits'][author].append(bin_sha)
+        return bin_sha
+
+    def project(self, uri, authors, commits, files):
+        rnd = self.rnd
+        paths = [b'/'.join([b'pkg%d' % rnd.randint(0, 3)] * rnd.randint(0, 2)
+                           + [b'module%d.py' % i]) for i in range(files)]
+        state = {path: self.put_object(b'blob', self.blob(rnd.randint(5, 200)))
+                 for path in paths[:max(1, files // 2)]}
+        ts = 1300000000 + rnd.randint(0, 10 ** 8)
+        head, side = None, None
+        project_commits = []
+        for i in range(commits):
+            author = rnd.choice(authors)
+            ts += rnd.randint(60, 86400)
+            changed = rnd.sample(paths, min(len(paths), rnd.randint(1, 3)))
+            for path in changed:
+                state[path] = self.put_object(
+                    b'blob', self.blob(rnd.randint(5, 200)))
+            if not i:  # initial import adds all files
+                changed = list(state)
+            parents = [head] if head else []
+            if side is not None:  # merge the side branch
+                parents.append(side)
+                side = None
+            elif head and rnd.random() < 0.1:  # start a side branch
+                side = self.put_commit(
+                    dict(state), [head], author, ts - 30, b'side %d' % i)
+                project_commits.append(side)
+                self.changed(side, uri, author, ts - 30, changed, state)
+            head = self.put_commit(
+                dict(state), parents, author, ts, b'commit %d' % i)
+            project_commits.append(head)
+            self.changed(head, uri, author, ts, changed, state)
+        self.relations['project_commits'][uri] = project_commits
+        self.samples['project'].append(uri.decode())
+
+    def changed(self, commit_sha, uri, author, ts, paths, state):
+        rels = self.relations
+        rels['commit_projects'][commit_sha].append(uri)
+        rels['project_authors'][uri].append(author)
+        rels['author_projects'][author].append(uri)
+        for path in paths:
+            blob_sha = state[path]
+            rels['commit_files'][commit_sha].append(path)
+            rels['file_commits'][path].append(commit_sha)
+            rels['author_files'][author].append(path)
+            rels['blob_commits'][blob_sha].append(commit_sha)
+            if blob_sha not in self.blob_first_author:
+                self.blob_first_author[blob_sha] = (
+                    b'%d;%s;' % (ts, author) + commit_sha)
+
+    def write_relations(self):
+        # SHA lists are stored as raw concatenated binary SHAs,
+        # names are semicolon separated and compressed
+        formats = {
+            'commit_children': ('c2cc', False, b''.join),
+            'author_commits': ('a2c', True, b''.join),
+            'project_commits': ('p2c', True, b''.join),
+            'blob_commits': ('b2c', False, b''.join),
+            'file_commits': ('f2c', True, b''.join),
+            'commit_projects': ('c2p', False, lambda v: comp(b';'.join(v))),
+            'commit_files': ('c2f', False, lambda v: comp(b';'.join(v))),
+            'project_authors': ('p2a', True, lambda v: comp(b';'.join(v))),
+            'author_projects': ('a2p', True, lambda v: comp(b';'.join(v))),
+            'author_files': ('a2f', True, lambda v: comp(b';'.join(v))),
+        }
+        values = dict(self.relations)
+        values['commit_data'] = {k: [v] for k, v in self.commit_data.items()}
+        values['blob_first_author'] = {
+            k: [v] for k, v in self.blob_first_author.items()}
+        formats['commit_data'] = ('c2dat', False, b''.join)
+        formats['blob_first_author'] = ('b2fa', False, b''.join)
+
+        for dtype, (prefix, use_fnv_keys, encode) in formats.items():
+            db = ShardedHash(os.path.join(
+                self.dirs['basemaps'],
+                '%sFull%s.{key}.tch' % (prefix, VERSION)),
+                self.relation_key_length, use_fnv_keys)
+            for key, value in values.get(dtype, {}).items():
+                # keep the order, remove duplicates
+                db[key] = encode(list(dict.fromkeys(value)))
+            db.close()
+
+    def close(self, output_dir):
+        for storage in (self.commits, self.trees, self.commit_bin,
+                        self.tree_bin, self.blob_bin):
+            storage.close()
+        self.write_relations()
+        self.samples['author'] = [a.decode() for a in
+                                  self.relations['author_commits']]
+        self.samples['file'] = [f.decode() for f in
+                                self.relations['file_commits']]
+        with open(os.path.join(output_dir, 'samples.json'), 'w') as fh:
+            json.dump(self.samples, fh, indent=1, sort_keys=True)
+        with open(os.path.join(output_dir, 'oscar.env'), 'w') as fh:
+            fh.write('export OSCAR_TEST=1\n')
+            for var, name in (('OSCAR_ALL_BLOBS', 'All.blobs'),
+                              ('OSCAR_ALL_SHA1C', 'All.sha1c'),
+                              ('OSCAR_ALL_SHA1O', 'All.sha1o'),
+                              ('OSCAR_BASEMAPS', 'basemaps')):
+                fh.write('export %s="%s"\n' % (
+                    var, os.path.abspath(self.dirs[name])))
+
+
+def env(output_dir):
+    """ Get OSCAR_* variables pointing to a generated dataset """
+    res = {}
+    with open(os.path.join(output_dir, 'oscar.env')) as fh:
+        for line in fh:
+            name, value = line[len('export '):].strip().split('=', 1)
+            res[name] = value.strip('"')
+    return res
+
+
+def generate(output_dir, projects=10, commits=100, files=20, authors=None,
+             seed=0, key_length=7, relation_key_length=5):
+    """ Generate a dataset; the same parameters always produce the same data
+
+    Args:
+        output_dir (str): directory to write to
+        projects (int): number of projects
+        commits (int): number of commits per project, not counting
+            side branches
+        files (int): number of files per project
+        authors (int): size of the pool of authors, shared by all projects;
+            default is two per project
+        seed (int): random seed
+        key_length (int): number of bits used to shard git objects,
+            7 means 128 files
+        relation_key_length (int): number of bits to shard relations
+    """
+    gen = Generator(output_dir, seed, key_length, relation_key_length)
+    author_pool = [b'Author %d <author%d@example.com>' % (i, i)
+                   for i in range(authors or 2 * projects)]
+    for i in range(projects):
+        gen.project(b'user%d_project%d' % (i % 7, i),
+                    gen.rnd.sample(author_pool, min(3, len(author_pool))),
+                    commits, files)
+    gen.close(output_dir)
+    return env(output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--commits', type=int, default=100,
+                        help='number of commits per project')
+    parser.add_argument('--files', type=int, default=20,
+                        help='number of files per project')
+    parser.add_argument('--authors', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--key-length', type=int, default=7)
+    parser.add_argument('--relation-key-length', type=int, default=5)
+    args = parser.parse_args()
+    generate(args.output_dir, args.projects, args.commits, args.files,
+             args.authors, args.seed, args.key_length,
+             args.relation_key_length)
+
+
+if __name__ == '__main__':
+    main()
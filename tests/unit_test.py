@@ -7,6 +7,15 @@ Please refrain from checking integrity of the dataset.
 """
 from __future__ import unicode_literals
 
+import binascii
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import warnings
+
 # Cython caches compiled files, so even if the main file did change but the
 # test suite didn't, it won't recompile. More details in this SO answer:
 # https://stackoverflow.com/questions/42259741/
@@ -19,6 +28,8 @@ pyximport.install(
 )
 
 from oscar import *
+from oscar import _Base
+import oscar
 from unit_test_cy import *
 
 
@@ -42,6 +53,390 @@ class TestBasics(unittest.TestCase):
                          '2012-05-15 17:53:27 -1130')
         self.assertIsNone(parse_commit_date(b'3337145807', b'+1100'))
 
+    def test_sha_array(self):
+        # trailing null bytes are stripped by numpy 'S20', but not here
+        a, b, c = b'\x01' * 20, b'\x02' * 19 + b'\x00', b'\x03' * 20
+        shas = ShaArray(c + a + b)
+        self.assertEqual(len(shas), 3)
+        self.assertEqual(list(shas), [c, a, b])
+        self.assertEqual(shas[2], b)
+        self.assertIn(b, shas)
+        self.assertIn(binascii.hexlify(a).decode('ascii'), shas)
+        self.assertNotIn(b'\x02' * 20, shas)
+        self.assertNotIn('invalid', shas)
+        self.assertEqual(shas.hex()[1], '01' * 20)
+        self.assertEqual(list(shas.isin([a, b'\x04' * 20])),
+                         [False, True, False])
+        self.assertEqual(list(shas & ShaArray(b + b'\x04' * 20)), [b])
+        self.assertEqual(list(shas - [a, b]), [c])
+        self.assertEqual(len(shas | [b'\x04' * 20, a]), 4)
+        self.assertEqual(len(ShaArray(None)), 0)
+
+        p = Project(b'test_sha_array')
+        p._commit_sha_array = shas
+        self.assertIn(Commit(a), p)
+        self.assertNotIn(b'\x04' * 20, p)
+        self.assertEqual(p.commit_shas, (c, a, b))
+        # already loaded SHAs are reused instead of reading them again
+        p = Project(b'test_sha_array')
+        p._commit_shas = (c, a)
+        self.assertIn(a, p)
+        self.assertNotIn(b, p)
+        self.assertEqual(list(p.commit_sha_array), [c, a])
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        sha = u'f2a7fcdc51450ab03cb364415f14e634fa69b62c'
+        events = []
+        with Stats() as s:
+            s.add_callback(lambda *event: events.append(event))
+            self.assertTrue(s.enabled)
+            commit = Commit(sha)
+            commit.author
+            tuple(iter(commit.tree))
+            tree_shard = commit.tree._stats_shard('tree_random')
+        self.assertFalse(s.enabled)
+        Commit(sha).author  # not recorded anymore
+
+        counters = s.counters()
+        reads = counters[('read_tch', 'commit_random', 114)]
+        self.assertEqual(reads['count'], 1)
+        self.assertGreater(reads['bytes'], 0)
+        self.assertGreaterEqual(reads['time'], 0)
+        self.assertEqual(
+            counters[('hash_read', 'commit_random', 114)]['count'], 1)
+        self.assertEqual(
+            counters[('commit_parse', 'commit_random', 114)]['count'], 1)
+        self.assertEqual(
+            counters[('decomp', 'commit_random', 114)]['count'], 1)
+        self.assertIsInstance(tree_shard, int)
+        self.assertEqual(
+            counters[('tree_parse', 'tree_random', tree_shard)]['count'], 1)
+        self.assertEqual(
+            counters[('decomp', 'tree_random', tree_shard)]['count'], 1)
+        self.assertEqual(s.counters(by=('op',))[('decomp',)]['count'], 2)
+        self.assertEqual(len(events),
+                         sum(c['count'] for c in counters.values()))
+        s.reset()
+        self.assertEqual(s.counters(), {})
+        self.assertFalse(stats().enabled)
+
+
+class TestPaths(unittest.TestCase):
+    def test_registry(self):
+        tmpdir = tempfile.mkdtemp()
+        for key in (0, 31):
+            open(os.path.join(tmpdir, 'c2pFullU.%d.tch' % key), 'w').close()
+        # manifest is written to a different dir not to change data dir mtime
+        manifest_dir = tempfile.mkdtemp()
+        manifest_path = os.path.join(manifest_dir, 'manifest.json')
+        raw_paths = {'OSCAR_TEST_CATEGORY': (tmpdir, {
+            'commit_projects': 'c2pFull{ver}.{key}.tch',
+            'commit_files': 'c2fFull{ver}.{key}.tch',
+        })}
+        try:
+            paths = PathRegistry(raw_paths, manifest_path)
+            self.assertEqual(dict.__len__(paths), 0)  # nothing resolved yet
+            expected = (os.path.join(tmpdir, 'c2pFullU.{key}.tch'), 5)
+            self.assertEqual(paths['commit_projects'], expected)
+            self.assertEqual(paths.versions['commit_projects'], 'U')
+            self.assertNotIn('commit_files', paths)
+            self.assertRaises(KeyError, lambda: paths['commit_files'])
+
+            # another process would pick it up from the manifest
+            paths = PathRegistry(raw_paths, manifest_path)
+            self.assertEqual(paths._from_manifest('commit_projects')[:2],
+                             expected)
+            # ... unless the directory was modified
+            stat = os.stat(tmpdir)
+            os.utime(tmpdir, (stat.st_atime, stat.st_mtime + 10))
+            self.assertIsNone(paths._from_manifest('commit_projects'))
+            self.assertEqual(paths['commit_projects'], expected)
+            # ... or a shard was replaced in place
+            paths = PathRegistry(raw_paths, manifest_path)
+            self.assertIsNotNone(paths._from_manifest('commit_projects'))
+            shard = os.path.join(tmpdir, 'c2pFullU.0.tch')
+            stat = os.stat(shard)
+            os.utime(shard, (stat.st_atime, stat.st_mtime + 10))
+            self.assertIsNone(paths._from_manifest('commit_projects'))
+        finally:
+            shutil.rmtree(tmpdir)
+            shutil.rmtree(manifest_dir)
+
+    def test_manifest_fallback(self):
+        # data is found in the second location of the fallback chain
+        tmpdir = tempfile.mkdtemp()
+        primary, fallback = (os.path.join(tmpdir, name)
+                             for name in ('da5', 'da4'))
+        os.mkdir(primary)
+        os.mkdir(fallback)
+        for key in (0, 31):
+            open(os.path.join(fallback, 'c2pFullU.%d.tch' % key), 'w').close()
+        manifest_path = os.path.join(tmpdir, 'manifest.json')
+        raw_paths = {'OSCAR_TEST_CATEGORY': (primary, {
+            'commit_projects': 'c2pFull{ver}.{key}.tch'})}
+        try:
+            paths = PathRegistry(raw_paths, manifest_path)
+            self.assertEqual(paths['commit_projects'][0],
+                             os.path.join(fallback, 'c2pFullU.{key}.tch'))
+            paths = PathRegistry(raw_paths, manifest_path)
+            self.assertIsNotNone(paths._from_manifest('commit_projects'))
+            # a new version in the primary location takes precedence
+            for key in (0, 31):
+                open(os.path.join(primary, 'c2pFullV.%d.tch' % key),
+                     'w').close()
+            stat = os.stat(primary)
+            os.utime(primary, (stat.st_atime, stat.st_mtime + 10))
+            self.assertIsNone(paths._from_manifest('commit_projects'))
+            self.assertEqual(paths['commit_projects'][0],
+                             os.path.join(primary, 'c2pFullV.{key}.tch'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class _Replicated(_Base):
+    use_fnv_keys = False
+
+
+class TestReplicas(unittest.TestCase):
+    def test_routing(self):
+        dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        for tmpdir, value in zip(dirs, (b'A', b'B')):
+            for shard in (0, 1):
+                path = os.path.join(tmpdir, 'r%d.tch' % shard)
+                db = Hash(path.encode('ascii'), writer=True)
+                db[bytes([shard]) + b'key'] = value
+                db.close()
+        templates = [os.path.join(tmpdir, 'r{key}.tch') for tmpdir in dirs]
+        ROUTER.reset()
+        try:
+            # replicas are discovered from environment variables
+            raw_paths = {'OSCAR_TEST_REPLICATED': (dirs[0], {
+                'test_replicated': 'r{key}.tch'})}
+            os.environ['OSCAR_TEST_REPLICATED_REPLICAS'] = dirs[1]
+            try:
+                paths = PathRegistry(raw_paths)
+                self.assertEqual(paths.replicas('test_replicated'), templates)
+            finally:
+                del os.environ['OSCAR_TEST_REPLICATED_REPLICAS']
+
+            PATHS['test_replicated'] = (templates[0], 1)
+            PATHS.add_replica('test_replicated', templates[1])
+            prefix_length, locations, shard_paths = PATHS.routes(
+                'test_replicated')
+            self.assertEqual(locations, tuple(dirs))
+            self.assertEqual(shard_paths[1], tuple(
+                t.format(key=1).encode('ascii') for t in templates))
+
+            obj = _Replicated(b'\x00key')
+            self.assertEqual(obj.read_tch('test_replicated'), b'A')
+            # reads go to the replica with the lowest latency
+            ROUTER.observe(dirs[0], 1.0)
+            self.assertEqual(obj.read_tch('test_replicated'), b'B')
+            # path queries don't count as reads, which would trigger probes
+            reads = ROUTER._reads
+            self.assertEqual(obj.resolve_path('test_replicated'),
+                             templates[1].format(key=0))
+            self.assertEqual(ROUTER.best(locations), 1)
+            self.assertEqual(ROUTER._reads, reads)
+            self.assertIsNone(_Replicated(b'\x00missing').read_tch(
+                'test_replicated'))
+
+            # failover: the preferred replica of the shard 1 is gone
+            ROUTER.reset()
+            os.remove(templates[0].format(key=1))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.assertEqual(_Replicated(b'\x01key').read_tch(
+                    'test_replicated'), b'B')
+            self.assertTrue(ROUTER.status()[dirs[0]]['down'])
+            self.assertFalse(ROUTER.status()[dirs[1]]['down'])
+            # ... and is skipped for other shards as well
+            self.assertEqual(obj.read_tch('test_replicated'), b'B')
+            self.assertEqual(_Replicated.fetch_many(
+                [b'\x00key', b'\x01key'], 'test_replicated'), [b'B', b'B'])
+        finally:
+            del PATHS['test_replicated']
+            ROUTER.reset()
+            for tmpdir in dirs:
+                shutil.rmtree(tmpdir)
+
+
+class TestFilters(unittest.TestCase):
+    def test_bloom(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        keys = [os.urandom(20) for _ in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertEqual(bloom.count, 1000)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(os.urandom(20) in bloom for _ in range(10000))
+        self.assertLess(false_positives, 300)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.bloom')
+            bloom.dump(path, 12345)
+            loaded = BloomFilter.load(path)
+            self.assertEqual((loaded.count, loaded.source_size), (1000, 12345))
+            self.assertTrue(all(key in loaded for key in keys))
+            self.assertRaises(TypeError, loaded.add, b'key')
+            with open(path, 'r+b') as fh:
+                fh.truncate(100)
+            self.assertRaises(ValueError, BloomFilter.load, path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lookups(self):
+        tmpdir = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 'f{key}.tch')
+        for shard in (0, 1):
+            db = Hash(template.format(key=shard).encode('ascii'), writer=True)
+            for i in range(100):
+                db[bytes([shard, i])] = b'value'
+            db.close()
+        try:
+            PATHS['test_filtered'] = (template, 1)
+            results = dict(build_filters('test_filtered', processes=2))
+            self.assertEqual(results, {0: 100, 1: 100})
+            self.assertTrue(os.path.isfile(template.format(key=0) + '.bloom'))
+
+            with Stats() as s:
+                self.assertEqual(_Replicated(b'\x01\x05').read_tch(
+                    'test_filtered'), b'value')
+                self.assertIsNone(_Replicated(b'\x01missing').read_tch(
+                    'test_filtered'))
+                self.assertEqual(_Replicated.fetch_many(
+                    [b'\x00missing', b'\x00\x07'], 'test_filtered'),
+                    [None, b'value'])
+            # missing keys didn't touch .tch files
+            self.assertEqual(s.counters(by=('op',))[('hash_read',)]['count'], 2)
+            self.assertEqual(s.counters(by=('op',))[('hash_read',)]['bytes'], 10)
+        finally:
+            del PATHS['test_filtered']
+            shutil.rmtree(tmpdir)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(10)
+        cache.put('a', b'12345')
+        cache.put('b', b'12345')
+        self.assertEqual(cache.get('a'), b'12345')
+        cache.put('c', b'123')  # b is the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'123')
+        cache.put('d', b'12345678901')  # larger than capacity
+        self.assertIsNone(cache.get('d'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (2, 2, 1))
+        self.assertEqual((stats['count'], stats['size']), (2, 8))
+
+    def test_object_cache(self):
+        sha = u'd4ddbae978c9ec2dc3b7b3497c2086ecf7be7d9d'
+        cache = cache_objects(1024 ** 2)
+        try:
+            data = Tree(sha).data
+            self.assertEqual(Tree(sha).data, data)
+            stats = cache.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+            self.assertEqual(stats['size'], len(data))
+
+            # values which failed to decompress are not cached
+            class BrokenTree(Tree):
+                def read_tch(self, dtype):
+                    return b'\x01\x01ab'  # output is larger than declared
+
+            self.assertIsNone(BrokenTree(sha[::-1]).data)
+            self.assertEqual(cache.stats()['count'], 1)
+        finally:
+            cache_objects(0)
+
+
+class TestMemo(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'memo.db')
+
+    def tearDown(self):
+        use_memo(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_store(self):
+        memo = MemoStore(self.path, max_size=100)
+        key = memo.key('project.head', b'test_memo', ('V', None))
+        self.assertNotEqual(key, memo.key('project.head', b'test_memo',
+                                          ('W', None)))
+        self.assertIsNone(memo.get(key))
+        memo.put(key, (b'\x01' * 20, [1, None], {'a': 'b'}))
+        memo.put(b'other', object())  # not serializable, skipped
+        # persists between instances
+        self.assertEqual(MemoStore(self.path).get(key),
+                         [b'\x01' * 20, [1, None], {'a': 'b'}])
+        self.assertEqual(len(memo), 1)
+        # plain JSON is stored, never unpickled or unmarshalled
+        value, = memo._connect().execute('SELECT value FROM memo').fetchone()
+        self.assertEqual(json.loads(bytes(value).decode('utf8'))[0],
+                         {'$bytes': '01' * 20})
+
+        for i in range(10):
+            memo.put(b'key%d' % i, b'x' * 20)
+        self.assertGreater(memo.size, memo.max_size)
+        self.assertLessEqual(memo.compact(), 90)
+        self.assertLessEqual(memo.size, 90)
+        self.assertIsNone(memo.get(key))  # the oldest one is evicted
+        self.assertEqual(memo.get(b'key9'), b'x' * 20)
+        stats = memo.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertGreater(stats['evictions'], 0)
+        memo.clear()
+        self.assertEqual(len(memo), 0)
+
+    def test_use_memo(self):
+        self.assertIsInstance(use_memo(self.path), MemoStore)
+        for path in ('', None):
+            self.assertIsNone(use_memo(path))
+            self.assertIsNone(oscar.MEMO)
+
+    def test_project(self):
+        def commit(ts, *parents):
+            return b''.join(
+                [b'tree %s\n' % (b'01' * 20)]
+                + [b'parent %s\n' % binascii.hexlify(parent)
+                   for parent in parents]
+                + [b'author A <a@b.c> %d +0000\n' % ts,
+                   b'committer A <a@b.c> %d +0000\n\nmsg\n' % ts])
+
+        root, a, b = (bytes([ch]) * 20 for ch in range(0x60, 0x63))
+        memo = use_memo(self.path)
+        cache = cache_objects(1024 ** 2)
+        try:
+            cache.put(('commit', root), commit(100))
+            cache.put(('commit', a), commit(200, root))
+            cache.put(('commit', b), commit(300, a))
+            p = Project(b'test_memo')
+            p._commit_shas = (root, a, b)
+            self.assertEqual(p.head, Commit(b))
+            self.assertEqual(p.tail, root)
+            fp = p.commits_fp
+            self.assertEqual(next(fp), Commit(b))
+            fp.close()  # incomplete chains are not stored
+            self.assertEqual(len(memo), 2)
+            self.assertEqual([c.bin_sha for c in p.commits_fp], [b, a, root])
+        finally:
+            cache_objects(0)
+
+        # objects are not available anymore, only memos are
+        p = Project(b'test_memo')
+        p._commit_shas = ()
+        self.assertEqual(p.head, Commit(b))
+        self.assertEqual(p.tail, root)
+        self.assertEqual(list(p.commits_fp), [Commit(b), Commit(a),
+                                              Commit(root)])
+        self.assertEqual(memo.stats()['hits'], 3)
+
 
 class TestHash(unittest.TestCase):
     # libtokyocabinet is not thread-safe; you cannot have two open instances of
@@ -65,10 +460,179 @@ class TestHash(unittest.TestCase):
         keys = list(self.db)
         self.assertGreaterEqual(len(keys), 1000)
 
+        # batch reading, missing keys are reported as None
+        self.assertEqual(self.db.get_many([k, b'missing_key', k]),
+                         [b'\x00\x01\x02\x03', None, b'\x00\x01\x02\x03'])
+
+        # handles release their locks, which are limited to 1024 per process
+        del self.db
+        for _ in range(2000):
+            self.assertTrue(Hash(db_path).concurrent)
+
+        # writing
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.tch').encode('ascii')
+            db = Hash(path, writer=True)
+            db[b'key'] = b'value'
+            db.put(b'other', b'')
+            db.close()
+            db = Hash(path)
+            self.assertEqual(db.get_many([b'key', b'other', b'missing']),
+                             [b'value', b'', None])
+            db.close()
+
+            # handles inherited from a parent process fail loudly
+            db = Hash(path, writer=True)
+            db._detach()
+            self.assertRaises(IOError, db.put, b'key', b'value')
+            self.assertRaises(IOError, len, db)
+            self.assertRaises(IOError, getattr, db, 'file_size')
+            self.assertRaises(IOError, db.__getitem__, b'key')
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class _Scanned(_Base):
+    use_fnv_keys = False
+    _keys_registry_dtype = 'test_scan'
+
+
+class TestScan(unittest.TestCase):
+    def test_items(self):
+        tmpdir = tempfile.mkdtemp()
+        template = os.path.join(tmpdir, 's{key}.tch')
+        expected = {}
+        for shard in (0, 1):
+            db = Hash(template.format(key=shard).encode('ascii'), writer=True)
+            for i in range(50):
+                key = bytes([shard, i])
+                expected[key] = b''.join(bytes([i, j]) * 10 for j in range(i))
+                db[key] = expected[key]
+            db.close()
+        try:
+            PATHS['test_scan'] = (template, 1)
+            db = Hash(template.format(key=0).encode('ascii'))
+            self.assertEqual(dict(db.items(readahead=1024)),
+                             {k: v for k, v in expected.items() if k[0] == 0})
+            self.assertEqual(dict(db.items(readahead=0)),
+                             {k: v for k, v in expected.items() if k[0] == 0})
+            # interleaved iterations of the same handle don't interfere
+            items, keys = db.items(), iter(db)
+            pairs = [(next(items), next(keys)) for _ in range(50)]
+            self.assertEqual([item[0] for item, _ in pairs],
+                             [key for _, key in pairs])
+            self.assertEqual(len(set(key for _, key in pairs)), 50)
+            self.assertEqual(list(items) + list(keys), [])
+            db.close()
+
+            self.assertEqual(dict(_Scanned.all_items()), expected)
+            self.assertEqual(dict(_Scanned.all_items(
+                shards=[1], decoder=len)),
+                {k: len(v) for k, v in expected.items() if k[0] == 1})
+
+            objects = list(_Scanned.all(with_values=True))
+            self.assertEqual(len(objects), 100)
+            for obj in objects:
+                # pre-populated, no need to read the relation again
+                self.assertEqual(obj._commit_shas, slice20(expected[obj.key]))
+        finally:
+            del PATHS['test_scan']
+            TCH_POOL.clear()
+            shutil.rmtree(tmpdir)
+
+
+class TestHandlePool(unittest.TestCase):
+    def test_pool(self):
+        tmpdir = tempfile.mkdtemp()
+        paths = [os.path.join(tmpdir, 'h%d.tch' % i).encode('ascii')
+                 for i in range(3)]
+        for path in paths:
+            db = Hash(path, writer=True)
+            db[b'key'] = path
+            db.close()
+        capacity = TCH_POOL.capacity
+        try:
+            pool = HandlePool(capacity=2)
+            first = pool.get(paths[0])
+            self.assertIs(pool.get(paths[0]), first)
+            pool.get(paths[1])
+            pool.get(paths[0])  # paths[1] is the least recently used now
+            pool.get(paths[2])
+            self.assertEqual(len(pool), 2)
+            self.assertNotIn(paths[1], pool)
+            self.assertEqual(pool.stats()['evictions'], 1)
+            # evicted handles keep working until released
+            pool.get(paths[1])
+            self.assertNotIn(paths[0], pool)
+            self.assertEqual(first[b'key'], paths[0])
+            del first
+            pool.clear()
+
+            # forked children reopen files instead of sharing handles
+            self.assertEqual(TCH_POOL.get(paths[0])[b'key'], paths[0])
+            pid = os.fork()
+            if not pid:  # child
+                ok = paths[0] not in TCH_POOL \
+                    and TCH_POOL.get(paths[0])[b'key'] == paths[0]
+                os._exit(0 if ok else 1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+            self.assertEqual(TCH_POOL.get(paths[0])[b'key'], paths[0])
+
+            # handles inherited by a child release their pthread keys,
+            # which are limited to 1024 per process
+            paths = [os.path.join(tmpdir, 'k%d.tch' % i).encode('ascii')
+                     for i in range(600)]
+            for path in paths:
+                Hash(path, writer=True, buckets=1).close()
+            TCH_POOL.capacity = len(paths)
+            for path in paths:
+                TCH_POOL.get(path)
+            pid = os.fork()
+            if not pid:  # child
+                handles = [Hash(path) for path in paths]
+                os._exit(0 if all(h.concurrent for h in handles) else 1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(status, 0)
+        finally:
+            TCH_POOL.capacity = capacity
+            TCH_POOL.clear()
+            shutil.rmtree(tmpdir)
+
+
+class _RandomCommits(_Base):
+    # registry of all commits in the test environment
+    use_fnv_keys = False
+    _keys_registry_dtype = 'commit_random'
+
+
+def _count(objects):
+    return sum(1 for _ in objects)
+
 
 class TestBase(unittest.TestCase):
-    # there is nothing testable at this class right now
-    pass
+    def test_shards(self):
+        _, prefix_length = PATHS['commit_random']
+        shards = _RandomCommits.shards()
+        self.assertEqual(shards, list(range(2 ** prefix_length)))
+        parts = [_RandomCommits.shards(part=i, of=3) for i in range(3)]
+        self.assertEqual(sorted(sum(parts, [])), shards)
+        self.assertEqual(parts[1], _RandomCommits.shards(part=1, of=3))
+        self.assertRaises(ValueError, lambda: _RandomCommits.shards(3, 3))
+        self.assertRaises(ValueError, lambda: list(
+            _RandomCommits.all_keys(shards=[2 ** prefix_length])))
+
+    def test_partitioned_scan(self):
+        # f2a7fcdc... is in the shard 114
+        bin_sha = binascii.unhexlify(u'f2a7fcdc51450ab03cb364415f14e634fa69b62c')
+        self.assertIn(bin_sha, list(_RandomCommits.all_keys(shards=[114])))
+        self.assertIn(_RandomCommits(bin_sha),
+                      list(_RandomCommits.all(part=114, of=128)))
+        results = dict(_RandomCommits.map_shards(
+            _count, processes=2, shards=[99, 114]))
+        self.assertEqual(set(results), {99, 114})
+        self.assertGreater(results[114], 0)
 
 
 class TestBlob(unittest.TestCase):
@@ -85,6 +649,156 @@ class TestBlob(unittest.TestCase):
         sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
         self.assertEqual(len(Blob(sha)), 42)
 
+    def test_read_many(self):
+        content = b'*.egg-info/\ndist/\nbuild/\n*.pyc\n*.mo\n*.gz\n'
+        sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
+        missing_sha = u'8300000000000000000000000000000000000000'
+        self.assertEqual(Blob.read_many([sha, missing_sha, Blob(sha)]),
+                         [content, None, content])
+
+    def test_bin_mappings(self):
+        from oscar import _clear_bins, _get_bin
+        content = b'*.egg-info/\ndist/\nbuild/\n*.pyc\n*.mo\n*.gz\n'
+        sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
+        offset, length = Blob(sha).position
+        template, key_length = PATHS['blob_data']
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'blob_3.bin')
+        with open(template.format(key=3), 'rb') as fh:
+            data = fh.read()
+        ROUTER.reset()
+        try:
+            # an empty .bin (e.g. being regenerated) is like a missing one
+            open(path, 'wb').close()
+            self.assertRaises(IOError, _get_bin, path)
+            PATHS['blob_data'] = (os.path.join(tmpdir, 'blob_{key}.bin'),
+                                  key_length)
+            PATHS.add_replica('blob_data', template)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.assertEqual(Blob(sha).data, content)
+
+            # a mapping shorter than requested is stale and is mapped again
+            with open(path, 'wb') as fh:
+                fh.write(data[:offset + length - 1])
+            self.assertEqual(len(_get_bin(path)), offset + length - 1)
+            with open(path, 'wb') as fh:
+                fh.write(data)
+            self.assertEqual(len(_get_bin(path, offset + length)), len(data))
+            _clear_bins()
+            self.assertEqual(len(_get_bin(path)), len(data))
+        finally:
+            PATHS['blob_data'] = (template, key_length)
+            ROUTER.reset()
+            _clear_bins()
+            shutil.rmtree(tmpdir)
+
+    def test_all_with_data(self):
+        # sequential scan of .bin using an index file, as in /da5_data/All.blobs
+        sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
+        offset, length = Blob(sha).position
+        tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(tmpdir, 'blob_3.idx'), 'w') as fh:
+            fh.write('0;%d;%d;%s\n' % (offset, length, sha))
+        dtypes = ('blob_sequential_idx', 'blob_sequential_bin')
+        saved_paths = {dtype: PATHS.get(dtype) for dtype in dtypes}
+        try:
+            PATHS['blob_sequential_idx'] = (
+                os.path.join(tmpdir, 'blob_{key}.idx'), 7)
+            PATHS['blob_sequential_bin'] = (PATHS['blob_data'][0], 7)
+            blobs = list(Blob.all(shards=[3], with_data=True))
+        finally:
+            for dtype, path in saved_paths.items():
+                if path is None:
+                    del PATHS[dtype]
+                else:
+                    PATHS[dtype] = path
+            shutil.rmtree(tmpdir)
+        self.assertEqual(blobs, [Blob(sha)])
+        # content is already populated from the sequential file
+        self.assertEqual(blobs[0]._data,
+                         b'*.egg-info/\ndist/\nbuild/\n*.pyc\n*.mo\n*.gz\n')
+
+    def test_scan_directory(self):
+        sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
+        commit = u'f2a7fcdc51450ab03cb364415f14e634fa69b62c'
+        tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmpdir, 'src', '.git'))
+        files = {
+            'gitignore': b'*.egg-info/\ndist/\nbuild/\n*.pyc\n*.mo\n*.gz\n',
+            os.path.join('src', 'unknown.txt'): b'not in the dataset\n',
+            os.path.join('src', '.git', 'HEAD'): b'skipped',
+        }
+        for name, content in files.items():
+            with open(os.path.join(tmpdir, name), 'wb') as fh:
+                fh.write(content)
+        os.symlink('gitignore', os.path.join(tmpdir, 'link'))
+        # symlinked directories are not followed, but recorded as links
+        os.symlink('src', os.path.join(tmpdir, 'dirlink'))
+        # not a valid utf8 name
+        os.symlink(b'\xff\xfe', os.path.join(tmpdir.encode(), b'badlink'))
+        saved_path = PATHS.get('blob_first_author')
+        saved_commits_path = PATHS.get('blob_commits')
+        try:
+            db_path = os.path.join(tmpdir, 'b2fa.tch')
+            db = Hash(db_path.encode('ascii'), writer=True)
+            db[binascii.unhexlify(sha)] = \
+                b'1500000000;Alice <a@example.com>;' + binascii.unhexlify(commit)
+            db.close()
+            PATHS['blob_first_author'] = (db_path, 0)
+            for workers in (0, 2):
+                records = {os.path.relpath(path, tmpdir): rest for path, *rest
+                           in scan_directory(tmpdir, workers, batch_size=2)}
+                self.assertEqual(set(records), {
+                    'gitignore', 'link', os.path.join('src', 'unknown.txt'),
+                    'b2fa.tch', os.fsdecode(b'badlink'), 'dirlink'})
+                self.assertEqual(records['dirlink'], [
+                    Blob.string_sha(b'src'), None, None])
+                self.assertEqual(records['badlink'][0],
+                                 Blob.string_sha(b'\xff\xfe'))
+                self.assertEqual(records['gitignore'],
+                                 [sha, 'Alice <a@example.com>', commit])
+                self.assertEqual(records['link'], [
+                    Blob.string_sha(b'gitignore'), None, None])
+                self.assertEqual(records[os.path.join('src', 'unknown.txt')],
+                                 [Blob.string_sha(b'not in the dataset\n'),
+                                  None, None])
+            self.assertEqual(Blob(sha).first_author,
+                             ('1500000000', 'Alice <a@example.com>', commit))
+
+            # without blob_first_author, the earliest of blob_commits is used
+            del PATHS['blob_first_author']
+            PATHS._resolved.add('blob_first_author')  # don't look it up
+            commits = [bytes([ch]) * 20 for ch in range(0x80, 0x83)]
+            db_path = os.path.join(tmpdir, 'b2c.tch')
+            db = Hash(db_path.encode('ascii'), writer=True)
+            db[binascii.unhexlify(sha)] = b''.join(commits)
+            db.close()
+            PATHS['blob_commits'] = (db_path, 0)
+            cache = cache_objects(1024 ** 2)
+            for ts, bin_sha in zip((300, 100, 200), commits):
+                cache.put(('commit', bin_sha), (
+                    b'tree %s\nauthor A%d <a@b.c> %d +0000\n'
+                    b'committer A <a@b.c> %d +0000\n\nmsg\n'
+                    % (b'01' * 20, ts, ts, ts)))
+            path = os.path.join(tmpdir, 'gitignore')
+            self.assertEqual(list(scan_directory(path, 0)), [
+                (path, sha, 'A100 <a@b.c>', binascii.hexlify(
+                    commits[1]).decode('ascii'))])
+            # blobs in too many commits, e.g. an empty file, are skipped
+            self.assertEqual(list(scan_directory(path, 0, max_commits=2)),
+                             [(path, sha, None, None)])
+        finally:
+            cache_objects(0)
+            for dtype, saved in (('blob_first_author', saved_path),
+                                 ('blob_commits', saved_commits_path)):
+                if saved is not None:
+                    PATHS[dtype] = saved
+                elif dict.__contains__(PATHS, dtype):
+                    del PATHS[dtype]
+            TCH_POOL.clear()
+            shutil.rmtree(tmpdir)
+
     def test_data(self):
         # blob has a different .data implementation
         sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
@@ -123,6 +837,38 @@ class TestTree(unittest.TestCase):
         self.assertIn(u'46aaf071f1b859c5bf452733c2583c70d92cd0c8', tree)
         self.assertIn(Blob(u'46aaf071f1b859c5bf452733c2583c70d92cd0c8'), tree)
 
+    def test_views(self):
+        tree = Tree(u'd4ddbae978c9ec2dc3b7b3497c2086ecf7be7d9d')
+        entries = list(tree)
+        self.assertEqual(len(entries), 6)
+        self.assertEqual(entries[0][:2], (b'100755', b'.gitignore'))
+        self.assertEqual(
+            [tuple(bytes(v) for v in entry) for entry in tree.views()],
+            entries)
+        data = tree.data
+        self.assertEqual(
+            [(data[start:name_start - 1], data[name_start:sha_start - 1],
+              data[sha_start:sha_start + 20])
+             for start, name_start, sha_start in tree.offsets()],
+            entries)
+
+    def test_traverse(self):
+        tree = Tree(u'd4ddbae978c9ec2dc3b7b3497c2086ecf7be7d9d')
+        subtree_sha = binascii.unhexlify(
+            u'954829887af5d9071aa92c427133ca2cdd0813cc')
+        blob_sha = binascii.unhexlify(
+            u'ff1f7925b77129b31938e76b5661f0a2c4500556')
+        # memoized subtrees are not read again
+        memo = {subtree_sha: [(b'100644', b'__init__.py', blob_sha)]}
+        files = list(tree.traverse(memo))
+        self.assertEqual(len(files), 7)
+        self.assertIn((b'100644', b'minicms/__init__.py', blob_sha), files)
+        self.assertIn(tree.bin_sha, memo)
+        self.assertEqual(list(tree.traverse(memo)), files)
+        # without a memo, traversal is lazy; some of the subtrees are missing
+        # from fixtures, so a full walk would fail
+        self.assertEqual(next(tree.traverse()), files[0])
+
     def test_len(self):
         tree = Tree(u'd4ddbae978c9ec2dc3b7b3497c2086ecf7be7d9d')
         self.assertEqual(len(tree), 5)
@@ -151,6 +897,25 @@ class TestCommit(unittest.TestCase):
         self.assertEqual(Commit(sha), Commit(sha))
         self.assertNotEqual(Commit(sha), Blob(sha))
 
+    def test_fetch_many(self):
+        shas = [u'f2a7fcdc51450ab03cb364415f14e634fa69b62c',
+                u'f200000000000000000000000000000000000000',
+                u'e38126dbca6572912013621d2aa9e6f7c50f36bc']
+        values = Commit.fetch_many(shas, 'commit_random')
+        self.assertEqual(len(values), 3)
+        self.assertIsNone(values[1])
+        self.assertEqual(values[0], Commit(shas[0]).read_tch('commit_random'))
+        self.assertEqual(values[2], Commit(shas[2]).read_tch('commit_random'))
+        # objects and binary shas are accepted as well
+        self.assertEqual(
+            Commit.fetch_many([Commit(shas[2]), binascii.unhexlify(shas[0])],
+                              'commit_random'),
+            [values[2], values[0]])
+        # reading shards concurrently should give the same result
+        self.assertEqual(
+            fetch_parallel([Commit(sha) for sha in shas], 'commit_random',
+                           workers=2), values)
+
     def test_data(self):
         data = Commit(u'f2a7fcdc51450ab03cb364415f14e634fa69b62c').data
         self.assertEqual(
@@ -178,12 +943,243 @@ class TestCommit(unittest.TestCase):
         self.assertRaises(AttributeError, lambda: c.arbitrary_attr)
         self.assertIsNone(c.signature)
 
+        # parsing directly, and more than once
+        c = Commit(u'e38126dbca6572912013621d2aa9e6f7c50f36bc')
+        c._parse()
+        c._parse()
+        self.assertEqual(c.authored_at.strftime('%Y-%m-%d %H:%M:%S %z'),
+                         '2012-05-19 01:14:08 +1100')
+
         c = Commit(u'1cc6f4418dcc09f64dcbb0410fec76ceaa5034ab')
         self.assertIsInstance(c.signature, bytes)
         self.assertGreater(len(c.signature), 450)  # 454 for this commit
 
+    def test_diff(self):
+        def sha(char):
+            return char * 20
+
+        def tree(*entries):
+            return b''.join(mode + b' ' + fname + b'\x00' + bin_sha
+                            for mode, fname, bin_sha in entries)
+
+        def commit(tree_sha, parent_sha):
+            return (b'tree %s\nparent %s\n'
+                    b'author A <a@b.c> 1375321509 +1100\n'
+                    b'committer A <a@b.c> 1375321509 +1100\n\nmsg\n') % (
+                binascii.hexlify(tree_sha), binascii.hexlify(parent_sha))
+
+        # objects are injected into the cache instead of the storage
+        cache = cache_objects(1024 ** 2)
+        try:
+            cache.put(('tree', sha(b'\x01')), tree(
+                (b'100644', b'a.txt', sha(b'\xa1')),
+                (b'100644', b'old.txt', sha(b'\xa2')),
+                (b'40000', b'dir', sha(b'\x02')),
+                (b'40000', b'same', sha(b'\x03'))))
+            cache.put(('tree', sha(b'\x02')), tree(
+                (b'100644', b'x', sha(b'\xa3'))))
+            cache.put(('tree', sha(b'\x11')), tree(
+                (b'100644', b'a.txt', sha(b'\xb1')),
+                (b'100644', b'new.txt', sha(b'\xb2')),
+                (b'40000', b'dir', sha(b'\x12')),
+                (b'40000', b'same', sha(b'\x03'))))
+            cache.put(('tree', sha(b'\x12')), tree(
+                (b'100644', b'y', sha(b'\xa3'))))
+            cache.put(('commit', sha(b'\x21')),
+                      commit(sha(b'\x01'), sha(b'\x20')))
+            cache.put(('commit', sha(b'\x22')),
+                      commit(sha(b'\x11'), sha(b'\x21')))
+
+            misses = cache.stats()['misses']
+            diff = set(Commit(sha(b'\x22')).__sub__(
+                Commit(sha(b'\x21')), threshold=1))
+            # the subtree 'same' was not read
+            self.assertEqual(cache.stats()['misses'], misses)
+            self.assertEqual(diff, {
+                (b'a.txt', b'a.txt', sha(b'\xa1'), sha(b'\xb1')),
+                (b'dir/x', b'dir/y', sha(b'\xa3'), sha(b'\xa3')),
+                (None, b'new.txt', None, sha(b'\xb2')),
+                (b'old.txt', None, sha(b'\xa2'), None),
+            })
+
+            # inexact renames, using real blobs: README.rst and setup.py
+            readme = binascii.unhexlify(
+                u'234a57538f15d72f00603bf086b465b0f2cda7b5')
+            setup_py = binascii.unhexlify(
+                u'46aaf071f1b859c5bf452733c2583c70d92cd0c8')
+            cache.put(('tree', sha(b'\x31')), tree(
+                (b'100644', b'README.rst', readme)))
+            cache.put(('tree', sha(b'\x32')), tree(
+                (b'100644', b'setup.py', setup_py)))
+            cache.put(('commit', sha(b'\x41')),
+                      commit(sha(b'\x31'), sha(b'\x40')))
+            cache.put(('commit', sha(b'\x42')),
+                      commit(sha(b'\x32'), sha(b'\x41')))
+            child, parent = Commit(sha(b'\x42')), Commit(sha(b'\x41'))
+            # these files have little in common
+            self.assertEqual(list(child.__sub__(parent, threshold=0)),
+                             [(b'README.rst', b'setup.py', readme, setup_py)])
+            self.assertEqual(set(child.__sub__(parent, threshold=0.5)), {
+                (b'README.rst', None, readme, None),
+                (None, b'setup.py', None, setup_py)})
+        finally:
+            cache_objects(0)
+
+    def test_parse_many(self):
+        c = Commit(u'f2a7fcdc51450ab03cb364415f14e634fa69b62c')
+        record, missing = Commit.parse_many([c.data, None])
+        self.assertIsNone(missing)
+        self.assertEqual(record.tree_sha, c.tree.bin_sha)
+        self.assertEqual(record.parent_shas, c.parent_shas)
+        self.assertEqual(record.author, b'Pavel Puchkin <neoascetic@gmail.com>')
+        self.assertEqual(record.message, b'License changed :P')
+        self.assertEqual((record.authored_ts, record.author_tz),
+                         (1375321509, 660))
+        self.assertEqual((record.committed_ts, record.committer_tz),
+                         (1375321597, 660))
+        self.assertEqual(record.authored_at, c.authored_at)
+        self.assertIsNone(record.signature)
+
+        # no tree, authored in the future
+        raw = (b'author A <a@b.c> 3337145807 +1100\n'
+               b'committer A <a@b.c> 1337145807 +1100\n\nmsg\n')
+        record, = Commit.parse_many([raw])
+        self.assertEqual(record.authored_ts, -1)
+        self.assertIsNone(record.authored_at)
+        self.assertEqual(record.committed_ts, 1337145807)
+        c = Commit(b'\x01' * 20)
+        c._data = raw
+        c._parse()
+        self.assertIsNone(c.tree)
+        self.assertIsNone(c.authored_at)
+
 
 class TestProject(unittest.TestCase):
+    def test_graph(self):
+        def sha(char):
+            return char * 20
+
+        def commit(ts, *parents):
+            return b''.join(
+                [b'tree %s\n' % binascii.hexlify(sha(b'\x01'))]
+                + [b'parent %s\n' % binascii.hexlify(parent)
+                   for parent in parents]
+                + [b'author A <a@b.c> %d +0000\n' % ts,
+                   b'committer A <a@b.c> %d +0000\n\nmsg\n' % ts])
+
+        root, a, b, c, merge = (sha(bytes([ch])) for ch in range(0x50, 0x55))
+        orphan, outside, missing = sha(b'\x55'), sha(b'\x56'), sha(b'\xf2')
+        cache = cache_objects(1024 ** 2)
+        try:
+            cache.put(('commit', root), commit(100))
+            cache.put(('commit', a), commit(200, root))
+            cache.put(('commit', b), commit(300, a))
+            cache.put(('commit', c), commit(250, root))
+            cache.put(('commit', merge), commit(400, b, c))
+            cache.put(('commit', orphan), commit(150, outside))
+
+            p = Project(b'test_graph')
+            p._commit_shas = (root, a, b, c, merge, orphan, missing)
+            g = p.graph
+            # every commit is looked up in the cache only once
+            self.assertEqual(cache.stats()['hits'], 6)
+            self.assertEqual(cache.stats()['misses'], 1)
+        finally:
+            cache_objects(0)
+
+        self.assertEqual(len(g), 6)
+        self.assertNotIn(missing, g)
+        self.assertEqual(g.parents(merge), (b, c))
+        self.assertEqual(set(g.children(root)), {a, c})
+        self.assertEqual(list(g.generation), [1, 2, 3, 2, 4, 1])
+        self.assertEqual(g.head, merge)
+        self.assertEqual(p.head, Commit(merge))
+        self.assertEqual(p.tail, root)
+        self.assertEqual(list(g.first_parent_chain()), [merge, b, a, root])
+        self.assertEqual(list(g.first_parent_chain(orphan)), [orphan])
+        self.assertEqual(g.first_parent_of(orphan), outside)
+        self.assertEqual(set(g.ancestors(merge)), {root, a, b, c})
+        self.assertTrue(g.is_ancestor(root, b))
+        self.assertTrue(g.is_ancestor(b, b))
+        self.assertFalse(g.is_ancestor(c, b))
+        self.assertEqual(g.merge_base(b, c), root)
+        self.assertEqual(g.merge_base(merge, b), b)
+        self.assertIsNone(g.merge_base(orphan, b))
+
+        # commit_data (c2dat) of a child dated in the future
+        future = sha(b'\x57')
+        tmpdir = tempfile.mkdtemp()
+        saved_path = PATHS.get('commit_data')
+        try:
+            path = os.path.join(tmpdir, 'c2dat.tch')
+            db = Hash(path.encode('ascii'), writer=True)
+            db[root] = b'100;+0000;A <a@b.c>;%s;' % (b'01' * 20)
+            db[future] = b'3337145807;+0000;A <a@b.c>;%s;%s' % (
+                b'01' * 20, binascii.hexlify(root))
+            db.close()
+            PATHS['commit_data'] = (path, 0)
+            g = CommitGraph((root, future))
+        finally:
+            if saved_path is None:
+                del PATHS['commit_data']
+            else:
+                PATHS['commit_data'] = saved_path
+            shutil.rmtree(tmpdir)
+        self.assertEqual(list(g.time), [100, -1])
+
+    def test_timeline(self):
+        def commit(ts, tz, author, *parents):
+            return b''.join(
+                [b'tree %s\n' % (b'01' * 20)]
+                + [b'parent %s\n' % binascii.hexlify(parent)
+                   for parent in parents]
+                + [b'author %s %d %s\n' % (author, ts, tz),
+                   b'committer A <a@b.c> %d +0000\n\nmsg\n' % ts])
+
+        a, b, merge, bot, future = (
+            bytes([ch]) * 20 for ch in range(0x70, 0x75))
+        monday = 4 * 86400  # 1970-01-05
+        cache = cache_objects(1024 ** 2)
+        try:
+            cache.put(('commit', a), commit(monday, b'+0000', b'A <a@b.c>'))
+            cache.put(('commit', b), commit(
+                monday - 60, b'+0100', b'B <b@b.c>'))
+            cache.put(('commit', merge), commit(
+                monday + 36 * 86400, b'-0500', b'A <a@b.c>', a, b))
+            cache.put(('commit', bot), commit(
+                monday, b'+0000', IGNORED_AUTHORS, merge))
+            # dated in the future, i.e. invalid
+            cache.put(('commit', future), commit(
+                3337145807, b'+0000', b'B <b@b.c>', merge))
+            p = Project(b'test_timeline')
+            p._commit_shas = (a, b, merge, bot, b'\xf2' * 20, future)
+            tl = p.timeline()
+        finally:
+            cache_objects(0)
+
+        self.assertEqual(tl.shas, [a, b, merge, future])
+        self.assertEqual(list(tl.time), [monday, monday - 60,
+                                         monday + 36 * 86400, -1])
+        self.assertEqual(list(tl.tz), [0, 60, -300, 0])
+        self.assertEqual(tl.authors, [b'A <a@b.c>', b'B <b@b.c>'])
+        self.assertEqual(list(tl.author), [0, 1, 0, 1])
+        self.assertEqual(list(tl.parents), [0, 0, 2, 1])
+
+        days, counts = tl.counts('day')
+        self.assertEqual(str(days[0]), '1970-01-04')
+        self.assertEqual((len(days), counts.sum()), (38, 3))
+        weeks, counts = tl.counts('week')
+        self.assertEqual([str(w) for w in weeks[:2]],
+                         ['1969-12-29', '1970-01-05'])
+        self.assertEqual(list(counts), [1, 1, 0, 0, 0, 0, 1])
+        weeks, counts = tl.counts('week', local=True)
+        self.assertEqual(str(weeks[0]), '1970-01-05')
+        self.assertEqual(list(counts), [2, 0, 0, 0, 0, 1])
+        months, counts = tl.counts('month', mask=tl.parents < 2)
+        self.assertEqual(([str(m) for m in months], list(counts)),
+                         (['1970-01'], [2]))
+        self.assertRaises(ValueError, tl.counts, 'year')
+
     def test_url(self):
         self.assertEqual(Project(b'testuser_test_proj').url,
                          b'https://github.com/testuser/test_proj')
@@ -195,6 +1191,154 @@ class TestProject(unittest.TestCase):
                          b'https://github.com/drupal.com/testproj')
 
 
+class TestQuery(unittest.TestCase):
+    def test_query(self):
+        def commit(author, parent):
+            return (b'tree %s\nparent %s\n'
+                    b'author %s 1375321509 +1100\n'
+                    b'committer A <a@b.c> 1375321509 +1100\n\nmsg\n') % (
+                binascii.hexlify(b'\x01' * 20), binascii.hexlify(parent),
+                author)
+
+        x, y, z = b'\x60' * 20, b'\x61' * 20, b'\x62' * 20
+        cache = cache_objects(1024 ** 2)
+        try:
+            cache.put(('commit', x), commit(b'A <a@b.c>', y))
+            cache.put(('commit', y), commit(b'A <a@b.c>', z))
+            cache.put(('commit', z), commit(b'B <b@b.c>', x))
+            commits = [Commit(x), Commit(x), Commit(y), Commit(z)]
+
+            hits = cache.stats()['hits']
+            authors = list(query(commits, batch_size=2).authors())
+            # the duplicate commit was read only once
+            self.assertEqual(cache.stats()['hits'] - hits, 3)
+            self.assertEqual(authors, [Author(b'A <a@b.c>')] * 2
+                             + [Author(b'B <b@b.c>')])
+            self.assertEqual(
+                list(query(commits).authors().distinct()),
+                [Author(b'A <a@b.c>'), Author(b'B <b@b.c>')])
+            self.assertEqual(list(query(Commit(x)).parents().parents()
+                                  .parents().limit(2)), [Commit(x)])
+            self.assertEqual(
+                list(query(commits).parents().filter(
+                    lambda c: c.bin_sha != y).limit(1)), [Commit(z)])
+        finally:
+            cache_objects(0)
+        with self.assertRaises(ValueError):
+            list(query(Commit(x)).commits())
+
+
+class TestAio(unittest.TestCase):
+    def test_aio(self):
+        import asyncio
+        blob_sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
+        shas = (u'f2a7fcdc51450ab03cb364415f14e634fa69b62c',
+                u'e38126dbca6572912013621d2aa9e6f7c50f36bc')
+
+        async def main():
+            commit = await aio.load(Commit(shas[0]))
+            self.assertIn('_data', commit.__dict__)
+            self.assertEqual(commit.author,
+                             b'Pavel Puchkin <neoascetic@gmail.com>')
+
+            with Stats() as s:
+                data = await asyncio.gather(
+                    aio.blob_data(blob_sha), aio.blob_data(Blob(blob_sha)))
+            self.assertEqual(data[0], Blob(blob_sha).data)
+            self.assertEqual(data[1], data[0])
+            # concurrent requests are coalesced
+            self.assertEqual(
+                s.counters(by=('op',))[('blob_data',)]['count'], 1)
+
+            project = Project(b'test_aio')
+            project._commit_shas = tuple(
+                binascii.unhexlify(sha) for sha in shas)
+            return [commit async for commit in aio.commits(project)]
+
+        aio.configure(batch_size=1)
+        # asyncio.run() is only available in Python 3.7+
+        loop = asyncio.new_event_loop()
+        try:
+            commits = loop.run_until_complete(main())
+        finally:
+            aio.configure(batch_size=256)
+            loop.close()
+        self.assertEqual([c.sha for c in commits], list(shas))
+        self.assertEqual(commits[1].data, Commit(shas[1]).data)
+
+
+class TestLookupServer(unittest.TestCase):
+    def test_lookup_server(self):
+        import threading
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'oscar.sock')
+        server = LookupServer(path, window=0.05)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+
+        sha = u'f2a7fcdc51450ab03cb364415f14e634fa69b62c'
+        blob_sha = u'83d22195edc1473673f1bf35307aea6edf3c37e3'
+        expected = Commit(sha).data, Blob(blob_sha).data
+        use_lookup_server(path)
+        try:
+            # concurrent requests of several clients are batched;
+            # how many land in the same batch depends on scheduling
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(
+                (Commit(sha).data, Blob(blob_sha).data))) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(results, [expected] * 4)
+            batches = server.batches
+            self.assertLess(batches, 8)
+
+            # the second time, values come from the cache
+            self.assertEqual(Commit(sha).data, expected[0])
+            self.assertEqual(server.batches, batches)
+            self.assertEqual(Blob.read_many([blob_sha, b'\x03' * 20]),
+                             [expected[1], None])
+            self.assertIsNone(
+                Commit(b'\xf2' * 20).read_tch('commit_random'))
+            # other users can't connect
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+            # a server that never replies
+            silent_path = os.path.join(tmpdir, 'silent.sock')
+            silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            silent.bind(silent_path)
+            silent.listen(1)
+            client = LookupClient(silent_path, timeout=0.1)
+            try:
+                self.assertRaises(
+                    IOError, client.get, 'commit_random', b'\xf2' * 20)
+            finally:
+                client.close()
+                silent.close()
+        finally:
+            use_lookup_server(None)
+            server.shutdown()
+            thread.join()
+            shutil.rmtree(tmpdir)
+
+    def test_messages(self):
+        from oscar import _recv_msg, _send_msg
+        a, b = socket.socketpair()
+        try:
+            _send_msg(a, [b'commit_random', None, b''])
+            self.assertEqual(_recv_msg(b), [b'commit_random', None, b''])
+            # a field longer than the message
+            a.sendall(b'\x00\x00\x00\x08\x00\x00\x00\x01\x00\x00\x00\x05')
+            self.assertRaises(ValueError, _recv_msg, b)
+        finally:
+            a.close()
+            b.close()
+
+
 class TestFile(unittest.TestCase):
     # this class consists of relations only - nothing to unit test
     pass
@@ -5,15 +5,20 @@ Unit tests - only to check functions do what they are expected to do.
 Please refrain from checking integrity of the dataset.
 """
 
+import os
 import unittest
 
+import lzf
+
 cimport oscar
+# decomp() and decomp_many() are Python functions, not declared in oscar.pxd
+from oscar import decomp, decomp_many
 
 class TestUtils(unittest.TestCase):
-    # ignored, as they're executed on import anyway:
+    # ignored, as they're executed on the first use of PATHS anyway:
     #     _latest_version
     #     _key_length
-    #     _get_paths
+    #     PathRegistry
 
     def test_unber(self):
         self.assertEqual(oscar.unber(b'\x00\x83M'), [0, 461])
@@ -34,8 +39,30 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(oscar.lzf_length(b'\xc4\xa6\x1f100644'), (2, 294))
 
     def test_decomp(self):
-        # TODO: test decomp()
-        pass
+        # Compress::LZF header is the uncompressed size, encoded like UTF-8
+        data = b'abc' * 100
+        raw = b'\xc4\xac' + lzf.compress(data)
+        self.assertEqual(decomp(raw), data)
+        # buffers are decompressed without copying
+        self.assertEqual(decomp(memoryview(b'xx' + raw)[2:]), data)
+        self.assertEqual(decomp(bytearray(raw)), data)
+        # incompressible data is stored as is
+        self.assertEqual(decomp(b'\x00abc'), b'abc')
+        self.assertEqual(decomp(b''), b'')
+        # large values are decompressed without the GIL
+        large = os.urandom(1000) * 30
+        large_raw = b'\xe7\x94\xb0' + lzf.compress(large)
+        self.assertEqual(oscar.lzf_length(large_raw), (3, 30000))
+        self.assertEqual(decomp(large_raw), large)
+        # truncated input
+        self.assertRaises(ValueError, decomp, raw[:-3])
+        self.assertRaises(ValueError, decomp, b'\xc4')
+
+        self.assertEqual(
+            decomp_many([raw, None, b'', b'\x00abc', memoryview(raw),
+                               large_raw]),
+            [data, None, b'', b'abc', data, large])
+        self.assertRaises(ValueError, decomp_many, [raw, raw[:-3]])
 
     def test_fnvhash(self):
         self.assertEqual(hex(oscar.fnvhash(b'foo')), '0xa9f37ed7')